@@ -1,6 +1,12 @@
-from shutil import rmtree
-from os.path import exists
-from os import mkdir
+from os.path import basename, exists
+from os import cpu_count, mkdir, remove
+try:
+    from os import sched_getaffinity
+except ImportError:
+    sched_getaffinity = None
+from json import dump, load
+from typing import Union
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
@@ -14,9 +20,10 @@ from pathlib import Path
 def create_key_cert(subject: x509.Name, san_names: list[str], san_ips: list[str], cert_days: int, public_exponent: int,
                     key_length: int, filename: str, key_ext: str, cert_ext: str, pem_ext: str, issuer_key=None,
                     issuer_cert=None, is_ca: bool = False, ca_suffix: str = '', is_key_encrypter: bool = False,
-                    is_cert_signer: bool = False) -> tuple:
-    # Create key
-    key: RSAPrivateKey = rsa.generate_private_key(public_exponent=public_exponent, key_size=key_length)
+                    is_cert_signer: bool = False, key: RSAPrivateKey = None) -> tuple:
+    # Create key unless one was created ahead of time
+    if key is None:
+        key: RSAPrivateKey = rsa.generate_private_key(public_exponent=public_exponent, key_size=key_length)
 
     # Create certificate and set up names
     cert = x509.CertificateBuilder()
@@ -92,7 +99,85 @@ def create_key_cert(subject: x509.Name, san_names: list[str], san_ips: list[str]
     return key, cert
 
 
-def create_tls_materials(project_folder: Path, setup_config: dict) -> None:
+def create_private_key_der(public_exponent: int, key_length: int) -> bytes:
+    # Create a key in a pool process; it travels back as DER since key objects cannot be pickled
+    key: RSAPrivateKey = rsa.generate_private_key(public_exponent=public_exponent, key_size=key_length)
+    return key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+def get_usable_cpu_count() -> int:
+    # Count the cores this process may run on; CPU affinity is only available on some platforms such as Linux
+    if sched_getaffinity is not None:
+        return len(sched_getaffinity(0))
+    return cpu_count() or 1
+
+
+def create_private_keys(key_count: int, public_exponent: int, key_length: int) -> list[RSAPrivateKey]:
+    # Spread prime generation, which is nearly all of the run time, across the available cores
+    worker_count: int = max(min(key_count, get_usable_cpu_count()), 1)
+    print(f'Creating {key_count} RSA keys with {worker_count} processes...')
+
+    private_keys: list[RSAPrivateKey] = []
+    with ProcessPoolExecutor(max_workers=worker_count) as key_pool:
+        key_futures: list[Future] = [
+            key_pool.submit(create_private_key_der, public_exponent, key_length) for _ in range(key_count)
+        ]
+        for key_future in as_completed(key_futures):
+            # The pool just created the key, so skip the slow RSA checks when loading it back
+            private_keys.append(serialization.load_der_private_key(
+                key_future.result(), None, unsafe_skip_rsa_key_validation=True
+            ))
+            print(f'Created {len(private_keys)} of {key_count} RSA keys...')
+
+    return private_keys
+
+
+def get_material_files(tls_path: str, name: str, fs: dict, ca_suffix: str = '') -> list[str]:
+    # List every file create_key_cert writes for one set of materials
+    material_files: list[str] = [f'{tls_path}/{name}.{fs["keyExt"]}', f'{tls_path}/{name}.{fs["certExt"]}',
+                                 f'{tls_path}/{name}.{fs["pemExt"]}']
+    if ca_suffix:
+        material_files.append(f'{tls_path}/{name}-{ca_suffix}.{fs["certExt"]}')
+    return material_files
+
+
+def get_regeneration_reason(manifest_entry: Union[dict, None], inputs: dict, material_files: list[str],
+                            renew_percent: float) -> Union[str, None]:
+    # Find why a set of materials has to be generated again, or None when the existing one can be reused
+    if manifest_entry is None or not all(exists(material_file) for material_file in material_files):
+        return 'missing'
+    if manifest_entry['inputs'] != inputs:
+        return 'changed'
+
+    # Check the certificate on disk is still the one the manifest recorded
+    with open(material_files[1], 'rb') as cert_file:
+        cert: x509.Certificate = x509.load_pem_x509_certificate(cert_file.read())
+    if cert.fingerprint(hashes.SHA256()).hex() != manifest_entry['fingerprint']:
+        return 'changed'
+
+    # Renew once less than the set share of the validity period remains
+    renew_window: timedelta = (cert.not_valid_after_utc - cert.not_valid_before_utc) * renew_percent / 100
+    if cert.not_valid_after_utc - datetime.now(timezone.utc) <= renew_window:
+        return 'expiring'
+    return None
+
+
+def load_key_cert(material_files: list[str]) -> tuple[RSAPrivateKey, x509.Certificate]:
+    # Read back reused materials; the key was written by this program, so skip the slow RSA checks
+    with open(material_files[0], 'rb') as key_file:
+        key: RSAPrivateKey = serialization.load_pem_private_key(
+            key_file.read(), None, unsafe_skip_rsa_key_validation=True
+        )
+    with open(material_files[1], 'rb') as cert_file:
+        cert: x509.Certificate = x509.load_pem_x509_certificate(cert_file.read())
+    return key, cert
+
+
+def create_tls_materials(project_folder: Path, setup_config: dict) -> dict:
     # Create subgroups to save space
     dns: dict = setup_config['dns']
     tls: dict = setup_config['tls']
@@ -100,100 +185,180 @@ def create_tls_materials(project_folder: Path, setup_config: dict) -> None:
     tls_folder: dict = setup_config['fs']['tlsFolder']
     network: dict = setup_config['engine']['network']
     stage: dict = setup_config['stage']
+    tls_path: str = f'{project_folder}/{tls_folder}'
 
-    # Create TLS folder
-    if exists(f'{project_folder}/{tls_folder}'):
-        rmtree(f'{project_folder}/{tls_folder}')
-    mkdir(f'{project_folder}/{tls_folder}')
+    # Create TLS folder and read what earlier runs generated
+    if not exists(tls_path):
+        mkdir(tls_path)
+    manifest_fp: str = f'{tls_path}/{fs["tlsManifest"]}'
+    old_manifest: dict = {}
+    if exists(manifest_fp):
+        with open(manifest_fp) as manifest_file:
+            old_manifest = load(manifest_file)
 
-    # Generate CA TLS materials
-    print('Creating CA TLS materials...')
+    # Describe the CA TLS materials
     ca_cert_name: str = f'{dns['caName']}.{dns['domain']}'
-    ca_alt_names: list[str] = [ca_cert_name, dns['domain'], dns['default']]
-    ca_ips: list[str] = [f'{network['prefix']}.{network['startAddress']}']
-    ca_subject: x509.Name = x509.Name([
-        x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
-        x509.NameAttribute(NameOID.COMMON_NAME, ca_cert_name),
-    ])
-    ca_key, ca_cert = create_key_cert(
-        subject=ca_subject, san_names=ca_alt_names, san_ips=ca_ips, cert_days=tls['cert']['validDaysCA'],
-        public_exponent=tls['rsa']['publicExponent'], key_length=tls['rsa']['keyLength'],
-        filename=f'{project_folder}/{tls_folder}/{dns['caName']}', key_ext=fs['keyExt'], cert_ext=fs['certExt'],
-        pem_ext=fs['pemExt'], is_ca=True, is_cert_signer=True
-    )
+    ca_settings: dict = {
+        'name': dns['caName'],
+        'subject': x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
+            x509.NameAttribute(NameOID.COMMON_NAME, ca_cert_name),
+        ]),
+        'san_names': [ca_cert_name, dns['domain'], dns['default']],
+        'san_ips': [f'{network['prefix']}.{network['startAddress']}'],
+        'cert_days': tls['cert']['validDaysCA']
+    }
 
-    # Generate ingress TLS materials
-    print('Creating ingress TLS materials...')
-    ingress_alt_names: list[str] = [
-        dns['domain'], dns['default'], f'v3.{dns['domain']}', f'v4.{dns['domain']}',
-        f'{dns['ingressName']}.{dns['domain']}'
-    ]
-    ingress_subject: x509.Name = x509.Name([
-        x509.NameAttribute(NameOID.COUNTRY_NAME, 'US'),
-        x509.NameAttribute(NameOID.COMMON_NAME, dns['domain']),
-    ])
-    create_key_cert(
-        subject=ingress_subject, san_names=ingress_alt_names, san_ips=[dns['defaultIP']],
-        cert_days=tls['cert']['validDaysLeaf'], public_exponent=tls['rsa']['publicExponent'],
-        key_length=tls['rsa']['keyLength'], filename=f'{project_folder}/{tls_folder}/{dns['ingressName']}',
-        key_ext=fs['keyExt'], cert_ext=fs['certExt'],  pem_ext=fs['pemExt'], issuer_key=ca_key, issuer_cert=ca_cert,
-        ca_suffix=dns['caName'], is_key_encrypter=True
-    )
+    # Describe the ingress TLS materials
+    leaf_settings: list[dict] = [{
+        'name': dns['ingressName'],
+        'subject': x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, 'US'),
+            x509.NameAttribute(NameOID.COMMON_NAME, dns['domain']),
+        ]),
+        'san_names': [
+            dns['domain'], dns['default'], f'v3.{dns['domain']}', f'v4.{dns['domain']}',
+            f'{dns['ingressName']}.{dns['domain']}'
+        ],
+        'san_ips': [dns['defaultIP']]
+    }]
 
-    # Generate external TLS materials
-    print('Creating external TLS materials...')
+    # Describe the external TLS materials
     external_cert_name: str = f'{dns['externalName']}.{dns['domain']}'
-    external_alt_names: list[str] = [external_cert_name, dns['domain'], dns['default']]
-    external_subject: x509.Name = x509.Name([
-        x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
-        x509.NameAttribute(NameOID.COMMON_NAME, external_cert_name),
-    ])
-    create_key_cert(
-        subject=external_subject, san_names=external_alt_names, san_ips=[dns['defaultIP']],
-        cert_days=tls['cert']['validDaysLeaf'], public_exponent=tls['rsa']['publicExponent'],
-        key_length=tls['rsa']['keyLength'], filename=f'{project_folder}/{tls_folder}/{dns['externalName']}',
-        key_ext=fs['keyExt'], cert_ext=fs['certExt'], pem_ext=fs['pemExt'], issuer_key=ca_key, issuer_cert=ca_cert,
-        ca_suffix=dns['caName'], is_key_encrypter=True
-    )
+    leaf_settings.append({
+        'name': dns['externalName'],
+        'subject': x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
+            x509.NameAttribute(NameOID.COMMON_NAME, external_cert_name),
+        ]),
+        'san_names': [external_cert_name, dns['domain'], dns['default']],
+        'san_ips': [dns['defaultIP']]
+    })
 
-    # Generate datastore TLS materials
-    print('Creating datastore TLS materials...')
+    # Describe the datastore TLS materials
     datastore_cert_name: str = f'{dns['datastoreName']}.{dns['domain']}'
-    datastore_alt_names: list[str] = [datastore_cert_name, dns['domain'], dns['default']]
-    datastore_ip_addr: list[str] = [setup_config['server']['datastore']['networkAddress']]
-    datastore_subject: x509.Name = x509.Name([
-        x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
-        x509.NameAttribute(NameOID.COMMON_NAME, datastore_cert_name),
-    ])
-    create_key_cert(
-        subject=datastore_subject, san_names=datastore_alt_names, san_ips=datastore_ip_addr,
-        cert_days=tls['cert']['validDaysLeaf'], public_exponent=tls['rsa']['publicExponent'],
-        key_length=tls['rsa']['keyLength'], filename=f'{project_folder}/{tls_folder}/{dns['datastoreName']}',
-        key_ext=fs['keyExt'], cert_ext=fs['certExt'], pem_ext=fs['pemExt'], issuer_key=ca_key, issuer_cert=ca_cert,
-        ca_suffix=dns['caName'], is_key_encrypter=True
-    )
+    leaf_settings.append({
+        'name': dns['datastoreName'],
+        'subject': x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
+            x509.NameAttribute(NameOID.COMMON_NAME, datastore_cert_name),
+        ]),
+        'san_names': [datastore_cert_name, dns['domain'], dns['default']],
+        'san_ips': [setup_config['server']['datastore']['networkAddress']]
+    })
 
-    # Generate server stage TLS materials
+    # Describe the server stage TLS materials
     for i in range(stage['count']):
         server_stage_index = i + 1
-        print(f'Creating TLS materials for server stage {server_stage_index}...')
-
-        # Create current server_stage information
         server_stage_cert_name: str = f'{stage['namePrefix']}-{server_stage_index}.{dns['domain']}'
         server_stage_service_name: str = f'{stage['namePrefix']}-{server_stage_index}-service'
-        server_stage_ips: list[str] = [f'{network['prefix']}.{network['startAddress'] + server_stage_index}']
-        server_stage_alt_names: list[str] = [
-            server_stage_cert_name, server_stage_service_name, dns['domain'], dns['default']
-        ]
-        server_stage_subject: x509.Name = x509.Name([
-            x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
-            x509.NameAttribute(NameOID.COMMON_NAME, server_stage_cert_name),
-        ])
-        server_stage_name_prefix: str = f'{stage['namePrefix']}-{server_stage_index}'
-        create_key_cert(
-            subject=server_stage_subject, san_names=server_stage_alt_names, san_ips=server_stage_ips,
-            cert_days=tls['cert']['validDaysLeaf'], public_exponent=tls['rsa']['publicExponent'],
-            key_length=tls['rsa']['keyLength'], filename=f'{project_folder}/{tls_folder}/{server_stage_name_prefix}',
-            key_ext=fs['keyExt'], cert_ext=fs['certExt'], pem_ext=fs['pemExt'], issuer_key=ca_key, issuer_cert=ca_cert,
-            ca_suffix=dns['caName'], is_key_encrypter=True
+        leaf_settings.append({
+            'name': f'{stage['namePrefix']}-{server_stage_index}',
+            'subject': x509.Name([
+                x509.NameAttribute(NameOID.COUNTRY_NAME, dns['countryInitials']),
+                x509.NameAttribute(NameOID.COMMON_NAME, server_stage_cert_name),
+            ]),
+            'san_names': [server_stage_cert_name, server_stage_service_name, dns['domain'], dns['default']],
+            'san_ips': [f'{network['prefix']}.{network['startAddress'] + server_stage_index}']
+        })
+
+    # Record everything that goes into each set of materials so a change to any of it regenerates them
+    for material_settings in [ca_settings, *leaf_settings]:
+        material_settings['inputs'] = {
+            'subject': material_settings['subject'].rfc4514_string(),
+            'sanNames': material_settings['san_names'],
+            'sanIps': material_settings['san_ips'],
+            'validDays': material_settings.get('cert_days', tls['cert']['validDaysLeaf']),
+            'keyLength': tls['rsa']['keyLength'],
+            'publicExponent': tls['rsa']['publicExponent']
+        }
+
+    # Find the materials to regenerate; a new CA means every leaf has to be signed again
+    ca_files: list[str] = get_material_files(tls_path, dns['caName'], fs)
+    ca_reason: Union[str, None] = get_regeneration_reason(
+        old_manifest.get(dns['caName']), ca_settings['inputs'], ca_files, tls['cert']['renewPercent']
+    )
+    if ca_reason is None:
+        ca_key, ca_cert = load_key_cert(ca_files)
+    ca_fingerprint: Union[str, None] = None if ca_reason else ca_cert.fingerprint(hashes.SHA256()).hex()
+    for material_settings in leaf_settings:
+        material_settings['files'] = get_material_files(tls_path, material_settings['name'], fs, dns['caName'])
+        if ca_reason is None:
+            material_settings['inputs']['caFingerprint'] = ca_fingerprint
+            material_settings['reason'] = get_regeneration_reason(
+                old_manifest.get(material_settings['name']), material_settings['inputs'], material_settings['files'],
+                tls['cert']['renewPercent']
+            )
+        else:
+            material_settings['reason'] = 'caChanged'
+
+    # Generate the keys that are needed up front in parallel
+    stale_leaf_settings: list[dict] = [material_settings for material_settings in leaf_settings
+                                       if material_settings['reason'] is not None]
+    key_count: int = len(stale_leaf_settings) + (1 if ca_reason else 0)
+    private_keys: list[RSAPrivateKey] = []
+    if key_count > 0:
+        private_keys = create_private_keys(key_count, tls['rsa']['publicExponent'], tls['rsa']['keyLength'])
+
+    # Generate CA TLS materials
+    manifest: dict = {}
+    if ca_reason is not None:
+        print(f'Creating CA TLS materials ({ca_reason})...')
+        ca_key, ca_cert = create_key_cert(
+            subject=ca_settings['subject'], san_names=ca_settings['san_names'], san_ips=ca_settings['san_ips'],
+            cert_days=ca_settings['cert_days'], public_exponent=tls['rsa']['publicExponent'],
+            key_length=tls['rsa']['keyLength'], filename=f'{tls_path}/{dns['caName']}', key_ext=fs['keyExt'],
+            cert_ext=fs['certExt'], pem_ext=fs['pemExt'], is_ca=True, is_cert_signer=True, key=private_keys.pop()
         )
+        ca_fingerprint = ca_cert.fingerprint(hashes.SHA256()).hex()
+        for material_settings in leaf_settings:
+            material_settings['inputs']['caFingerprint'] = ca_fingerprint
+    else:
+        print('Reusing CA TLS materials...')
+    manifest[dns['caName']] = {
+        'status': 'reused' if ca_reason is None else 'created',
+        'reason': ca_reason,
+        'inputs': ca_settings['inputs'],
+        'fingerprint': ca_fingerprint,
+        'notValidAfter': ca_cert.not_valid_after_utc.isoformat(),
+        'files': [basename(ca_file) for ca_file in ca_files]
+    }
+
+    # Generate leaf TLS materials signed by the CA
+    for material_settings in leaf_settings:
+        if material_settings['reason'] is not None:
+            print(f'Creating {material_settings['name']} TLS materials ({material_settings['reason']})...')
+            _, leaf_cert = create_key_cert(
+                subject=material_settings['subject'], san_names=material_settings['san_names'],
+                san_ips=material_settings['san_ips'], cert_days=tls['cert']['validDaysLeaf'],
+                public_exponent=tls['rsa']['publicExponent'], key_length=tls['rsa']['keyLength'],
+                filename=f'{tls_path}/{material_settings['name']}', key_ext=fs['keyExt'], cert_ext=fs['certExt'],
+                pem_ext=fs['pemExt'], issuer_key=ca_key, issuer_cert=ca_cert, ca_suffix=dns['caName'],
+                is_key_encrypter=True, key=private_keys.pop()
+            )
+        else:
+            print(f'Reusing {material_settings['name']} TLS materials...')
+            _, leaf_cert = load_key_cert(material_settings['files'])
+        manifest[material_settings['name']] = {
+            'status': 'reused' if material_settings['reason'] is None else 'created',
+            'reason': material_settings['reason'],
+            'inputs': material_settings['inputs'],
+            'fingerprint': leaf_cert.fingerprint(hashes.SHA256()).hex(),
+            'notValidAfter': leaf_cert.not_valid_after_utc.isoformat(),
+            'files': [basename(leaf_file) for leaf_file in material_settings['files']]
+        }
+
+    # Remove materials an earlier run made for stages that no longer exist
+    for old_name, old_entry in old_manifest.items():
+        if old_name not in manifest:
+            print(f'Removing {old_name} TLS materials...')
+            for old_file in old_entry['files']:
+                if exists(f'{tls_path}/{old_file}'):
+                    remove(f'{tls_path}/{old_file}')
+
+    # Save and report the manifest
+    with open(manifest_fp, 'w') as manifest_file:
+        dump(manifest, manifest_file, indent=4)
+    reused_names: list[str] = [name for name, entry in manifest.items() if entry['status'] == 'reused']
+    print(f'Reused {len(reused_names)} of {len(manifest)} TLS materials: {', '.join(reused_names) or 'none'}.')
+    return manifest
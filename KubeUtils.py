@@ -184,6 +184,11 @@ def create_secret_volume(name: str, secret_name: str) -> dict:
     return {'name': name, 'secret': {'secretName': secret_name}}
 
 
+def create_empty_dir_volume(name: str) -> dict:
+    # Keep the volume in memory since it only holds small files shared between containers of one pod
+    return {'name': name, 'emptyDir': {'medium': 'Memory'}}
+
+
 def create_service(name: str, namespace_name: str, selector: dict, ports: list[dict], labels: dict = None) -> dict:
     # Create service
     service_config: dict = {
@@ -0,0 +1,145 @@
+from enum import StrEnum, auto
+from json import dumps, loads
+from struct import Struct, error as StructError
+from typing import BinaryIO, Union
+
+# Set the content types each wire format is sent with
+JSON_CONTENT_TYPE: str = 'application/json'
+BINARY_CONTENT_TYPE: str = 'application/x-fibonacci-pair'
+
+# Set the binary frame layout; every field is big-endian
+BINARY_VERSION: int = 1
+BINARY_FLAG_STEPS: int = 0b01
+BINARY_FLAG_SEQUENCE: int = 0b10
+BINARY_HEADER_STRUCT: Struct = Struct('>BB')
+BINARY_STEPS_STRUCT: Struct = Struct('>I')
+BINARY_SEQUENCE_STRUCT: Struct = Struct('>H')
+BINARY_NUMBER_STRUCT: Struct = Struct('>I')
+
+# Set the framing for transports without message boundaries; every frame is its length then its payload
+FRAME_LENGTH_STRUCT: Struct = Struct('>I')
+FRAME_MAX_BYTES: int = 1 << 24
+ACK_CODE_STRUCT: Struct = Struct('>H')
+
+
+# Specify valid wire formats
+class WireFormat(StrEnum):
+    JSON = auto()
+    BINARY = auto()
+
+
+def encode_number(number: int) -> bytes:
+    # Write a non-negative number as the fewest big-endian bytes that hold it
+    return number.to_bytes((number.bit_length() + 7) // 8, 'big')
+
+
+def decode_number(data: bytes) -> int:
+    return int.from_bytes(data, 'big')
+
+
+def encode_binary(fib_numbers: dict) -> bytes:
+    # Write the header, the optional fields that are present, then each number as length-prefixed bytes
+    flags: int = 0
+    optional_fields: bytes = b''
+    if 'steps' in fib_numbers:
+        flags |= BINARY_FLAG_STEPS
+        optional_fields += BINARY_STEPS_STRUCT.pack(int(fib_numbers['steps']))
+    if 'sequence' in fib_numbers:
+        flags |= BINARY_FLAG_SEQUENCE
+        sequence_bytes: bytes = str(fib_numbers['sequence']).encode()
+        optional_fields += BINARY_SEQUENCE_STRUCT.pack(len(sequence_bytes)) + sequence_bytes
+
+    frame: list[bytes] = [BINARY_HEADER_STRUCT.pack(BINARY_VERSION, flags), optional_fields]
+    for key in ['fib_one', 'fib_two']:
+        number_bytes: bytes = encode_number(int(fib_numbers[key]))
+        frame.extend([BINARY_NUMBER_STRUCT.pack(len(number_bytes)), number_bytes])
+
+    return b''.join(frame)
+
+
+def decode_binary(data: bytes) -> dict:
+    # Read the frame back into the same dictionary shape the JSON format produces
+    try:
+        version, flags = BINARY_HEADER_STRUCT.unpack_from(data, 0)
+        if version != BINARY_VERSION:
+            raise ValueError(f'Unsupported binary frame version {version}.')
+        offset: int = BINARY_HEADER_STRUCT.size
+        fib_numbers: dict = {}
+
+        if flags & BINARY_FLAG_STEPS:
+            fib_numbers['steps'] = BINARY_STEPS_STRUCT.unpack_from(data, offset)[0]
+            offset += BINARY_STEPS_STRUCT.size
+        if flags & BINARY_FLAG_SEQUENCE:
+            sequence_length: int = BINARY_SEQUENCE_STRUCT.unpack_from(data, offset)[0]
+            offset += BINARY_SEQUENCE_STRUCT.size
+            fib_numbers['sequence'] = data[offset:offset + sequence_length].decode()
+            offset += sequence_length
+
+        for key in ['fib_one', 'fib_two']:
+            number_length: int = BINARY_NUMBER_STRUCT.unpack_from(data, offset)[0]
+            offset += BINARY_NUMBER_STRUCT.size
+            if offset + number_length > len(data):
+                raise ValueError('Binary frame is shorter than its number lengths.')
+            fib_numbers[key] = decode_number(data[offset:offset + number_length])
+            offset += number_length
+    except StructError as e:
+        raise ValueError(f'Binary frame is truncated. Details: {e}')
+
+    return fib_numbers
+
+
+def encode_message(fib_numbers: dict, wire_format: str) -> tuple[bytes, str]:
+    # Return the body and the content type to send it with
+    if wire_format == WireFormat.BINARY.value:
+        return encode_binary(fib_numbers), BINARY_CONTENT_TYPE
+    else:
+        return dumps(fib_numbers).encode(), JSON_CONTENT_TYPE
+
+
+def guess_content_type(data: bytes) -> str:
+    # Tell the formats apart for transports without headers; JSON objects open with a brace, binary frames never do
+    return JSON_CONTENT_TYPE if data.lstrip()[:1] == b'{' else BINARY_CONTENT_TYPE
+
+
+def decode_message(data: bytes, content_type: str) -> dict:
+    # Pick the decoder from the content type and fall back to JSON for anything else
+    if content_type == BINARY_CONTENT_TYPE:
+        return decode_binary(data)
+    else:
+        fib_numbers = loads(data)
+        if not isinstance(fib_numbers, dict):
+            raise ValueError('JSON message must be an object.')
+        return fib_numbers
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return FRAME_LENGTH_STRUCT.pack(len(payload)) + payload
+
+
+def read_frame(stream: BinaryIO) -> Union[bytes, None]:
+    # Read one whole frame, or nothing if the stream ended cleanly between frames
+    header: bytes = stream.read(FRAME_LENGTH_STRUCT.size)
+    if not header:
+        return None
+    if len(header) < FRAME_LENGTH_STRUCT.size:
+        raise ValueError('Stream ended inside a frame header.')
+
+    length: int = FRAME_LENGTH_STRUCT.unpack(header)[0]
+    if length > FRAME_MAX_BYTES:
+        raise ValueError(f'Frame of {length} bytes is larger than the {FRAME_MAX_BYTES} byte limit.')
+    payload: bytes = stream.read(length)
+    if len(payload) < length:
+        raise ValueError('Stream ended inside a frame.')
+    return payload
+
+
+def encode_ack(return_code: int, log_id: str) -> bytes:
+    # Answer a frame with its response code and the log ID of the step it produced
+    return ACK_CODE_STRUCT.pack(return_code) + log_id.encode()
+
+
+def decode_ack(payload: bytes) -> tuple[int, str]:
+    try:
+        return ACK_CODE_STRUCT.unpack_from(payload, 0)[0], payload[ACK_CODE_STRUCT.size:].decode()
+    except StructError as e:
+        raise ValueError(f'Acknowledgement frame is truncated. Details: {e}')
@@ -1,27 +1,21 @@
 from server_init import *
 from os import getpid
+from abc import ABC, abstractmethod
 from os.path import exists
 from enum import StrEnum, auto
-from typing import Union
-from pymongo import MongoClient
-from pymongo.database import Database
-from pymongo.results import InsertOneResult
-from pymongo.errors import OperationFailure
-from psycopg2 import connect
-from psycopg2.errors import OperationalError
+from threading import Lock
+from time import monotonic
+from typing import Any, Union
 from base64 import b64encode
 from json import dumps
 from hashlib import sha256
-from requests import request, Response, RequestException
+from requests import Response, RequestException
+from network_utils import send_request
+from shared_utils import get_shared_state
 from datetime import datetime
 
-# Set datastore log counts
-DATASTORE_LOG_COUNT_SERVER: int = 0
-DATASTORE_LOG_COUNT_DEFAULT: int = 0
-DATASTORE_LOG_COUNT_OPERATION: int = 0
 
-
-# Create datastore connection if needed
+# Specify valid datastore types
 class DatastoreType(StrEnum):
     DSNONE = 'none'
     DSFILE = 'file'
@@ -30,38 +24,15 @@ class DatastoreType(StrEnum):
     POSTGRESQL = auto()
 
 
-if DATASTORE_TYPE == DatastoreType.MONGODB.value:
-    DATASTORE_CONNECTION: Union[MongoClient, connect] = MongoClient(
-        host=NETWORK_DATASTORE_ADDRESS, port=NETWORK_DATASTORE_PORT, username=DATASTORE_AUTH_USERNAME,
-        password=DATASTORE_AUTH_PASSWORD
-        # tls=True, tlsCAFile=SECRET_CA_CERT_TARGET, tlsCertificateKeyFile=SECRET_PEM_TARGET
-    )
-    DATASTORE_DATABASE: Database = DATASTORE_CONNECTION[DATASTORE_AUTH_USERNAME]
-    if 'datastore' not in DATASTORE_DATABASE.list_collection_names():
-        DATASTORE_DATABASE.create_collection(
-            name='datastore',
-            timeseries={
-                'timeField': 'log_time',
-                'metaField': 'log_server',
-                'granularity': 'seconds'
-            }
-        )
-elif DATASTORE_TYPE == DatastoreType.POSTGRESQL.value:
-    DATASTORE_CONNECTION: Union[MongoClient, connect] = connect(
-        dbname=DATASTORE_AUTH_USERNAME, user=DATASTORE_AUTH_USERNAME, password=DATASTORE_AUTH_PASSWORD,
-        host=NETWORK_DATASTORE_ADDRESS, port=NETWORK_DATASTORE_PORT
-        # sslmode='require', sslcert=SECRET_CERT_TARGET, sslkey=SECRET_KEY_TARGET,
-        # sslcertmode='require', sslrootcert=SECRET_CA_CERT_TARGET
-    )
-
-
 # Specify valid API types
 class APIType(StrEnum):
     REST = auto()
+    RESTASYNC = auto()
     GRPC = auto()
     SOAP = auto()
     GRAPHQL = auto()
     MQTT = auto()
+    TCP = auto()
 
 
 # Specify valid log types
@@ -84,6 +55,7 @@ class LogKind(StrEnum):
     HEALTHCHECK = auto()
     START = auto()
     DATASTORE = auto()
+    FIB = auto()
 
 
 def create_log(log_type: LogType, log_kinds: list[LogKind], server_id: dict, details: str) -> dict:
@@ -103,20 +75,13 @@ def create_log(log_type: LogType, log_kinds: list[LogKind], server_id: dict, det
 
 def save_log(filepath: str, cur_log: dict, server_id: Union[dict, None] = None,
              is_operation: bool = False) -> Union[tuple[bool, bool], bool]:
-    global DATASTORE_LOG_COUNT_SERVER
-    global DATASTORE_LOG_COUNT_DEFAULT
-    global DATASTORE_LOG_COUNT_OPERATION
-
-    # Get log count
+    # Get log count from the container-wide counters so IDs stay unique across workers
     if filepath == DATASTORE_LOGS_SERVER_PATH:
-        DATASTORE_LOG_COUNT_SERVER += 1
-        cur_log_count: int = DATASTORE_LOG_COUNT_SERVER
+        cur_log_count: int = get_shared_state().increment('logCountServer')
     elif filepath == DATASTORE_LOGS_DEFAULT_PATH:
-        DATASTORE_LOG_COUNT_DEFAULT += 1
-        cur_log_count: int = DATASTORE_LOG_COUNT_DEFAULT
+        cur_log_count: int = get_shared_state().increment('logCountDefault')
     elif filepath == DATASTORE_LOGS_OPERATION_PATH:
-        DATASTORE_LOG_COUNT_OPERATION += 1
-        cur_log_count: int = DATASTORE_LOG_COUNT_OPERATION
+        cur_log_count: int = get_shared_state().increment('logCountOperation')
     else:
         cur_log_count: int = -1
     assert cur_log_count > 0, 'File path should match one of the set paths.'
@@ -144,31 +109,47 @@ def save_log(filepath: str, cur_log: dict, server_id: Union[dict, None] = None,
         return success
 
 
-def send_log(cur_log: dict, server_id: dict):
-    if DATASTORE_TYPE == DatastoreType.DSNONE.value: # Save to local temp CSV
+# Create the datastore backends; each one imports its driver and connects only when it is built
+class DatastoreBackend(ABC):
+    driver_modules: tuple[str, ...] = ()
+
+    @abstractmethod
+    def send(self, cur_log: dict, server_id: dict) -> Union[str, None]:
+        # Store the log and return the details to record as an operation log, if any
+        pass
+
+
+class LocalDatastoreBackend(DatastoreBackend):
+    def send(self, cur_log: dict, server_id: dict) -> Union[str, None]:
+        # Save to local temp CSV
         save_log(DATASTORE_LOGS_DEFAULT_PATH, cur_log, server_id)
-    elif DATASTORE_TYPE == DatastoreType.DSFILE.value:  # Send to remote CSV
+        return None
+
+
+class FileDatastoreBackend(DatastoreBackend):
+    def send(self, cur_log: dict, server_id: dict) -> Union[str, None]:
+        # Send to remote CSV
         try:
-            response: Response = request(
+            response: Response = send_request(
                 method='POST',
                 url=f'https://{NETWORK_DATASTORE_ADDRESS}:{NETWORK_DATASTORE_PORT}/datastore',
-                json=cur_log,
-                cert=(SECRET_CERT_TARGET, SECRET_KEY_TARGET),
-                verify=TLS_CA_CERT_PATH
+                json=cur_log
             )
-            ds_details: str = f'Return info for file datastore sending: {response.json()}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
+            return f'Return info for file datastore sending: {response.json()}'
         except RequestException as e:
-            ds_details: str = f'Experienced Request Exception for file datastore. Details: {e}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
-    elif DATASTORE_TYPE == DatastoreType.ELASTICSTACK.value:  # Send to remote Elasticstack
+            return f'Experienced Request Exception for file datastore. Details: {e}'
+
+
+class ElasticstackDatastoreBackend(DatastoreBackend):
+    def send(self, cur_log: dict, server_id: dict) -> Union[str, None]:
+        # Send to remote Elasticstack
         try:
             cur_log['data_stream'] = {
                 'type': 'logs',
                 'dataset': f'fibonacci-{server_id['API']}-{server_id['STAGE_INDEX']}-{server_id['WORKER_PID']}',
                 'namespace': 'datastore'
             }
-            response: Response = request(
+            response: Response = send_request(
                 method='POST',
                 url=f'http://{NETWORK_DATASTORE_ADDRESS}:{NETWORK_DATASTORE_PORT}',
                 auth=(DATASTORE_AUTH_USERNAME, DATASTORE_AUTH_PASSWORD),
@@ -176,15 +157,42 @@ def send_log(cur_log: dict, server_id: dict):
                 # cert=(SECRET_CERT_TARGET, SECRET_KEY_TARGET),
                 # verify=SECRET_CA_CERT_TARGET
             )
-            ds_details: str = f'Return info for ElasticStack datastore sending: {response.text}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
+            return f'Return info for ElasticStack datastore sending: {response.text}'
         except RequestException as e:
-            ds_details: str = f'Experienced Request Exception for Elasticstack datastore. Details: {e}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
-    elif DATASTORE_TYPE == DatastoreType.MONGODB.value:  # Send to remote MongoDB
+            return f'Experienced Request Exception for Elasticstack datastore. Details: {e}'
+
+
+class MongoDatastoreBackend(DatastoreBackend):
+    driver_modules: tuple[str, ...] = ('pymongo',)
+
+    def __init__(self) -> None:
+        from pymongo import MongoClient
+        from pymongo.database import Database
+        from pymongo.errors import OperationFailure
+
+        # Create datastore connection
+        self.operation_failure: type[Exception] = OperationFailure
+        self.connection: MongoClient = MongoClient(
+            host=NETWORK_DATASTORE_ADDRESS, port=NETWORK_DATASTORE_PORT, username=DATASTORE_AUTH_USERNAME,
+            password=DATASTORE_AUTH_PASSWORD
+            # tls=True, tlsCAFile=SECRET_CA_CERT_TARGET, tlsCertificateKeyFile=SECRET_PEM_TARGET
+        )
+        database: Database = self.connection[DATASTORE_AUTH_USERNAME]
+        if 'datastore' not in database.list_collection_names():
+            database.create_collection(
+                name='datastore',
+                timeseries={
+                    'timeField': 'log_time',
+                    'metaField': 'log_server',
+                    'granularity': 'seconds'
+                }
+            )
+        self.collection: Any = database['datastore']
+
+    def send(self, cur_log: dict, server_id: dict) -> Union[str, None]:
         # Write to collection
         try:
-            result: InsertOneResult = DATASTORE_CONNECTION[DATASTORE_AUTH_USERNAME]['datastore'].insert_one({
+            result: Any = self.collection.insert_one({
                 'log_time': datetime.strptime(cur_log['time'], '%Y-%m-%d %H:%M:%S.%f'),
                 'log_server': cur_log['server'],
                 'log_type': cur_log['type'],
@@ -192,16 +200,32 @@ def send_log(cur_log: dict, server_id: dict):
                 'log_details': cur_log['details'],
                 'log_hash': cur_log['hash']
             })
-            ds_details: str = f'Result ID for MongoDB datastore sending: {result.inserted_id}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
-        except OperationFailure as e:
-            ds_details: str = f'Experienced Operational Failure. Details: {e}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
-    elif DATASTORE_TYPE == DatastoreType.POSTGRESQL.value:  # Send to remote PostgreSQL
+            return f'Result ID for MongoDB datastore sending: {result.inserted_id}'
+        except self.operation_failure as e:
+            return f'Experienced Operational Failure. Details: {e}'
+
+
+class PostgresDatastoreBackend(DatastoreBackend):
+    driver_modules: tuple[str, ...] = ('psycopg2',)
+
+    def __init__(self) -> None:
+        from psycopg2 import connect
+        from psycopg2.errors import OperationalError
+
+        # Create datastore connection
+        self.operational_error: type[Exception] = OperationalError
+        self.connection: Any = connect(
+            dbname=DATASTORE_AUTH_USERNAME, user=DATASTORE_AUTH_USERNAME, password=DATASTORE_AUTH_PASSWORD,
+            host=NETWORK_DATASTORE_ADDRESS, port=NETWORK_DATASTORE_PORT
+            # sslmode='require', sslcert=SECRET_CERT_TARGET, sslkey=SECRET_KEY_TARGET,
+            # sslcertmode='require', sslrootcert=SECRET_CA_CERT_TARGET
+        )
+
+    def send(self, cur_log: dict, server_id: dict) -> Union[str, None]:
         # Write to table
         try:
-            with DATASTORE_CONNECTION:
-                with DATASTORE_CONNECTION.cursor() as insert_cursor:
+            with self.connection:
+                with self.connection.cursor() as insert_cursor:
                     insert_cursor.execute("""
                         INSERT INTO datastore (log_time, log_server, log_type, log_kinds, log_details, log_hash) 
                         VALUES (%s, %s, %s, %s, %s, %s);
@@ -211,13 +235,78 @@ def send_log(cur_log: dict, server_id: dict):
                             cur_log['type'], cur_log['kinds'], cur_log['details'], cur_log['hash'],
                         )
                     )
-            ds_details: str = f'Successfully log with hash {cur_log["hash"]} to datastore.'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
-        except OperationalError as e:
-            ds_details: str = f'Experienced Operational Error. Details: {e}'
-            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
-    else:  # Error out
-        ds_details: str = 'Could not match server datastore option to available constants.'
+            return f'Successfully log with hash {cur_log["hash"]} to datastore.'
+        except self.operational_error as e:
+            return f'Experienced Operational Error. Details: {e}'
+
+
+# Map each datastore type to its backend; only the selected one is ever built
+DATASTORE_BACKENDS: dict[str, type[DatastoreBackend]] = {
+    DatastoreType.DSNONE.value: LocalDatastoreBackend,
+    DatastoreType.DSFILE.value: FileDatastoreBackend,
+    DatastoreType.ELASTICSTACK.value: ElasticstackDatastoreBackend,
+    DatastoreType.MONGODB.value: MongoDatastoreBackend,
+    DatastoreType.POSTGRESQL.value: PostgresDatastoreBackend
+}
+
+# Set up the per-process datastore state
+DATASTORE_BACKEND: Union[DatastoreBackend, None] = None
+DATASTORE_BACKEND_PID: int = -1
+DATASTORE_BACKEND_RETRY_AT: float = 0.0
+DATASTORE_BACKEND_IS_BUILDING: bool = False
+DATASTORE_BACKEND_LOCK: Lock = Lock()
+
+
+def get_datastore_backend(server_id: dict) -> Union[DatastoreBackend, None]:
+    global DATASTORE_BACKEND
+    global DATASTORE_BACKEND_PID
+    global DATASTORE_BACKEND_RETRY_AT
+    global DATASTORE_BACKEND_IS_BUILDING
+
+    # Build the backend on first use in each process so drivers load and connect after the fork, never in the master;
+    # only one thread builds it, outside the lock, while the others carry on without it
+    with DATASTORE_BACKEND_LOCK:
+        if DATASTORE_BACKEND_PID != getpid():
+            DATASTORE_BACKEND = None
+            DATASTORE_BACKEND_PID = getpid()
+            DATASTORE_BACKEND_RETRY_AT = 0.0
+            DATASTORE_BACKEND_IS_BUILDING = False
+        if (DATASTORE_BACKEND is not None or DATASTORE_BACKEND_IS_BUILDING or DATASTORE_TYPE not in DATASTORE_BACKENDS
+                or monotonic() < DATASTORE_BACKEND_RETRY_AT):
+            return DATASTORE_BACKEND
+        is_retry: bool = DATASTORE_BACKEND_RETRY_AT > 0
+        DATASTORE_BACKEND_IS_BUILDING = True
+
+    try:
+        backend: Union[DatastoreBackend, None] = DATASTORE_BACKENDS[DATASTORE_TYPE]()
+    except Exception as e:
+        # Wait as long as an open circuit before trying again, and only log the first failure of a run of them
+        backend = None
+        if not is_retry:
+            report_log(LogType.OPERATION, [LogKind.ONLOG], server_id,
+                       f'Could not connect to the {DATASTORE_TYPE} datastore. Retrying every '
+                       f'{NETWORK_BREAKER_RESET_SECONDS} second(s) and saving logs locally until then. Details: {e}',
+                       is_operation=True)
+
+    with DATASTORE_BACKEND_LOCK:
+        DATASTORE_BACKEND = backend
+        DATASTORE_BACKEND_RETRY_AT = 0.0 if backend is not None else monotonic() + NETWORK_BREAKER_RESET_SECONDS
+        DATASTORE_BACKEND_IS_BUILDING = False
+
+    return backend
+
+
+def send_log(cur_log: dict, server_id: dict):
+    backend: Union[DatastoreBackend, None] = get_datastore_backend(server_id)
+    if DATASTORE_TYPE not in DATASTORE_BACKENDS:  # Error out
+        ds_details: Union[str, None] = 'Could not match server datastore option to available constants.'
+    elif backend is None:  # Keep the log in the local CSV while the datastore is being connected to or is unreachable
+        save_log(DATASTORE_LOGS_DEFAULT_PATH, cur_log, server_id)
+        ds_details: Union[str, None] = None
+    else:
+        ds_details: Union[str, None] = backend.send(cur_log, server_id)
+
+    if ds_details is not None:
         report_log(LogType.OPERATION, [LogKind.ONLOG], server_id, ds_details, is_operation=True)
 
 
@@ -0,0 +1,95 @@
+from server_init import *
+from collections import OrderedDict
+from enum import StrEnum, auto
+from hashlib import blake2b
+from threading import Lock
+from time import time
+from typing import Union
+from codec_utils import encode_binary
+from shared_utils import get_shared_state
+
+
+# Specify where recently handled messages are remembered
+class DedupeScope(StrEnum):
+    NONE = auto()
+    WORKER = auto()
+    CONTAINER = auto()
+
+
+def create_dedupe_key(fib_one: int, fib_two: int, steps: int, sequence_id: str) -> int:
+    # Hash the same canonical frame the binary wire format uses so both formats give the same key
+    frame: bytes = encode_binary({'fib_one': fib_one, 'fib_two': fib_two, 'steps': steps, 'sequence': sequence_id})
+    return int.from_bytes(blake2b(frame, digest_size=8).digest(), 'big')
+
+
+# Remember the response to recently handled messages in this worker, oldest first
+class DedupeCache:
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.entries: OrderedDict[int, tuple[float, int, str]] = OrderedDict()
+        self.max_entries: int = max_entries
+        self.ttl_seconds: float = ttl_seconds
+        self.lock: Lock = Lock()
+
+    def get(self, key: int) -> Union[tuple[int, str], None]:
+        with self.lock:
+            entry: Union[tuple[float, int, str], None] = self.entries.get(key)
+            if entry is None or entry[0] < time():
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key: int, return_code: int, log_id: str) -> None:
+        with self.lock:
+            self.entries[key] = (time() + self.ttl_seconds, return_code, log_id)
+            self.entries.move_to_end(key)
+
+            # Evict expired entries and anything over capacity from the oldest end
+            while self.entries:
+                expires: float = next(iter(self.entries.values()))[0]
+                if len(self.entries) <= self.max_entries and expires >= time():
+                    break
+                self.entries.popitem(last=False)
+
+
+# Keep the same interface over the slots every worker in the container shares
+class SharedDedupeCache:
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds: float = ttl_seconds
+
+    def get(self, key: int) -> Union[tuple[int, str], None]:
+        return get_shared_state().get_dedupe(key)
+
+    def put(self, key: int, return_code: int, log_id: str) -> None:
+        get_shared_state().set_dedupe(key, time() + self.ttl_seconds, return_code, log_id)
+
+
+# Keep each worker's dedupe cache
+DEDUPE_CACHE: Union[DedupeCache, SharedDedupeCache, None] = None
+
+
+def get_dedupe_cache() -> Union[DedupeCache, SharedDedupeCache, None]:
+    global DEDUPE_CACHE
+
+    # Return nothing when deduplication is turned off
+    if DEDUPE_SCOPE == DedupeScope.NONE.value:
+        return None
+
+    if DEDUPE_CACHE is None:
+        if DEDUPE_SCOPE == DedupeScope.CONTAINER.value:
+            DEDUPE_CACHE = SharedDedupeCache(DEDUPE_TTL_SECONDS)
+        else:
+            DEDUPE_CACHE = DedupeCache(DEDUPE_MAX_ENTRIES, DEDUPE_TTL_SECONDS)
+
+    return DEDUPE_CACHE
+
+
+def get_original_response(key: int) -> Union[tuple[int, str], None]:
+    # Return the response code and log ID of a recently handled message with the same key
+    dedupe_cache: Union[DedupeCache, SharedDedupeCache, None] = get_dedupe_cache()
+    return dedupe_cache.get(key) if dedupe_cache is not None else None
+
+
+def remember_response(key: int, return_code: int, log_id: str) -> None:
+    dedupe_cache: Union[DedupeCache, SharedDedupeCache, None] = get_dedupe_cache()
+    if dedupe_cache is not None:
+        dedupe_cache.put(key, return_code, log_id)
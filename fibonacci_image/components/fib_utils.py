@@ -0,0 +1,54 @@
+from server_init import *
+from functools import lru_cache
+from hashlib import sha256
+from math import log2, sqrt
+
+# Set the constants used to place a number in the sequence and to decide when it is too large to log in full
+FIB_LOG2_PHI: float = log2((1 + sqrt(5)) / 2)
+FIB_LOG2_SQRT5: float = log2(sqrt(5))
+FIB_LOG_LIMIT: int = 10 ** FIB_LOG_MAX_DIGITS
+FIB_LOG_HEX_BITS: int = 32
+
+
+def get_fib_doubling(n: int) -> tuple[int, int]:
+    # Walk the bits of n from the top using F(2k) = F(k)(2F(k+1) - F(k)) and F(2k+1) = F(k)^2 + F(k+1)^2
+    fib_k: int = 0
+    fib_k_next: int = 1
+    for bit in bin(n)[2:]:
+        fib_even: int = fib_k * (2 * fib_k_next - fib_k)
+        fib_odd: int = fib_k * fib_k + fib_k_next * fib_k_next
+        if bit == '1':
+            fib_k, fib_k_next = fib_odd, fib_even + fib_odd
+        else:
+            fib_k, fib_k_next = fib_even, fib_odd
+
+    # Return F(n) and F(n + 1)
+    return fib_k, fib_k_next
+
+
+@lru_cache(maxsize=FIB_CACHE_SIZE)
+def get_fib_pair(n: int) -> tuple[int, int]:
+    # Return the pair (F(n - 1), F(n)) that the ring carries for index n
+    assert 0 <= n <= FIB_MAX_INDEX, f'Fibonacci index must be between 0 and {FIB_MAX_INDEX}.'
+    if n == 0:
+        return 1, 0
+
+    return get_fib_doubling(n - 1)
+
+
+def get_fib_index(number: int) -> int:
+    # Invert F(n) ~ phi^n / sqrt(5); exact for numbers in the sequence and the nearest index otherwise
+    return round((log2(number) + FIB_LOG2_SQRT5) / FIB_LOG2_PHI)
+
+
+def render_fib_number(number: int) -> str:
+    # Log small numbers in full
+    if number < FIB_LOG_LIMIT:
+        return str(number)
+
+    # Summarize large numbers with a fixed size so log volume and hashing stay constant; /fib/<index> has the full value
+    bits: int = number.bit_length()
+    hex_mask: int = (1 << FIB_LOG_HEX_BITS) - 1
+    hex_head: int = number >> (bits - FIB_LOG_HEX_BITS)
+    digest: str = sha256(number.to_bytes((bits + 7) // 8, 'big')).hexdigest()[:16]
+    return f'F({get_fib_index(number)})[{bits} bits 0x{hex_head:08x}..{number & hex_mask:08x} sha256:{digest}]'
@@ -0,0 +1,395 @@
+from server_init import *
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Union
+from flask import Flask, Response, request as flask_request, jsonify
+from graphql import (DocumentNode, ExecutionResult, GraphQLArgument, GraphQLError, GraphQLField, GraphQLFloat,
+                     GraphQLInputField, GraphQLInputObjectType, GraphQLInt, GraphQLList, GraphQLNonNull,
+                     GraphQLObjectType, GraphQLResolveInfo, GraphQLScalarType, GraphQLSchema, GraphQLString,
+                     IntValueNode, StringValueNode, ValueNode, execute_sync, parse, validate)
+from requests import RequestException, Response as RequestsResponse
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import RETRY_STATUS_CODES, get_backoff, get_breaker_stats, get_dest_url, send_request
+from send_utils import get_executor
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, create_server_identifier, start_worker,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         register_routes)
+
+# Create a server identifier
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings; a preloaded app is started by the post_fork hook in each worker
+if not PRELOAD:
+    start_worker(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
+SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
+
+# Set the route and the mutation every stage sends to the next one; the fixed text always hits the document cache
+GRAPHQL_PATH: str = '/graphql'
+ADVANCE_MUTATION: str = '''
+mutation Advance($pairs: [PairInput!]!) {
+  advance(pairs: $pairs) { code status message result sequence }
+}
+'''
+
+
+def parse_big_int_literal(value_node: ValueNode, variables: Union[dict, None] = None) -> int:
+    # Take numbers written inline in a document either quoted or bare
+    if isinstance(value_node, (StringValueNode, IntValueNode)):
+        return int(value_node.value)
+    raise GraphQLError('BigInt must be a string or an integer.', value_node)
+
+
+# Carry fibonacci numbers as decimal strings since they outgrow the 32 bit GraphQL Int
+BIG_INT_TYPE: GraphQLScalarType = GraphQLScalarType(
+    name='BigInt', serialize=str, parse_value=int, parse_literal=parse_big_int_literal
+)
+
+# Carry keyed maps such as breakers and active sequences as they are
+JSON_TYPE: GraphQLScalarType = GraphQLScalarType(name='JSON', serialize=lambda value: value)
+
+PAIR_INPUT_TYPE: GraphQLInputObjectType = GraphQLInputObjectType('PairInput', {
+    'fibOne': GraphQLInputField(GraphQLNonNull(BIG_INT_TYPE)),
+    'fibTwo': GraphQLInputField(GraphQLNonNull(BIG_INT_TYPE)),
+    'steps': GraphQLInputField(GraphQLNonNull(GraphQLInt), default_value=STEPS_DEFAULT),
+    'sequence': GraphQLInputField(GraphQLNonNull(GraphQLString), default_value=DEFAULT_SEQUENCE_ID)
+})
+
+ADVANCE_RESULT_TYPE: GraphQLObjectType = GraphQLObjectType('AdvanceResult', {
+    'code': GraphQLField(GraphQLNonNull(GraphQLInt)),
+    'status': GraphQLField(GraphQLNonNull(GraphQLString)),
+    'message': GraphQLField(GraphQLNonNull(GraphQLString)),
+    'result': GraphQLField(GraphQLNonNull(GraphQLString)),
+    'sequence': GraphQLField(GraphQLNonNull(GraphQLString))
+})
+
+PROGRESS_TYPE: GraphQLObjectType = GraphQLObjectType('Progress', {
+    'steps': GraphQLField(GraphQLNonNull(BIG_INT_TYPE)),
+    'sequencesStarted': GraphQLField(GraphQLNonNull(BIG_INT_TYPE)),
+    'sequencesCompleted': GraphQLField(GraphQLNonNull(BIG_INT_TYPE)),
+    'duplicatesDropped': GraphQLField(GraphQLNonNull(BIG_INT_TYPE)),
+    'lastLogId': GraphQLField(GraphQLNonNull(GraphQLString)),
+    'lastStepTime': GraphQLField(GraphQLNonNull(GraphQLFloat)),
+    'activeSequences': GraphQLField(GraphQLNonNull(JSON_TYPE)),
+    'completedSequences': GraphQLField(GraphQLNonNull(GraphQLInt)),
+    'evictedSequences': GraphQLField(GraphQLNonNull(GraphQLInt))
+})
+
+SENDER_STATS_TYPE: GraphQLObjectType = GraphQLObjectType('SenderStats', {
+    name: GraphQLField(GraphQLNonNull(GraphQLInt))
+    for name in ['scheduled', 'scheduleDepth', 'queued', 'inFlight', 'queueDepth', 'workers', 'rejected']
+})
+
+DOCUMENT_STATS_TYPE: GraphQLObjectType = GraphQLObjectType('DocumentStats', {
+    name: GraphQLField(GraphQLNonNull(GraphQLInt)) for name in ['hits', 'misses', 'size', 'maxSize']
+})
+
+STATS_TYPE: GraphQLObjectType = GraphQLObjectType('Stats', {
+    'sender': GraphQLField(GraphQLNonNull(SENDER_STATS_TYPE)),
+    'breakers': GraphQLField(GraphQLNonNull(JSON_TYPE)),
+    'documents': GraphQLField(GraphQLNonNull(DOCUMENT_STATS_TYPE))
+})
+
+
+def get_document_stats() -> dict:
+    cache_info = get_document.cache_info()
+    return {'hits': cache_info.hits, 'misses': cache_info.misses, 'size': cache_info.currsize,
+            'maxSize': cache_info.maxsize}
+
+
+def resolve_progress(root: Any, info: GraphQLResolveInfo) -> dict:
+    # Combine the container-wide counters with this worker's sequence table
+    snapshot: dict = get_shared_state().get_snapshot()
+    sequences: dict = SEQUENCE_TABLE.get_progress()
+    return {**snapshot, 'activeSequences': sequences['active'], 'completedSequences': sequences['completed'],
+            'evictedSequences': sequences['evicted']}
+
+
+def resolve_stats(root: Any, info: GraphQLResolveInfo) -> dict:
+    return {'sender': get_executor().get_stats(), 'breakers': get_breaker_stats(), 'documents': get_document_stats()}
+
+
+def resolve_advance(root: Any, info: GraphQLResolveInfo, pairs: list[dict]) -> list[dict]:
+    # Keep one request from holding the worker for longer than a batch is allowed to
+    if len(pairs) > GRAPHQL_BATCH_SIZE:
+        raise GraphQLError(f'Advance takes at most {GRAPHQL_BATCH_SIZE} pair(s) per call.')
+    return [advance_pair(pair) for pair in pairs]
+
+
+SCHEMA: GraphQLSchema = GraphQLSchema(
+    query=GraphQLObjectType('Query', {
+        'progress': GraphQLField(GraphQLNonNull(PROGRESS_TYPE), resolve=resolve_progress),
+        'stats': GraphQLField(GraphQLNonNull(STATS_TYPE), resolve=resolve_stats)
+    }),
+    mutation=GraphQLObjectType('Mutation', {
+        'advance': GraphQLField(
+            GraphQLNonNull(GraphQLList(GraphQLNonNull(ADVANCE_RESULT_TYPE))),
+            args={'pairs': GraphQLArgument(GraphQLNonNull(GraphQLList(GraphQLNonNull(PAIR_INPUT_TYPE))))},
+            resolve=resolve_advance
+        )
+    })
+)
+
+
+@lru_cache(maxsize=GRAPHQL_DOCUMENT_CACHE_SIZE)
+def get_document(query: str) -> tuple[Union[DocumentNode, None], tuple[GraphQLError, ...]]:
+    # Parse and validate each distinct document once; stages send the same few documents over and over
+    try:
+        document: DocumentNode = parse(query)
+    except GraphQLError as e:
+        return None, (e,)
+    return document, tuple(validate(SCHEMA, document))
+
+
+# Parse the mutation stages send each other up front so a preloaded master hands the parsed document to every worker
+if PRELOAD:
+    get_document(ADVANCE_MUTATION)
+
+
+def run_operation(operation: Any) -> dict:
+    # Run one operation of a request against the cached document
+    if not isinstance(operation, dict) or not isinstance(operation.get('query'), str):
+        return {'errors': [{'message': 'Each operation must be an object with a query string.'}]}
+    document, errors = get_document(operation['query'])
+    if errors:
+        return {'errors': [error.formatted for error in errors]}
+
+    result: ExecutionResult = execute_sync(
+        SCHEMA, document, variable_values=operation.get('variables'), operation_name=operation.get('operationName')
+    )
+    return result.formatted
+
+
+def advance_pair(pair: dict) -> dict:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Ingest numbers
+    fib_one: int = pair['fibOne']
+    fib_two: int = pair['fibTwo']
+    steps: int = get_requested_steps(pair)
+    sequence_id: str = pair['sequence']
+
+    # Shed load before doing any work if sends or the outbox are backed up
+    if get_executor().is_full() or OUTBOX.is_full():
+        get_executor().record_rejection()
+        msg: str = 'POST request rejected. Send queue is full.'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+        return {'code': 503, 'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID, 'sequence': sequence_id}
+
+    # Answer a repeat of a recently handled pair with the original result and do nothing else
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    original_response: Union[tuple[int, str], None] = get_original_response(dedupe_key)
+    if original_response is not None:
+        get_shared_state().increment('duplicatesDropped')
+        return_code, log_id = original_response
+        return {'code': return_code, 'status': 'Success', 'message': POST_SUCCESS_MESSAGES[return_code],
+                'result': log_id, 'sequence': sequence_id}
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+               f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
+
+    # Decide on a result to send back
+    if new_fib_one < UPPER_BOUND:  # Queue for the next server in line once the throttle interval passes
+        if not get_executor().submit(OUTBOX.add, new_fib_one, new_fib_two, steps, sequence_id, snf_log_id,
+                                     delay=THROTTLE_SECONDS):
+            get_executor().record_rejection()
+            msg: str = 'POST request rejected. Send queue is full.'
+            report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+            return {'code': 503, 'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID, 'sequence': sequence_id}
+        return_code: int = 202
+    else:  # Return that the upper bound has been reached
+        return_code: int = 200
+
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
+
+    # Remember the result in case the same pair is sent again
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    msg: str = POST_SUCCESS_MESSAGES[return_code]
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return {'code': return_code, 'status': 'Success', 'message': msg, 'result': SNF_LOG_ID, 'sequence': sequence_id}
+
+
+# Gather pairs that are ready for the next stage and send them in as few advance calls as possible
+class Outbox:
+    def __init__(self, batch_size: int, max_size: int) -> None:
+        self.pairs: list[tuple[dict, str, int]] = []
+        self.batch_size: int = batch_size
+        self.max_size: int = max_size
+        self.is_flushing: bool = False
+        self.lock: Lock = Lock()
+
+    def is_full(self) -> bool:
+        with self.lock:
+            return len(self.pairs) >= self.max_size
+
+    def add(self, new_fib_one: int, new_fib_two: int, steps: int, sequence_id: str, snf_log_id: str) -> None:
+        self.put({'fibOne': str(new_fib_one), 'fibTwo': str(new_fib_two), 'steps': steps, 'sequence': sequence_id},
+                 snf_log_id)
+
+    def put(self, pair_input: dict, snf_log_id: str, attempt: int = 0) -> None:
+        # Leave the pair for the flush in progress if there is one, so pairs ready at the same time share a call
+        pair: tuple[dict, str, int] = (pair_input, snf_log_id, attempt)
+        with self.lock:
+            is_overflow: bool = self.is_flushing and len(self.pairs) >= self.max_size
+            if not is_overflow:
+                self.pairs.append(pair)
+                if self.is_flushing:
+                    return
+                self.is_flushing = True
+
+        # Send a pair that does not fit on this sender thread, which holds back new work until the outbox drains
+        if is_overflow:
+            trigger_send([pair])
+        else:
+            self.flush()
+
+    def flush(self) -> None:
+        is_drained: bool = False
+        try:
+            while True:
+                with self.lock:
+                    batch: list[tuple[dict, str, int]] = self.pairs[:self.batch_size]
+                    del self.pairs[:self.batch_size]
+                    if not batch:
+                        self.is_flushing = False
+                        is_drained = True
+                        return
+                trigger_send(batch)
+        finally:
+            # Hand the flush to the next pair even if a send failed, so the outbox never stops draining
+            if not is_drained:
+                with self.lock:
+                    self.is_flushing = False
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.pairs), 'maxSize': self.max_size, 'flushing': self.is_flushing}
+
+
+# Keep each worker's outbox
+OUTBOX: Outbox = Outbox(GRAPHQL_BATCH_SIZE, GRAPHQL_OUTBOX_SIZE)
+
+
+# Define a sending call for a batch of pairs
+def trigger_send(batch: list[tuple[dict, str, int]]) -> None:
+    global SERVER_IDENTIFIER
+
+    snf_log_ids: list[str] = [snf_log_id for _, snf_log_id, _ in batch]
+    try:
+        response: RequestsResponse = send_request(
+            method='POST',
+            url=f'{get_dest_url()}{GRAPHQL_PATH}',
+            json={'query': ADVANCE_MUTATION, 'variables': {'pairs': [pair for pair, _, _ in batch]}}
+        )
+        results: Union[list[dict], None] = (response.json().get('data') or {}).get('advance')
+    except (RequestException, ValueError) as e:
+        for snf_log_id in snf_log_ids:
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Experienced Request Exception for message ID {snf_log_id}. Details: {e}')
+        return
+
+    # Log the result of every pair in the batch, or the response as a whole if it does not answer each pair
+    if results is None or len(results) != len(batch):
+        for snf_log_id in snf_log_ids:
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Return info for message ID {snf_log_id}: {response.text}')
+        return
+    for (pair, snf_log_id, attempt), result in zip(batch, results):
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Return code for message ID {snf_log_id}: {result['code']}')
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Return info for message ID {snf_log_id}: {result}')
+
+        # The call itself succeeds when the next stage sheds a pair, so retry the pair here
+        if result['code'] in RETRY_STATUS_CODES:
+            resend_pair(pair, snf_log_id, attempt, f'return code {result['code']}')
+
+
+def resend_pair(pair: dict, snf_log_id: str, attempt: int, reason: str) -> None:
+    global SERVER_IDENTIFIER
+
+    # Put the pair back in the outbox after a jittered backoff, giving it as many attempts as an HTTP request gets
+    if attempt + 1 < NETWORK_RETRY_ATTEMPTS and get_executor().submit(OUTBOX.put, pair, snf_log_id, attempt + 1,
+                                                                       delay=get_backoff(attempt)):
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Resending message ID {snf_log_id} after {reason}.')
+        return
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+               f'Dropped message ID {snf_log_id} after {reason} on attempt {attempt + 1}.')
+
+
+# Create app object
+app = Flask(__name__)
+
+
+# Create GraphQL logic; a list body runs a batch of operations in one request
+@app.route(GRAPHQL_PATH, methods=['POST'])
+def process_graphql() -> tuple[Response, int]:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    body: Union[dict, list, None] = flask_request.get_json(force=True, silent=True)
+    if not isinstance(body, (dict, list)):
+        msg: str = 'POST request failed. Unable to retrieve GraphQL operations.'
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+        return jsonify({'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID}), 400
+
+    if isinstance(body, list):
+        return jsonify([run_operation(operation) for operation in body]), 200
+    return jsonify(run_operation(body)), 200
+
+
+def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+    return get_executor().submit(OUTBOX.add, fib_one, fib_two, STEPS_DEFAULT, sequence_id, start_log_id)
+
+
+def start_sequences(start_index: Union[int, None], count: int, method: str) -> tuple[int, str, str, list[str]]:
+    global SNF_LOG_ID
+
+    return_code, status, msg, sequence_ids, start_log_id = launch_sequences(
+        SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, method, submit_start
+    )
+
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    return return_code, status, msg, sequence_ids
+
+
+def get_log_id() -> str:
+    return SNF_LOG_ID
+
+
+# Add the control routes every stage shares
+register_routes(app, SERVER_IDENTIFIER, SEQUENCE_TABLE, get_log_id, start_sequences,
+                get_ready_checks=lambda: {'outbox': not OUTBOX.is_full()},
+                get_health_extras=lambda: {'documents': get_document_stats(), 'outbox': OUTBOX.get_stats()})
@@ -0,0 +1,279 @@
+from server_init import *
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from collections.abc import Iterator
+from queue import SimpleQueue
+from threading import Lock, Thread
+from typing import Union
+from flask import Flask
+from grpc import (ChannelCredentials, RpcError, Server, ServicerContext, secure_channel, server as grpc_server,
+                  ssl_channel_credentials, ssl_server_credentials)
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import FAILURE_STATUS_CODES, RETRY_STATUS_CODES, CircuitBreaker, get_backoff, get_breaker
+from send_utils import get_executor
+from codec_utils import encode_number, decode_number
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, create_server_identifier, report_startup,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         register_routes)
+from fibonacci_pb2 import Ack, HealthReply, HealthRequest, Pair, StartReply, StartRequest
+from fibonacci_pb2_grpc import StageServicer, StageStub, add_StageServicer_to_server
+
+# Create a server identifier
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings
+report_startup(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
+SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
+
+# Set the address of the next stage's stream
+STREAM_DESTINATION: str = f'{NETWORK_DEST_ADDRESS}:{NETWORK_DEST_STREAM_PORT}'
+
+
+def read_tls_materials() -> tuple[bytes, bytes, bytes]:
+    # Read the key, certificate, and CA generated at startup for mutual TLS on the streams
+    with open(SECRET_KEY_TARGET, 'rb') as key_file, open(SECRET_CERT_TARGET, 'rb') as cert_file, \
+            open(TLS_CA_CERT_PATH, 'rb') as ca_file:
+        return key_file.read(), cert_file.read(), ca_file.read()
+
+
+# Keep one long-lived bidirectional stream to the next stage and feed it from a queue
+class RelayStream:
+    def __init__(self, destination: str) -> None:
+        key, cert, ca = read_tls_materials()
+        credentials: ChannelCredentials = ssl_channel_credentials(root_certificates=ca, private_key=key,
+                                                                  certificate_chain=cert)
+        self.destination: str = destination
+        self.stub: StageStub = StageStub(secure_channel(destination, credentials))
+        self.queue: Union[SimpleQueue, None] = None
+        self.pending: deque[tuple[Pair, str, int]] = deque()
+        self.lock: Lock = Lock()
+
+    def send(self, pair: Pair, snf_log_id: str, attempt: int = 0) -> None:
+        global SERVER_IDENTIFIER
+
+        # Fail fast while the next stage is known to be down
+        if not get_breaker(self.destination).allow():
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Experienced RPC Exception for message ID {snf_log_id}. Details: Circuit to '
+                       f'{self.destination} is open.')
+            return
+
+        # Open the stream on first use or after it broke; every later pair rides the same HTTP/2 stream
+        with self.lock:
+            if self.queue is None:
+                self.queue = SimpleQueue()
+                self.pending = deque()
+                acks: Iterator[Ack] = self.stub.Relay(iter(self.queue.get, None))
+                Thread(target=self.read_acks, args=(self.queue, self.pending, acks), name='relay_acks',
+                       daemon=True).start()
+            self.pending.append((pair, snf_log_id, attempt))
+            self.queue.put(pair)
+
+    def resend(self, pair: Pair, snf_log_id: str, attempt: int, reason: str) -> None:
+        global SERVER_IDENTIFIER
+
+        # Try the pair again after a jittered backoff, giving it as many attempts as an HTTP request gets
+        if attempt + 1 < NETWORK_RETRY_ATTEMPTS and get_executor().submit(self.send, pair, snf_log_id, attempt + 1,
+                                                                           delay=get_backoff(attempt)):
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Resending message ID {snf_log_id} to {self.destination} after {reason}.')
+            return
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Dropped message ID {snf_log_id} to {self.destination} after {reason} on attempt {attempt + 1}.')
+
+    def read_acks(self, queue: SimpleQueue, pending: deque[tuple[Pair, str, int]], acks: Iterator[Ack]) -> None:
+        global SERVER_IDENTIFIER
+
+        # Match acks to pairs by order; the next stage answers the pairs of a stream in the order they arrived
+        breaker: CircuitBreaker = get_breaker(self.destination)
+        try:
+            for ack in acks:
+                pair, snf_log_id, attempt = pending.popleft()
+                if 200 <= ack.code < 300:
+                    breaker.record_success()
+                elif ack.code in FAILURE_STATUS_CODES:
+                    breaker.record_failure()
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Return code for fibonacci sequence {ack.sequence}: {ack.code}')
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Return info for fibonacci sequence {ack.sequence}: {ack.message} {ack.result}')
+
+                # A busy next stage gets the pair again once it has had time to drain
+                if ack.code in RETRY_STATUS_CODES:
+                    self.resend(pair, snf_log_id, attempt, f'return code {ack.code}')
+        except (RpcError, IndexError) as e:
+            breaker.record_failure()
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Experienced RPC Exception on the stream to {self.destination}. Details: {e}')
+        finally:
+            # Let the next send open a fresh stream; no send can add to this stream's pairs once it is dropped
+            with self.lock:
+                if self.queue is queue:
+                    self.queue = None
+                unacknowledged: list[tuple[Pair, str, int]] = list(pending)
+                pending.clear()
+            queue.put(None)
+
+            # Resend the pairs the stream took down with it, whether or not they had gone out
+            if unacknowledged:
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Stream to {self.destination} closed with {len(unacknowledged)} unacknowledged pair(s).')
+            for pair, snf_log_id, attempt in unacknowledged:
+                self.resend(pair, snf_log_id, attempt, 'the stream closed')
+
+
+# Create the outbound stream; the channel connects lazily on the first send
+RELAY_STREAM: RelayStream = RelayStream(STREAM_DESTINATION)
+
+
+def create_pair(fib_one: int, fib_two: int, steps: int, sequence_id: str) -> Pair:
+    return Pair(fib_one=encode_number(fib_one), fib_two=encode_number(fib_two), steps=steps, sequence=sequence_id)
+
+
+def process_pair(pair: Pair) -> Ack:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Shed load before doing any work if sends are backed up
+    if get_executor().is_full():
+        get_executor().record_rejection()
+        msg: str = 'Relay message rejected. Send queue is full.'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+        return Ack(code=503, status='Fail', message=msg, result=SNF_LOG_ID, sequence=pair.sequence)
+
+    # Ingest numbers
+    fib_one: int = decode_number(pair.fib_one)
+    fib_two: int = decode_number(pair.fib_two)
+    steps: int = get_requested_steps({'steps': pair.steps} if pair.steps > 0 else {})
+    sequence_id: str = pair.sequence or DEFAULT_SEQUENCE_ID
+
+    # Answer a repeat of a recently handled message with the original response and do nothing else
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    original_response: Union[tuple[int, str], None] = get_original_response(dedupe_key)
+    if original_response is not None:
+        get_shared_state().increment('duplicatesDropped')
+        return_code, log_id = original_response
+        return Ack(code=return_code, status='Success', message=POST_SUCCESS_MESSAGES[return_code], result=log_id,
+                   sequence=sequence_id)
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+               f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
+
+    # Decide on a response to send back
+    if new_fib_one < UPPER_BOUND:  # Forward on the stream to the next server once the throttle interval passes
+        if not get_executor().submit(RELAY_STREAM.send, create_pair(new_fib_one, new_fib_two, steps, sequence_id),
+                                     snf_log_id, delay=THROTTLE_SECONDS):
+            msg: str = 'Relay message rejected. Send queue is full.'
+            report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+            return Ack(code=503, status='Fail', message=msg, result=SNF_LOG_ID, sequence=sequence_id)
+        return_code: int = 202
+    else:  # Return that the upper bound has been reached
+        return_code: int = 200
+
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
+
+    # Remember the response in case the same message is sent again
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    msg: str = POST_SUCCESS_MESSAGES[return_code]
+
+    # Send the response back
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return Ack(code=return_code, status='Success', message=msg, result=SNF_LOG_ID, sequence=sequence_id)
+
+
+def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+    return get_executor().submit(RELAY_STREAM.send, create_pair(fib_one, fib_two, STEPS_DEFAULT, sequence_id),
+                                 start_log_id)
+
+
+def start_sequences(start_index: Union[int, None], count: int, method: str) -> tuple[int, str, str, list[str]]:
+    global SNF_LOG_ID
+
+    return_code, status, msg, sequence_ids, start_log_id = launch_sequences(
+        SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, method, submit_start
+    )
+
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    return return_code, status, msg, sequence_ids
+
+
+def get_log_id() -> str:
+    return SNF_LOG_ID
+
+
+# Serve the stream and the unary control calls
+class StageService(StageServicer):
+    def Relay(self, request_iterator: Iterator[Pair], context: ServicerContext) -> Iterator[Ack]:
+        for pair in request_iterator:
+            yield process_pair(pair)
+
+    def Start(self, request: StartRequest, context: ServicerContext) -> StartReply:
+        start_index: Union[int, None] = request.from_index if request.HasField('from_index') else None
+        return_code, status, msg, sequence_ids = start_sequences(start_index, request.count or 1, 'Start')
+        return StartReply(code=return_code, status=status, message=msg, result=SNF_LOG_ID, sequences=sequence_ids)
+
+    def Health(self, request: HealthRequest, context: ServicerContext) -> HealthReply:
+        global SERVER_IDENTIFIER
+
+        # Read the container progress without resetting the healthcheck marker used by the HTTP healthcheck
+        snapshot: dict = get_shared_state().get_snapshot()
+        msg: str = f'Health call succeeded. Server has processed {snapshot['steps']} step(s).'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.HEALTHCHECK], SERVER_IDENTIFIER, msg)
+        return HealthReply(status='Success', message=msg, result=snapshot['lastLogId'],
+                           progress={key: value for key, value in snapshot.items() if isinstance(value, int)})
+
+
+def create_stream_server() -> Server:
+    # Every worker binds the same port; gRPC sets SO_REUSEPORT so the kernel spreads streams across workers
+    key, cert, ca = read_tls_materials()
+    stream_server: Server = grpc_server(ThreadPoolExecutor(max_workers=NETWORK_SELF_STREAM_WORKERS,
+                                                           thread_name_prefix='stream'))
+    add_StageServicer_to_server(StageService(), stream_server)
+    stream_server.add_secure_port(
+        f'{NETWORK_SELF_ADDRESS_LISTENING}:{NETWORK_SELF_STREAM_PORT}',
+        ssl_server_credentials([(key, cert)], root_certificates=ca, require_client_auth=True)
+    )
+    return stream_server
+
+
+# Start the stream server in this worker
+STREAM_SERVER: Server = create_stream_server()
+STREAM_SERVER.start()
+
+# Create app object for the HTTP control routes served by Gunicorn
+app = Flask(__name__)
+
+
+# Add the control routes every stage shares
+register_routes(app, SERVER_IDENTIFIER, SEQUENCE_TABLE, get_log_id, start_sequences)
@@ -1,24 +1,93 @@
 from server_init import *
+from os import getpid, kill
+from signal import SIG_DFL, SIGHUP, getsignal
+from importlib import import_module
+from shared_utils import create_shared_state
+from network_utils import enable_session_resumption
+
+# Reload the workers gracefully once renewed TLS materials are in place so they serve the new certificate
+def reload_workers() -> None:
+    # Until the arbiter handles signals no worker has been forked, so they load the new materials anyway
+    if getsignal(SIGHUP) not in (SIG_DFL, None):
+        kill(getpid(), SIGHUP)
+
 
 # Do some pre-flight stuff
-create_tls_materials()
+create_tls_materials(reload_workers)
+create_probe_file()
+
+# Create the container-wide progress state so every forked worker inherits it
+create_shared_state()
 
 # Configure settings
-# API app
-wsgi_app = f'{API}:app'
+# API app; APIs named after the library they use get a module suffix so they do not shadow it
+API_MODULES: dict[str, str] = {'graphql': 'graphql_stage', 'grpc': 'grpc_stage'}
+wsgi_app = f'{API_MODULES.get(API, API)}:app'
+
+# APIs whose stages can also be reached through a Unix domain socket on a shared volume
+UNIX_SOCKET_APIS: list[str] = ['graphql', 'rest', 'soap']
+USE_UNIX_SOCKET: bool = bool(NETWORK_SELF_SOCKET_PATH) and API in UNIX_SOCKET_APIS
 
-# Workers
+# Workers; threaded workers are used so peers can hold keep-alive connections open
 workers = WORKERS
+if API == 'restasync':  # The asyncio API serves every connection from one event loop per worker
+    worker_class = 'aiohttp.GunicornWebWorker'
+elif USE_UNIX_SOCKET:  # The Unix domain socket skips TLS unless it is asked for, so it needs its own connections
+    worker_class = 'worker_utils.UnixSocketWorker'
+else:
+    worker_class = 'gthread'
+keepalive = NETWORK_SELF_KEEPALIVE
+
+# Preloading; APIs that start threads or open connections at import stay loaded by each worker
+PRELOAD_APIS: list[str] = ['graphql', 'rest', 'restasync', 'soap']
+preload_app = PRELOAD and API in PRELOAD_APIS
 
 # Output handling
 capture_output = True
 loglevel = 'debug'
 
-# Set listening socket
-bind = f'{NETWORK_SELF_ADDRESS_LISTENING}:{NETWORK_SELF_PORT}'
+# Set listening sockets; the TCP socket stays open for the healthcheck and for stages in other pods
+bind = [f'{NETWORK_SELF_ADDRESS_LISTENING}:{NETWORK_SELF_PORT}']
+if USE_UNIX_SOCKET:
+    bind.append(f'unix:{NETWORK_SELF_SOCKET_PATH}')
 
 # SSL Enabling; Default standard is TLSv2
 keyfile = SECRET_KEY_TARGET
 certfile = SECRET_CERT_TARGET
 ca_certs = TLS_CA_CERT_PATH
 do_handshake_on_connect = True
+
+# Set up the server TLS context; it is built once in the master so every forked worker shares its session ticket keys
+SERVER_SSL_CONTEXT = None
+
+
+def ssl_context(conf, default_ssl_context_factory):
+    global SERVER_SSL_CONTEXT
+    if SERVER_SSL_CONTEXT is None:
+        SERVER_SSL_CONTEXT = enable_session_resumption(default_ssl_context_factory())
+    return SERVER_SSL_CONTEXT
+
+
+# Build the server TLS context in the master before each worker is forked
+def pre_fork(server, worker) -> None:
+    from gunicorn.sock import ssl_context as create_server_ssl_context
+    create_server_ssl_context(server.cfg)
+
+
+# Start each preloaded worker and open its fork-unsafe resources; the datastore connects on the startup logs
+def post_fork(server, worker) -> None:
+    if preload_app:
+        from stage_utils import start_worker
+        start_worker(import_module(API_MODULES.get(API, API)).SERVER_IDENTIFIER)
+        if API != 'restasync':  # The asyncio API opens its client session on app startup
+            from network_utils import get_session
+            from send_utils import get_executor
+            get_session()
+            get_executor()
+
+
+# Stop the gRPC stream server on the way out so its threads do not keep the worker alive
+def worker_exit(server, worker) -> None:
+    if API == 'grpc':
+        from grpc_stage import STREAM_SERVER
+        STREAM_SERVER.stop(grace=None).wait()
@@ -0,0 +1,224 @@
+from server_init import *
+from os import getpid
+from queue import SimpleQueue
+from socket import gethostname
+from threading import Thread
+from time import sleep
+from typing import Union
+from flask import Flask
+from paho.mqtt.client import Client, CallbackAPIVersion, ConnectFlags, MQTTMessage, MQTTMessageInfo
+from paho.mqtt.reasoncodes import ReasonCode
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import create_ssl_context
+from send_utils import get_executor
+from codec_utils import encode_message, decode_message, guess_content_type
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, create_server_identifier, report_startup,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         register_routes)
+
+# Create a server identifier
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings
+report_startup(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
+SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
+
+# Set the topics; each stage reads its own and writes the one of the next stage in the ring
+MQTT_TOPIC_PREFIX: str = 'stage'
+MQTT_SELF_TOPIC: str = f'{MQTT_TOPIC_PREFIX}/{STAGE_INDEX}'
+MQTT_DEST_TOPIC: str = f'{MQTT_TOPIC_PREFIX}/{STAGE_INDEX % STAGE_COUNT + 1}'
+
+# Ping the broker this often when the link is idle
+MQTT_KEEPALIVE_SECONDS: int = 60
+
+# Let one worker per container subscribe so every message is handled once; the rest only publish
+IS_SUBSCRIBER: bool = get_shared_state().claim_subscriber()
+
+# Pass received messages from the network thread to the thread that handles them
+MESSAGE_QUEUE: SimpleQueue = SimpleQueue()
+
+
+# Define a publishing call
+def trigger_send(new_fib_one: int, new_fib_two: int, steps: int, sequence_id: str, snf_log_id: str) -> None:
+    global SERVER_IDENTIFIER
+
+    # Hand the message to the client; it is queued while the broker is away and sent once it is back
+    try:
+        payload, _ = encode_message(
+            {'fib_one': new_fib_one, 'fib_two': new_fib_two, 'steps': steps, 'sequence': sequence_id}, WIRE_FORMAT
+        )
+        message_info: MQTTMessageInfo = MQTT_CLIENT.publish(MQTT_DEST_TOPIC, payload, qos=MQTT_QOS)
+    except ValueError as e:
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Experienced Publish Exception for message ID {snf_log_id}. Details: {e}')
+        return
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+               f'Return code for message ID {snf_log_id}: {message_info.rc}')
+
+
+def process_message(client: Client, message: MQTTMessage) -> None:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Hold the message while sends are backed up; it is only acknowledged once handled, so the broker keeps it
+    if get_executor().is_full():
+        get_executor().record_rejection()
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                   f'Message on {message.topic} held. Send queue is full.')
+        while get_executor().is_full():
+            sleep(SENDER_RETRY_AFTER_SECONDS)
+
+    # Get and ingest numbers in whichever wire format the sender used; a bad message is acknowledged so it is gone
+    try:
+        fib_numbers: Union[dict, None] = decode_message(message.payload, guess_content_type(message.payload))
+        fib_one: int = int(fib_numbers['fib_one'])
+        fib_two: int = int(fib_numbers['fib_two'])
+        steps: int = get_requested_steps(fib_numbers)
+        sequence_id: str = str(fib_numbers.get('sequence', DEFAULT_SEQUENCE_ID))
+    except (KeyError, ValueError, TypeError):
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                   f'Message on {message.topic} failed. Unable to retrieve numbers.')
+        client.ack(message.mid, message.qos)
+        return
+
+    # Drop a redelivery of a recently handled message; QoS 1 can deliver the same message more than once
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    if get_original_response(dedupe_key) is not None:
+        get_shared_state().increment('duplicatesDropped')
+        client.ack(message.mid, message.qos)
+        return
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+               f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
+
+    # Decide on what to do next
+    if new_fib_one < UPPER_BOUND:  # Publish to the next stage once the throttle interval passes
+        # Wait for room instead of dropping the message if another request filled the send queue in the meantime
+        while not get_executor().submit(trigger_send, new_fib_one, new_fib_two, steps, sequence_id, snf_log_id,
+                                        delay=THROTTLE_SECONDS):
+            get_executor().record_rejection()
+            sleep(SENDER_RETRY_AFTER_SECONDS)
+        return_code: int = 202
+    else:  # Record that the upper bound has been reached
+        return_code: int = 200
+
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
+
+    # Remember the message in case the broker delivers it again, then let the broker forget it
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    client.ack(message.mid, message.qos)
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, POST_SUCCESS_MESSAGES[return_code])
+
+
+def queue_message(client: Client, userdata: None, message: MQTTMessage) -> None:
+    # Only hand the message over; the network thread has to stay free to send keepalive pings
+    MESSAGE_QUEUE.put(message)
+
+
+def handle_messages(client: Client) -> None:
+    global SERVER_IDENTIFIER
+
+    # Handle messages in the order they arrived; the broker stops delivering once its unacknowledged window is full
+    while True:
+        message: MQTTMessage = MESSAGE_QUEUE.get()
+        try:
+            process_message(client, message)
+        except Exception as e:
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                       f'Message on {message.topic} failed. Details: {e}')
+            client.ack(message.mid, message.qos)
+
+
+def subscribe_on_connect(client: Client, userdata: None, flags: ConnectFlags, reason_code: ReasonCode,
+                         properties: None) -> None:
+    global SERVER_IDENTIFIER
+
+    # Subscribe again after every reconnect; the persistent session keeps messages that arrived in between
+    report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
+               f'Connected to the broker at {NETWORK_BROKER_ADDRESS}:{NETWORK_BROKER_PORT}. Result: {reason_code}')
+    if IS_SUBSCRIBER and not reason_code.is_failure:
+        client.subscribe(MQTT_SELF_TOPIC, qos=MQTT_QOS)
+
+
+def create_client() -> Client:
+    # The subscriber keeps an ID per host and a persistent session so a restarted container picks up where it left
+    # off; it acknowledges each message itself once the forward is queued instead of as soon as the callback returns
+    if IS_SUBSCRIBER:
+        client: Client = Client(CallbackAPIVersion.VERSION2, client_id=f'fibonacci-stage-{STAGE_INDEX}-{gethostname()}',
+                                clean_session=False, manual_ack=True)
+        Thread(target=handle_messages, args=(client,), name='mqtt_messages', daemon=True).start()
+    else:
+        client: Client = Client(CallbackAPIVersion.VERSION2, client_id=f'fibonacci-stage-{STAGE_INDEX}-{getpid()}')
+    client.tls_set_context(create_ssl_context())
+    client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+    client.on_connect = subscribe_on_connect
+    client.on_message = queue_message
+
+    # Connect in the background so the worker starts even while the broker is down
+    client.connect_async(NETWORK_BROKER_ADDRESS, NETWORK_BROKER_PORT, keepalive=MQTT_KEEPALIVE_SECONDS)
+    client.loop_start()
+    return client
+
+
+# Connect this worker to the broker
+MQTT_CLIENT: Client = create_client()
+
+# Create app object for the HTTP control routes served by Gunicorn
+app = Flask(__name__)
+
+
+def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+    return get_executor().submit(trigger_send, fib_one, fib_two, STEPS_DEFAULT, sequence_id, start_log_id)
+
+
+def start_sequences(start_index: Union[int, None], count: int, method: str) -> tuple[int, str, str, list[str]]:
+    global SNF_LOG_ID
+
+    return_code, status, msg, sequence_ids, start_log_id = launch_sequences(
+        SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, method, submit_start
+    )
+
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    return return_code, status, msg, sequence_ids
+
+
+def get_log_id() -> str:
+    return SNF_LOG_ID
+
+
+# Add the control routes every stage shares
+register_routes(app, SERVER_IDENTIFIER, SEQUENCE_TABLE, get_log_id, start_sequences,
+                get_ready_checks=lambda: {'broker': MQTT_CLIENT.is_connected()},
+                get_health_extras=lambda: {'broker': {'connected': MQTT_CLIENT.is_connected(),
+                                                      'subscriber': IS_SUBSCRIBER, 'topic': MQTT_SELF_TOPIC}})
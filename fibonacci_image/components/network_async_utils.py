@@ -0,0 +1,46 @@
+from server_init import *
+from asyncio import TimeoutError as AsyncTimeoutError, sleep as async_sleep
+from urllib.parse import urlsplit
+from aiohttp import ClientConnectorError, ClientError, ClientSession, ClientTimeout, ConnectionTimeoutError
+from network_utils import (FAILURE_STATUS_CODES, RETRY_STATUS_CODES, CircuitBreaker, CircuitOpenError, get_backoff,
+                           get_breaker)
+
+
+def create_client_timeout() -> ClientTimeout:
+    return ClientTimeout(sock_connect=NETWORK_TIMEOUT_CONNECT_SECONDS, sock_read=NETWORK_TIMEOUT_READ_SECONDS)
+
+
+async def send_request_async(client: ClientSession, method: str, url: str, **kwargs) -> tuple[int, str]:
+    # Mirror send_request on the event loop and return the status code and body text
+    breaker: CircuitBreaker = get_breaker(urlsplit(url).netloc)
+
+    # Only retry a POST that never reached the peer; after a read timeout the peer may already have forwarded it
+    retryable_errors: tuple[type[BaseException], ...] = (
+        (ClientConnectorError, ConnectionTimeoutError) if method == 'POST' else (ClientError, AsyncTimeoutError)
+    )
+    for attempt in range(NETWORK_RETRY_ATTEMPTS):
+        if attempt > 0:
+            await async_sleep(get_backoff(attempt - 1))
+        if not breaker.allow():
+            raise CircuitOpenError(f'Circuit to {urlsplit(url).netloc} is open.')
+
+        try:
+            async with client.request(method=method, url=url, **kwargs) as response:
+                status: int = response.status
+                text: str = await response.text()
+        except retryable_errors:
+            breaker.record_failure()
+            if attempt + 1 == NETWORK_RETRY_ATTEMPTS:
+                raise
+            continue
+        except BaseException:
+            # Count any other error as a failure without retrying so a half-open trial is always released
+            breaker.record_failure()
+            raise
+
+        if status in FAILURE_STATUS_CODES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if status not in RETRY_STATUS_CODES or attempt + 1 == NETWORK_RETRY_ATTEMPTS:
+            return status, text
@@ -0,0 +1,302 @@
+from server_init import *
+from os import getpid
+from enum import StrEnum, auto
+from random import uniform
+from socket import AF_UNIX, SOCK_STREAM, socket
+from ssl import OP_NO_TICKET, SSLContext, SSLSession, SSLSocket, Purpose, create_default_context
+from threading import Lock
+from time import monotonic, sleep
+from typing import Union
+from urllib.parse import urlsplit
+from requests import ConnectionError, RequestException, Response, Session, Timeout
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import NewConnectionError
+from shared_utils import get_shared_state
+
+# Set the timeouts every outbound request uses
+REQUEST_TIMEOUT: tuple[float, float] = (NETWORK_TIMEOUT_CONNECT_SECONDS, NETWORK_TIMEOUT_READ_SECONDS)
+
+# Set the response codes that are worth another attempt and the ones that also count against the peer
+RETRY_STATUS_CODES: tuple[int, ...] = (502, 503, 504)
+FAILURE_STATUS_CODES: tuple[int, ...] = (502, 504)
+
+# Set up the per-process client state
+HTTP_SESSION: Union[Session, None] = None
+HTTP_SESSION_PID: int = -1
+HTTP_SESSION_LOCK: Lock = Lock()
+
+# Set up the per-process TLS sessions, keyed by the client context and the destination they were made with
+TLS_SESSIONS: dict[tuple[int, str], SSLSession] = {}
+
+
+def record_tls_handshake(is_server: bool, is_resumed: bool) -> None:
+    side: str = 'Server' if is_server else 'Client'
+    get_shared_state().increment(f'tls{side}Handshakes')
+    if is_resumed:
+        get_shared_state().increment(f'tls{side}Resumed')
+
+
+def get_tls_stats() -> dict:
+    # Report how many handshakes each side of the container did and how many of them skipped the full exchange
+    snapshot: dict = get_shared_state().get_snapshot()
+    tls_stats: dict = {'resumption': TLS_RESUMPTION}
+    for side in ['Client', 'Server']:
+        handshakes: int = snapshot[f'tls{side}Handshakes']
+        resumed: int = snapshot[f'tls{side}Resumed']
+        hit_rate: float = round(resumed / handshakes, 3) if handshakes else 0.0
+        tls_stats[side.lower()] = {'handshakes': handshakes, 'resumed': resumed, 'hitRate': hit_rate}
+    return tls_stats
+
+
+# Create a TLS socket that offers the last session made with its destination and counts every handshake
+class TLSSessionSocket(SSLSocket):
+    session_key: Union[tuple[int, str], None] = None
+    is_session_saved: bool = False
+
+    def do_handshake(self, block: bool = False) -> None:
+        # Offer a saved session once; non-blocking sockets come back here until the handshake finishes
+        if not self.server_side and self.session_key is None:
+            self.session_key = (id(self.context), f'{self.server_hostname}@{self.getpeername()}')
+            if TLS_RESUMPTION and self.session_key in TLS_SESSIONS:
+                try:
+                    self.session = TLS_SESSIONS[self.session_key]
+                except ValueError:
+                    TLS_SESSIONS.pop(self.session_key, None)
+
+        super().do_handshake(block)
+        record_tls_handshake(self.server_side, self.session_reused)
+        self.save_session()
+
+    def read(self, length: int = 1024, buffer: Union[bytearray, memoryview, None] = None) -> Union[bytes, int]:
+        # TLS 1.3 servers send their session tickets after the handshake, so save the session after the first read too
+        data: Union[bytes, int] = super().read(length, buffer)
+        self.save_session()
+        return data
+
+    def save_session(self) -> None:
+        if self.server_side or self.is_session_saved or not TLS_RESUMPTION:
+            return
+        session: Union[SSLSession, None] = self.session
+        if session is not None and session.has_ticket:
+            TLS_SESSIONS[self.session_key] = session
+            self.is_session_saved = True
+
+
+def enable_session_resumption(ssl_context: SSLContext) -> SSLContext:
+    # Servers issue session tickets by default, so turning resumption off also stops them from being issued
+    ssl_context.sslsocket_class = TLSSessionSocket
+    if not TLS_RESUMPTION:
+        ssl_context.options |= OP_NO_TICKET
+    return ssl_context
+
+
+# Create an adapter that hands one shared SSL context to every pooled connection
+class TLSAdapter(HTTPAdapter):
+    def __init__(self, ssl_context: SSLContext, **kwargs) -> None:
+        self.ssl_context: SSLContext = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections: int, maxsize: int, block: bool = False, **pool_kwargs) -> None:
+        pool_kwargs['ssl_context'] = self.ssl_context
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+
+def connect_dest_socket(connection: HTTPConnection) -> socket:
+    # Reach the next stage through its Unix domain socket on the shared volume instead of over loopback TCP
+    unix_socket: socket = socket(AF_UNIX, SOCK_STREAM)
+    unix_socket.settimeout(NETWORK_TIMEOUT_CONNECT_SECONDS)
+    try:
+        unix_socket.connect(NETWORK_DEST_SOCKET_PATH)
+    except OSError as e:
+        unix_socket.close()
+        raise NewConnectionError(connection, f'Failed to connect to {NETWORK_DEST_SOCKET_PATH}. Details: {e}')
+    return unix_socket
+
+
+# Create connections that keep the HTTP and TLS handling but open a Unix domain socket underneath
+class UnixHTTPConnection(HTTPConnection):
+    def _new_conn(self) -> socket:
+        return connect_dest_socket(self)
+
+
+class UnixHTTPSConnection(HTTPSConnection):
+    def _new_conn(self) -> socket:
+        return connect_dest_socket(self)
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+
+class UnixHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = UnixHTTPSConnection
+
+
+# Create an adapter whose pools connect to the next stage's Unix domain socket
+class UnixAdapter(TLSAdapter):
+    def init_poolmanager(self, connections: int, maxsize: int, block: bool = False, **pool_kwargs) -> None:
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': UnixHTTPConnectionPool, 'https': UnixHTTPSConnectionPool}
+
+
+def get_dest_url() -> str:
+    # Drop TLS on the next stage's Unix domain socket unless it is asked for
+    scheme: str = 'http' if NETWORK_DEST_SOCKET_PATH and not NETWORK_SOCKET_TLS else 'https'
+    return f'{scheme}://{NETWORK_DEST_ADDRESS}:{NETWORK_DEST_PORT}'
+
+
+def create_ssl_context() -> SSLContext:
+    # Load the CA bundle and the client certificate once for mutual TLS
+    ssl_context: SSLContext = create_default_context(Purpose.SERVER_AUTH, cafile=TLS_CA_CERT_PATH)
+    ssl_context.load_cert_chain(certfile=SECRET_CERT_TARGET, keyfile=SECRET_KEY_TARGET)
+    return enable_session_resumption(ssl_context)
+
+
+def create_session() -> Session:
+    # Create a keep-alive session with a bounded connection pool
+    session: Session = Session()
+    adapter: TLSAdapter = TLSAdapter(
+        ssl_context=create_ssl_context(), pool_connections=NETWORK_POOL_CONNECTIONS, pool_maxsize=NETWORK_POOL_SIZE,
+        pool_block=True
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', HTTPAdapter(pool_connections=NETWORK_POOL_CONNECTIONS, pool_maxsize=NETWORK_POOL_SIZE,
+                                         pool_block=True))
+
+    # Send requests for the next stage through its Unix domain socket when it is local
+    if NETWORK_DEST_SOCKET_PATH:
+        session.mount(f'{get_dest_url()}/', UnixAdapter(
+            ssl_context=adapter.ssl_context, pool_connections=NETWORK_POOL_CONNECTIONS,
+            pool_maxsize=NETWORK_POOL_SIZE, pool_block=True
+        ))
+    return session
+
+
+def get_session() -> Session:
+    global HTTP_SESSION
+    global HTTP_SESSION_PID
+
+    # Build the session once per process so forked workers never share sockets
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None or HTTP_SESSION_PID != getpid():
+            HTTP_SESSION = create_session()
+            HTTP_SESSION_PID = getpid()
+
+    return HTTP_SESSION
+
+
+# Specify circuit breaker states
+class BreakerState(StrEnum):
+    CLOSED = auto()
+    OPEN = auto()
+    HALFOPEN = 'half-open'
+
+
+# Raise when a destination is skipped because its circuit is open
+class CircuitOpenError(RequestException):
+    pass
+
+
+# Stop calling a destination after repeated failures and let one trial request through once it has rested
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float) -> None:
+        self.failure_threshold: int = failure_threshold
+        self.reset_seconds: float = reset_seconds
+        self.state: BreakerState = BreakerState.CLOSED
+        self.failures: int = 0
+        self.opened_at: float = 0.0
+        self.is_trial_running: bool = False
+        self.rejected: int = 0
+        self.lock: Lock = Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == BreakerState.OPEN and monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = BreakerState.HALFOPEN
+                self.is_trial_running = False
+
+            if self.state == BreakerState.CLOSED:
+                return True
+            elif self.state == BreakerState.HALFOPEN and not self.is_trial_running:
+                self.is_trial_running = True
+                return True
+            else:
+                self.rejected += 1
+                return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.state = BreakerState.CLOSED
+            self.failures = 0
+            self.is_trial_running = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == BreakerState.HALFOPEN or self.failures >= self.failure_threshold:
+                self.state = BreakerState.OPEN
+                self.opened_at = monotonic()
+                self.is_trial_running = False
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'state': self.state.value, 'failures': self.failures, 'rejected': self.rejected}
+
+
+# Set up one breaker per destination in each process
+BREAKERS: dict[str, CircuitBreaker] = {}
+BREAKERS_LOCK: Lock = Lock()
+
+
+def get_breaker(destination: str) -> CircuitBreaker:
+    with BREAKERS_LOCK:
+        if destination not in BREAKERS:
+            BREAKERS[destination] = CircuitBreaker(NETWORK_BREAKER_FAILURE_THRESHOLD, NETWORK_BREAKER_RESET_SECONDS)
+        return BREAKERS[destination]
+
+
+def get_breaker_stats() -> dict:
+    with BREAKERS_LOCK:
+        breakers: dict[str, CircuitBreaker] = dict(BREAKERS)
+    return {destination: breaker.get_stats() for destination, breaker in breakers.items()}
+
+
+def get_backoff(attempt: int) -> float:
+    # Use full jitter so retries from many workers do not land on the peer at the same moment
+    return uniform(0, min(NETWORK_RETRY_BACKOFF_MAX_SECONDS, NETWORK_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+
+
+def send_request(method: str, url: str, **kwargs) -> Response:
+    # Send through the shared session with timeouts, jittered retries, and the destination's breaker
+    breaker: CircuitBreaker = get_breaker(urlsplit(url).netloc)
+
+    # Only retry a POST that never reached the peer; after a read timeout the peer may already have forwarded it
+    retryable_errors: tuple[type[RequestException], ...] = (
+        (ConnectionError,) if method == 'POST' else (ConnectionError, Timeout)
+    )
+    for attempt in range(NETWORK_RETRY_ATTEMPTS):
+        if attempt > 0:
+            sleep(get_backoff(attempt - 1))
+        if not breaker.allow():
+            raise CircuitOpenError(f'Circuit to {urlsplit(url).netloc} is open.')
+
+        try:
+            response: Response = get_session().request(method=method, url=url, timeout=REQUEST_TIMEOUT, **kwargs)
+        except retryable_errors:
+            breaker.record_failure()
+            if attempt + 1 == NETWORK_RETRY_ATTEMPTS:
+                raise
+            continue
+        except BaseException:
+            # Count any other error as a failure without retrying so a half-open trial is always released
+            breaker.record_failure()
+            raise
+
+        if response.status_code in FAILURE_STATUS_CODES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status_code not in RETRY_STATUS_CODES or attempt + 1 == NETWORK_RETRY_ATTEMPTS:
+            return response
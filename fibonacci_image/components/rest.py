@@ -1,219 +1,154 @@
 from server_init import *
-from os import getpid, name
-from platform import win32_ver, freedesktop_os_release
 from flask import Flask, request as flask_request, jsonify
-from requests import request as requests_request, Response
-from sys import version
-from threading import Thread
-from time import sleep
-from datastore_utils import APIType, DatastoreType, LogType, LogKind, report_log, save_log
+from requests import RequestException, Response
+from typing import Union
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import get_dest_url, send_request
+from send_utils import get_executor
+from codec_utils import encode_message, decode_message
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, create_server_identifier, start_worker,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         register_routes, reject_busy)
 
 # Create a server identifier
-if name == 'nt':
-    os_version: str = f'Windows {win32_ver()[0]}.{win32_ver()[1]}'
-else:
-    os_version: str = f'{freedesktop_os_release()['PRETTY_NAME']}'
-
-SERVER_IDENTIFIER: dict = {
-    'PYTHON_VERSION': version,
-    'OS_VERSION': os_version,
-    'WORKER_PID': getpid(),
-    'API': API,
-    'DATASTORE_TYPE': DATASTORE_TYPE,
-    'STAGE_INDEX': STAGE_INDEX
-}
-
-# Create log from the server identifier
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'The server identifier is {SERVER_IDENTIFIER}')
-
-# Create log from the datastore filepaths
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'The datastore default server log location is {DATASTORE_LOGS_DEFAULT_PATH}.')
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'The datastore operations log location is {DATASTORE_LOGS_OPERATION_PATH}.')
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'The datastore server log location is {DATASTORE_LOGS_SERVER_PATH}.')
-
-# Create log from the server API
-assert API in [member.value for member in APIType]
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER, f'The server API is {API}.')
-
-# Get the server datastore
-assert DATASTORE_TYPE in [member.value for member in DatastoreType]
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER, f'The server datastore is {DATASTORE_TYPE}.')
-
-# Get the server count
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'Total amount of servers in the network is {STAGE_COUNT}.')
-
-# Get the server index
-assert 0 < STAGE_INDEX <= STAGE_COUNT
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'Server index validated. Index is {STAGE_INDEX}.')
-
-# Get destination socket
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'Destination socket created. Socket is {NETWORK_DEST_ADDRESS} at port {NETWORK_DEST_PORT}.')
-
-# Get throttle time
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER,
-           f'Throttle interval set to {THROTTLE_SECONDS} second(s).')
-
-# Get the upper bound
-report_log(LogType.OPERATION, [LogKind.ONSTART], SERVER_IDENTIFIER, f'Upper bound of test set to {UPPER_BOUND}.')
-
-# Start the log ID rotation
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings; a preloaded app is started by the post_fork hook in each worker
+if not PRELOAD:
+    start_worker(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
 SNF_LOG_ID: str = 'N/A'
-LAST_SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
 
 # Create app object
 app = Flask(__name__)
 
 
 # Define a sending thread
-def trigger_send(new_fib_one: int, new_fib_two: int, snf_log_id: str) -> None:
+def trigger_send(new_fib_one: int, new_fib_two: int, steps: int, sequence_id: str, snf_log_id: str) -> None:
     global SERVER_IDENTIFIER
 
-    response: Response = requests_request(
-        method='POST',
-        url=f'https://{NETWORK_DEST_ADDRESS}:{NETWORK_DEST_PORT}',
-        json={'fib_one': new_fib_one, 'fib_two': new_fib_two},
-        cert=(SECRET_CERT_TARGET, SECRET_KEY_TARGET),
-        verify=TLS_CA_CERT_PATH
-    )
+    try:
+        body, content_type = encode_message(
+            {'fib_one': new_fib_one, 'fib_two': new_fib_two, 'steps': steps, 'sequence': sequence_id}, WIRE_FORMAT
+        )
+        response: Response = send_request(
+            method='POST',
+            url=get_dest_url(),
+            data=body,
+            headers={'Content-Type': content_type}
+        )
+    except (RequestException, ValueError) as e:
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Experienced Request Exception for message ID {snf_log_id}. Details: {e}')
+        return
     report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
                f'Return code for message ID {snf_log_id}: {response.status_code}')
     report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
-               f'Return info for message ID {snf_log_id}: {response.json()}')
+               f'Return info for message ID {snf_log_id}: {response.text}')
 
 
 # Create route processing logic
 @app.route('/', methods=['POST'])
-def process_fib_numbers() -> tuple[Response, int]:
+def process_fib_numbers() -> Union[tuple[Response, int], tuple[Response, int, dict]]:
     global SERVER_IDENTIFIER
     global SNF_LOG_ID
 
-    # Get numbers
-    fib_numbers: dict = flask_request.get_json(force=True, silent=True)
-    if fib_numbers is None:
+    # Shed load before doing any work if sends are backed up
+    if get_executor().is_full():
+        return reject_busy(SERVER_IDENTIFIER, SNF_LOG_ID, LogKind.MAIN, 'POST')
+
+    # Get and ingest numbers in whichever wire format the sender used
+    try:
+        fib_numbers: Union[dict, None] = decode_message(flask_request.get_data(), flask_request.mimetype)
+        fib_one: int = int(fib_numbers['fib_one'])
+        fib_two: int = int(fib_numbers['fib_two'])
+        steps: int = get_requested_steps(fib_numbers)
+        sequence_id: str = str(fib_numbers.get('sequence', DEFAULT_SEQUENCE_ID))
+    except (KeyError, ValueError, TypeError):
         msg: str = f'POST request failed. Unable to retrieve numbers.'
         report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
         return jsonify({'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID}), 422
 
-    # Ingest numbers
-    fib_one: int = int(fib_numbers['fib_one'])
-    fib_two: int = int(fib_numbers['fib_two'])
+    # Answer a repeat of a recently handled message with the original response and do nothing else
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    original_response: Union[tuple[int, str], None] = get_original_response(dedupe_key)
+    if original_response is not None:
+        get_shared_state().increment('duplicatesDropped')
+        return_code, log_id = original_response
+        return jsonify({'status': 'Success', 'message': POST_SUCCESS_MESSAGES[return_code], 'result': log_id,
+                        'sequence': sequence_id}), return_code
+
     report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
-               f'Retrieved numbers {fib_one} and {fib_two} in fibonacci sequence.')
+               f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
 
-    # Create new numbers
-    if fib_two > 0:  # The sequence already started
-        new_fib_one: int = fib_two
-        new_fib_two: int = fib_one + fib_two
-    else:  # The sequence just started
-        new_fib_one: int = 0
-        new_fib_two: int = 1
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
 
     report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
-               f'Next fibonacci number determined to be {new_fib_two}.')
+               f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+               f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
     report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
-               f'Sending numbers {new_fib_one} and {new_fib_two} in fibonacci sequence.')
-
-    # Artificial throttling
-    sleep(THROTTLE_SECONDS)
+               f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
 
-    # Update the current log id
-    SNF_LOG_ID = f'{STAGE_INDEX}-{new_fib_one}-{new_fib_two}'
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
 
     # Decide on a response to send back
-    if new_fib_one < UPPER_BOUND:  # Run the bash script to forward the next server in line
-        trigger_send_thread: Thread = Thread(target=trigger_send, args=(new_fib_one, new_fib_two, SNF_LOG_ID,))
-        trigger_send_thread.start()
-        msg: str = 'POST request succeeded. Sent off fibonacci numbers.'
+    if new_fib_one < UPPER_BOUND:  # Forward to the next server in line once the throttle interval passes
+        if not get_executor().submit(trigger_send, new_fib_one, new_fib_two, steps, sequence_id, snf_log_id,
+                                     delay=THROTTLE_SECONDS):
+            return reject_busy(SERVER_IDENTIFIER, SNF_LOG_ID, LogKind.MAIN, 'POST')
         return_code: int = 202
     else:  # Return that the upper bound has been reached
-        msg: str = f'POST request succeeded. Reached upper bound.'
         return_code: int = 200
 
-    # Send the response back
-    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
-    return jsonify({'status': 'Success', 'message': msg, 'result': SNF_LOG_ID}), return_code
-
-
-# Create healthcheck logic
-@app.route('/healthcheck', methods=['GET'])
-def get_healthcheck() -> tuple[Response, int]:
-    global SERVER_IDENTIFIER
-    global SNF_LOG_ID
-    global LAST_SNF_LOG_ID
-
-    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.HEALTHCHECK], SERVER_IDENTIFIER,
-               'GET healthcheck request received.')
-
-    # Compare IDs
-    if LAST_SNF_LOG_ID != SNF_LOG_ID: 
-        msg: str = 'GET healthcheck request succeeded. Server has processed a new step.'
-    else:
-        msg: str = 'GET healthcheck request succeeded. Server is waiting for some reason.'
-    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.HEALTHCHECK], SERVER_IDENTIFIER, msg)
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
 
-    # Update Last ID for later healthcheck
-    LAST_SNF_LOG_ID = SNF_LOG_ID
+    # Remember the response in case the same message is sent again
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    msg: str = POST_SUCCESS_MESSAGES[return_code]
 
     # Send the response back
-    return jsonify({'status': 'Success', 'message': msg, 'result': SNF_LOG_ID}), 200
-
-
-# Create starting logic
-@app.route('/start', methods=['GET'])
-def start_fib() -> tuple[Response, int]:
-    global SERVER_IDENTIFIER
-    global SNF_LOG_ID
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return jsonify({'status': 'Success', 'message': msg, 'result': SNF_LOG_ID, 'sequence': sequence_id}), return_code
 
-    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.START], SERVER_IDENTIFIER, 'GET start request received.')
 
-    # Set the log ID to the starting default
-    SNF_LOG_ID = f'{STAGE_INDEX}-0-0'
+def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+    return get_executor().submit(trigger_send, fib_one, fib_two, STEPS_DEFAULT, sequence_id, start_log_id)
 
-    # Run the bash script to start the sequence at 0 0
-    trigger_send_thread: Thread = Thread(target=trigger_send, args=(0, 0, SNF_LOG_ID,))
-    trigger_send_thread.start()
 
-    # Send the response back
-    msg: str = f'GET start request succeeded. Started fibonacci sequence.'
-    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.START], SERVER_IDENTIFIER, msg)
+def start_sequences(start_index: Union[int, None], count: int, method: str) -> tuple[int, str, str, list[str]]:
+    global SNF_LOG_ID
 
-    return jsonify({'status': 'Success', 'message': msg, 'result': SNF_LOG_ID}), 202
+    return_code, status, msg, sequence_ids, start_log_id = launch_sequences(
+        SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, method, submit_start
+    )
 
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    return return_code, status, msg, sequence_ids
 
-# Create datastore logic
-@app.route('/datastore', methods=['POST'])
-def process_log() -> tuple[Response, int]:
-    global SERVER_IDENTIFIER
-    global SNF_LOG_ID
 
-    # Get log
-    cur_log: dict = flask_request.get_json(force=True, silent=True)
-    if cur_log is None:
-        msg: str = f'POST datastore request failed. Unable to retrieve log.'
-        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.DATASTORE], SERVER_IDENTIFIER, msg)
-        return jsonify({'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID}), 422
+def get_log_id() -> str:
+    return SNF_LOG_ID
 
-    # Save log to file
-    success, op_success = save_log(DATASTORE_LOGS_SERVER_PATH, cur_log, SERVER_IDENTIFIER)
-    if success and op_success:
-        status: str = 'Success'
-        msg: str = f'POST datastore request succeeded. Saved log.'
-        return_code: int = 200
-    elif success and not op_success:
-        status: str = 'Success'
-        msg: str = f'POST datastore request succeeded. Saved log. Subsequent operation log saving failed.'
-        return_code: int = 200
-    else:
-        status: str = 'Fail'
-        msg: str = f'POST datastore request failed. Saving log to file failed.'
-        return_code: int = 500
 
-    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.DATASTORE], SERVER_IDENTIFIER, msg)
-    return jsonify({'status': status, 'message': msg, 'result': SNF_LOG_ID}), return_code
+# Add the control routes every stage shares
+register_routes(app, SERVER_IDENTIFIER, SEQUENCE_TABLE, get_log_id, start_sequences)
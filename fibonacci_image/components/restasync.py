@@ -0,0 +1,253 @@
+from server_init import *
+from asyncio import (AbstractEventLoop, TimeoutError as AsyncTimeoutError, get_running_loop,
+                     run_coroutine_threadsafe, to_thread)
+from json import JSONDecodeError
+from typing import Union
+from aiohttp import web, ClientError, ClientSession, TCPConnector
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import CircuitOpenError, create_ssl_context
+from network_async_utils import create_client_timeout, send_request_async
+from send_utils import AsyncBoundedExecutor
+from codec_utils import encode_message, decode_message
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, check_ready, create_server_identifier, start_worker,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         parse_start_args, create_start_response, create_health_response, create_fib_response,
+                         create_datastore_response)
+
+# Create a server identifier
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings; a preloaded app is started by the post_fork hook in each worker
+if not PRELOAD:
+    start_worker(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
+SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
+
+# Create the sender and route table
+SEND_EXECUTOR: AsyncBoundedExecutor = AsyncBoundedExecutor(SENDER_WORKERS, SENDER_QUEUE_DEPTH,
+                                                           SENDER_SCHEDULE_DEPTH)
+CLIENT_KEY: web.AppKey[ClientSession] = web.AppKey('client', ClientSession)
+routes: web.RouteTableDef = web.RouteTableDef()
+
+
+# Run log reporting off the event loop so datastore writes never block it
+async def report_log_async(log_type: LogType, log_kinds: list[LogKind], server_id: dict, details: str) -> None:
+    await to_thread(report_log, log_type, log_kinds, server_id, details)
+
+
+# Define a sending task
+async def trigger_send(client: ClientSession, new_fib_one: int, new_fib_two: int, steps: int, sequence_id: str,
+                       snf_log_id: str) -> None:
+    global SERVER_IDENTIFIER
+
+    try:
+        body, content_type = encode_message(
+            {'fib_one': new_fib_one, 'fib_two': new_fib_two, 'steps': steps, 'sequence': sequence_id}, WIRE_FORMAT
+        )
+        status, response_info = await send_request_async(
+            client, 'POST', f'https://{NETWORK_DEST_ADDRESS}:{NETWORK_DEST_PORT}', data=body,
+            headers={'Content-Type': content_type}
+        )
+    except (ClientError, AsyncTimeoutError, CircuitOpenError, ValueError) as e:
+        await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                               f'Experienced Request Exception for message ID {snf_log_id}. Details: {e}')
+        return
+
+    await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Return code for message ID {snf_log_id}: {status}')
+    await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Return info for message ID {snf_log_id}: {response_info}')
+
+
+# Define a response for when the send queue cannot take more work
+async def reject_busy(log_kind: LogKind, method: str) -> web.Response:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    SEND_EXECUTOR.record_rejection()
+    msg: str = f'{method} request rejected. Send queue is full.'
+    await report_log_async(LogType.SEND, [LogKind.ONCALL, log_kind], SERVER_IDENTIFIER, msg)
+    return web.json_response(
+        {'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID, 'sender': SEND_EXECUTOR.get_stats()}, status=503,
+        headers={'Retry-After': str(SENDER_RETRY_AFTER_SECONDS)}
+    )
+
+
+# Create route processing logic
+@routes.post('/')
+async def process_fib_numbers(request: web.Request) -> web.Response:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Shed load before doing any work if sends are backed up
+    if SEND_EXECUTOR.is_full():
+        return await reject_busy(LogKind.MAIN, 'POST')
+
+    # Get and ingest numbers in whichever wire format the sender used
+    try:
+        fib_numbers: dict = decode_message(await request.read(), request.content_type)
+        fib_one: int = int(fib_numbers['fib_one'])
+        fib_two: int = int(fib_numbers['fib_two'])
+        steps: int = get_requested_steps(fib_numbers)
+        sequence_id: str = str(fib_numbers.get('sequence', DEFAULT_SEQUENCE_ID))
+    except (KeyError, ValueError, TypeError):
+        msg: str = f'POST request failed. Unable to retrieve numbers.'
+        await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+        return web.json_response({'status': 'Fail', 'message': msg, 'result': SNF_LOG_ID}, status=422)
+
+    # Answer a repeat of a recently handled message with the original response and do nothing else
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    original_response: Union[tuple[int, str], None] = get_original_response(dedupe_key)
+    if original_response is not None:
+        get_shared_state().increment('duplicatesDropped')
+        return_code, log_id = original_response
+        return web.json_response({'status': 'Success', 'message': POST_SUCCESS_MESSAGES[return_code],
+                                  'result': log_id, 'sequence': sequence_id}, status=return_code)
+
+    await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                           f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+                           f'in fibonacci sequence {sequence_id}.')
+
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
+
+    await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                           f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+                           f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
+    await report_log_async(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                           f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+                           f'in fibonacci sequence {sequence_id}.')
+
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
+
+    # Decide on a response to send back
+    if new_fib_one < UPPER_BOUND:  # Forward to the next server in line once the throttle interval passes
+        if not SEND_EXECUTOR.submit(trigger_send, request.app[CLIENT_KEY], new_fib_one, new_fib_two, steps,
+                                    sequence_id, snf_log_id, delay=THROTTLE_SECONDS):
+            return await reject_busy(LogKind.MAIN, 'POST')
+        return_code: int = 202
+    else:  # Return that the upper bound has been reached
+        return_code: int = 200
+
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
+
+    # Remember the response in case the same message is sent again
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    msg: str = POST_SUCCESS_MESSAGES[return_code]
+
+    # Send the response back
+    await report_log_async(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return web.json_response({'status': 'Success', 'message': msg, 'result': SNF_LOG_ID, 'sequence': sequence_id},
+                             status=return_code)
+
+
+# Create liveness and readiness logic; both answer from memory and skip logging so frequent probes stay cheap
+@routes.get('/livez')
+async def get_livez(request: web.Request) -> web.Response:
+    return web.json_response({'status': 'Success'}, status=200)
+
+
+@routes.get('/readyz')
+async def get_readyz(request: web.Request) -> web.Response:
+    ready_body, return_code = check_ready(SEND_EXECUTOR.is_full())
+    return web.json_response(ready_body, status=return_code)
+
+
+# Create healthcheck logic; the shared builders log to the datastore, so they run off the event loop
+@routes.get('/healthcheck')
+async def get_healthcheck(request: web.Request) -> web.Response:
+    global SERVER_IDENTIFIER
+
+    health_body, return_code = await to_thread(create_health_response, SERVER_IDENTIFIER, SEQUENCE_TABLE,
+                                               SEND_EXECUTOR.get_stats())
+    return web.json_response(health_body, status=return_code)
+
+
+# Create starting logic
+@routes.get('/start')
+async def start_fib(request: web.Request) -> web.Response:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    loop: AbstractEventLoop = get_running_loop()
+    client: ClientSession = request.app[CLIENT_KEY]
+
+    async def submit_on_loop(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+        return SEND_EXECUTOR.submit(trigger_send, client, fib_one, fib_two, STEPS_DEFAULT, sequence_id, start_log_id)
+
+    def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+        # The shared start logic runs on a worker thread, but the sender belongs to the event loop
+        return run_coroutine_threadsafe(submit_on_loop(fib_one, fib_two, sequence_id, start_log_id), loop).result()
+
+    start_index, count = parse_start_args(request.query)
+    return_code, status, msg, sequence_ids, start_log_id = await to_thread(
+        launch_sequences, SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, 'GET start', submit_start,
+        SEND_EXECUTOR
+    )
+
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    start_body, return_code, headers = create_start_response(return_code, status, msg, sequence_ids, SNF_LOG_ID,
+                                                             SEND_EXECUTOR.get_stats())
+    return web.json_response(start_body, status=return_code, headers=headers)
+
+
+# Create direct lookup logic
+@routes.get(r'/fib/{fib_index:\d+}')
+async def get_fib(request: web.Request) -> web.Response:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    fib_body, return_code = await to_thread(create_fib_response, SERVER_IDENTIFIER,
+                                            int(request.match_info['fib_index']), SNF_LOG_ID,
+                                            request.query.get('format') == 'hex')
+    return web.json_response(fib_body, status=return_code)
+
+
+# Create datastore logic
+@routes.post('/datastore')
+async def process_log(request: web.Request) -> web.Response:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Get log
+    try:
+        cur_log: Union[dict, None] = await request.json()
+    except (JSONDecodeError, UnicodeDecodeError):
+        cur_log = None
+
+    log_body, return_code = await to_thread(create_datastore_response, SERVER_IDENTIFIER, cur_log, SNF_LOG_ID)
+    return web.json_response(log_body, status=return_code)
+
+
+# Create and close the keep-alive client with the worker's event loop
+async def create_client(cur_app: web.Application) -> None:
+    cur_app[CLIENT_KEY] = ClientSession(connector=TCPConnector(ssl=create_ssl_context(), limit=NETWORK_POOL_SIZE),
+                                        timeout=create_client_timeout())
+
+
+async def close_client(cur_app: web.Application) -> None:
+    await cur_app[CLIENT_KEY].close()
+
+
+# Create app object
+app: web.Application = web.Application()
+app.add_routes(routes)
+app.on_startup.append(create_client)
+app.on_cleanup.append(close_client)
@@ -1,13 +1,13 @@
-from server_init import (API, NETWORK_SELF_ADDRESS_HEALTHCHECK, NETWORK_SELF_PORT, SECRET_CERT_TARGET,
-                         SECRET_KEY_TARGET, TLS_CA_CERT_PATH)
+from server_init import API, NETWORK_SELF_ADDRESS_HEALTHCHECK, NETWORK_SELF_PORT
 from datastore_utils import APIType
-from requests import request, Response
+from network_utils import REQUEST_TIMEOUT, get_session
+from requests import Response
 
 # Send healthcheck to self
-if API == APIType.REST.value:
-    response: Response = request(
+if API in [APIType.REST.value, APIType.RESTASYNC.value, APIType.GRPC.value, APIType.MQTT.value,
+           APIType.GRAPHQL.value, APIType.SOAP.value, APIType.TCP.value]:
+    response: Response = get_session().request(
         method='GET',
         url=f'https://{NETWORK_SELF_ADDRESS_HEALTHCHECK}:{NETWORK_SELF_PORT}/healthcheck',
-        cert=(SECRET_CERT_TARGET, SECRET_KEY_TARGET),
-        verify=TLS_CA_CERT_PATH
+        timeout=REQUEST_TIMEOUT
     )
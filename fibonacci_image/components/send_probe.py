@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+from http.client import HTTPSConnection
+from json import load
+from os import environ
+from ssl import SSLContext, create_default_context
+from sys import argv, exit
+
+# Read the settings the server wrote at startup; only the standard library is imported so each probe starts fast
+PROBE_PATH: str = environ.get('PROBE_PATH', '/tmp/probe.json')
+PROBE_ROUTES: list[str] = ['livez', 'readyz']
+
+# Probe liveness unless readiness is asked for
+route: str = argv[1] if len(argv) > 1 else 'livez'
+if route not in PROBE_ROUTES:
+    exit(f'Probe route must be one of {PROBE_ROUTES}.')
+
+with open(PROBE_PATH) as probe_file:
+    probe_settings: dict = load(probe_file)
+
+ssl_context: SSLContext = create_default_context(cafile=probe_settings['caPath'])
+ssl_context.load_cert_chain(certfile=probe_settings['certPath'], keyfile=probe_settings['keyPath'])
+
+# Send probe to self and fail on anything but a 200 response
+connection: HTTPSConnection = HTTPSConnection(
+    probe_settings['address'], probe_settings['port'], context=ssl_context, timeout=probe_settings['timeoutSecs']
+)
+connection.request('GET', f'/{route}')
+status: int = connection.getresponse().status
+connection.close()
+exit(0 if status == 200 else 1)
@@ -0,0 +1,200 @@
+from server_init import *
+from os import getpid
+from asyncio import Semaphore, Task, create_task, sleep
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic
+from collections.abc import Callable, Coroutine
+from typing import Union
+
+
+# Create a single timer thread that fires delayed calls from a heap ordered by due time
+class DelayScheduler:
+    def __init__(self) -> None:
+        self.heap: list[tuple[float, int, Callable, tuple]] = []
+        self.order: count = count()
+        self.condition: Condition = Condition()
+        self.thread: Thread = Thread(target=self.loop, name='send_scheduler', daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay: float, fn: Callable, *args) -> None:
+        with self.condition:
+            heappush(self.heap, (monotonic() + delay, next(self.order), fn, args))
+            self.condition.notify()
+
+    def loop(self) -> None:
+        while True:
+            # Sleep until the earliest call is due or a new call is scheduled
+            with self.condition:
+                while not self.heap or self.heap[0][0] > monotonic():
+                    self.condition.wait(self.heap[0][0] - monotonic() if self.heap else None)
+                _, _, fn, args = heappop(self.heap)
+
+            fn(*args)
+
+
+# Create a thread pool that refuses work once its queue is full; delayed work waits in its own bounded heap
+class BoundedExecutor:
+    def __init__(self, max_workers: int, queue_depth: int, schedule_depth: int) -> None:
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='trigger_send')
+        self.scheduler: DelayScheduler = DelayScheduler()
+        self.max_workers: int = max_workers
+        self.queue_depth: int = queue_depth
+        self.schedule_depth: int = schedule_depth
+        self.pending: int = 0
+        self.scheduled: int = 0
+        self.in_flight: int = 0
+        self.rejected: int = 0
+        self.lock: Lock = Lock()
+
+    def is_full(self) -> bool:
+        with self.lock:
+            return self.pending >= self.max_workers + self.queue_depth or self.scheduled >= self.schedule_depth
+
+    def get_free_slots(self) -> int:
+        with self.lock:
+            return max(self.max_workers + self.queue_depth - self.pending, 0)
+
+    def submit(self, fn: Callable, *args, delay: float = 0.0) -> bool:
+        # Reserve a slot in the heap for delayed work or in the queue for work that is due, or reject the work
+        with self.lock:
+            if delay > 0:
+                if self.scheduled >= self.schedule_depth:
+                    return False
+                self.scheduled += 1
+            else:
+                if self.pending >= self.max_workers + self.queue_depth:
+                    return False
+                self.pending += 1
+
+        if delay > 0:
+            self.scheduler.schedule(delay, self.release, fn, *args)
+        else:
+            self.executor.submit(self.run, fn, *args)
+        return True
+
+    def release(self, fn: Callable, *args) -> None:
+        # Move delayed work from the heap to the pool once it is due; it was already accepted, so it is never dropped
+        with self.lock:
+            self.scheduled -= 1
+            self.pending += 1
+        self.executor.submit(self.run, fn, *args)
+
+    def record_rejection(self) -> None:
+        with self.lock:
+            self.rejected += 1
+
+    def run(self, fn: Callable, *args) -> None:
+        with self.lock:
+            self.in_flight += 1
+
+        try:
+            fn(*args)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.pending -= 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'scheduled': self.scheduled,
+                'scheduleDepth': self.schedule_depth,
+                'queued': self.pending - self.in_flight,
+                'inFlight': self.in_flight,
+                'queueDepth': self.queue_depth,
+                'workers': self.max_workers,
+                'rejected': self.rejected
+            }
+
+
+# Create the event loop counterpart that runs sends as tasks instead of threads
+class AsyncBoundedExecutor:
+    def __init__(self, max_workers: int, queue_depth: int, schedule_depth: int) -> None:
+        self.semaphore: Semaphore = Semaphore(max_workers)
+        self.tasks: set[Task] = set()
+        self.max_workers: int = max_workers
+        self.queue_depth: int = queue_depth
+        self.schedule_depth: int = schedule_depth
+        self.pending: int = 0
+        self.scheduled: int = 0
+        self.in_flight: int = 0
+        self.rejected: int = 0
+
+    def is_full(self) -> bool:
+        return self.pending >= self.max_workers + self.queue_depth or self.scheduled >= self.schedule_depth
+
+    def get_free_slots(self) -> int:
+        return max(self.max_workers + self.queue_depth - self.pending, 0)
+
+    def submit(self, fn: Callable[..., Coroutine], *args, delay: float = 0.0) -> bool:
+        # Reserve a slot in the timer heap for delayed work or in the queue for work that is due, or reject the work
+        if delay > 0:
+            if self.scheduled >= self.schedule_depth:
+                return False
+            self.scheduled += 1
+        else:
+            if self.pending >= self.max_workers + self.queue_depth:
+                return False
+            self.pending += 1
+
+        # Keep a reference to the task so it is not collected before it finishes
+        task: Task = create_task(self.run(fn, *args, delay=delay))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    def record_rejection(self) -> None:
+        self.rejected += 1
+
+    async def run(self, fn: Callable[..., Coroutine], *args, delay: float = 0.0) -> None:
+        # Wait on the event loop's own timer heap without holding a send slot
+        if delay > 0:
+            try:
+                await sleep(delay)
+            finally:
+                self.scheduled -= 1
+            self.pending += 1
+
+        try:
+            async with self.semaphore:
+                self.in_flight += 1
+                try:
+                    await fn(*args)
+                finally:
+                    self.in_flight -= 1
+        finally:
+            self.pending -= 1
+
+    def get_stats(self) -> dict:
+        return {
+            'scheduled': self.scheduled,
+            'scheduleDepth': self.schedule_depth,
+            'queued': self.pending - self.in_flight,
+            'inFlight': self.in_flight,
+            'queueDepth': self.queue_depth,
+            'workers': self.max_workers,
+            'rejected': self.rejected
+        }
+
+
+# Set up the per-process executor state
+SEND_EXECUTOR: Union[BoundedExecutor, None] = None
+SEND_EXECUTOR_PID: int = -1
+SEND_EXECUTOR_LOCK: Lock = Lock()
+
+
+def get_executor() -> BoundedExecutor:
+    global SEND_EXECUTOR
+    global SEND_EXECUTOR_PID
+
+    # Build the executor once per process since threads do not survive a fork
+    with SEND_EXECUTOR_LOCK:
+        if SEND_EXECUTOR is None or SEND_EXECUTOR_PID != getpid():
+            SEND_EXECUTOR = BoundedExecutor(SENDER_WORKERS, SENDER_QUEUE_DEPTH, SENDER_SCHEDULE_DEPTH)
+            SEND_EXECUTOR_PID = getpid()
+
+    return SEND_EXECUTOR
@@ -0,0 +1,71 @@
+from server_init import *
+from collections import OrderedDict
+from secrets import token_hex
+from threading import Lock
+from time import monotonic
+
+# Set the sequence ID used for messages that do not carry one
+DEFAULT_SEQUENCE_ID: str = 'default'
+
+
+def create_sequence_id() -> str:
+    # Prefix with the stage so IDs started by different stages never collide
+    return f'{STAGE_INDEX}-{token_hex(6)}'
+
+
+# Hold the progress of one sequence in as little memory as possible
+class SequenceState:
+    __slots__ = ('log_id', 'hops', 'updated')
+
+    def __init__(self, log_id: str) -> None:
+        self.log_id: str = log_id
+        self.hops: int = 0
+        self.updated: float = monotonic()
+
+
+# Track the progress of every sequence a worker has seen, oldest update first
+class SequenceTable:
+    def __init__(self, max_tracked: int, idle_seconds: int) -> None:
+        self.active: OrderedDict[str, SequenceState] = OrderedDict()
+        self.max_tracked: int = max_tracked
+        self.idle_seconds: int = idle_seconds
+        self.completed: int = 0
+        self.evicted: int = 0
+        self.lock: Lock = Lock()
+
+    def update(self, sequence_id: str, log_id: str, is_done: bool = False) -> None:
+        with self.lock:
+            # Drop finished sequences right away
+            if is_done:
+                if self.active.pop(sequence_id, None) is not None:
+                    self.completed += 1
+                return
+
+            # Record progress and move the sequence to the newest end
+            state: SequenceState = self.active.setdefault(sequence_id, SequenceState(log_id))
+            state.log_id = log_id
+            state.hops += 1
+            state.updated = monotonic()
+            self.active.move_to_end(sequence_id)
+            self.evict()
+
+    def evict(self) -> None:
+        # Evict from the oldest end while sequences are idle or the table is over capacity
+        while self.active:
+            oldest: SequenceState = next(iter(self.active.values()))
+            if len(self.active) <= self.max_tracked and monotonic() - oldest.updated <= self.idle_seconds:
+                break
+            self.active.popitem(last=False)
+            self.evicted += 1
+
+    def get_progress(self) -> dict:
+        with self.lock:
+            self.evict()
+            return {
+                'active': {
+                    sequence_id: {'result': state.log_id, 'hops': state.hops}
+                    for sequence_id, state in self.active.items()
+                },
+                'completed': self.completed,
+                'evicted': self.evicted
+            }
@@ -1,8 +1,13 @@
-from os import environ
-from json import load
+from os import O_CREAT, O_TRUNC, O_WRONLY, chmod, environ, fdopen, makedirs, open as open_fd, remove, replace
+from os.path import abspath, exists
+from json import dump, dumps, load
+from hashlib import sha256
+from tempfile import mkstemp
+from threading import Timer
 from copy import deepcopy
-from collections.abc import Iterator
-from typing import Any
+from sys import get_int_max_str_digits, set_int_max_str_digits
+from collections.abc import Callable, Iterator
+from typing import Any, TextIO, Union
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
@@ -103,6 +108,19 @@ def create_key_cert(subject: x509.Name, san_names: list[str], san_ips: list[str]
         cert = cert.sign(issuer_key, hashes.SHA512())
 
     # Save key and certificate as various documents
+    save_key_cert(key, cert, filename, key_ext, cert_ext, pem_ext, issuer_cert, is_ca, ca_suffix)
+    return key, cert
+
+
+def open_private(filename: str) -> TextIO:
+    # Create or truncate a file that holds a private key so only its owner can read it
+    private_fd: int = open_fd(filename, O_WRONLY | O_CREAT | O_TRUNC, 0o600)
+    chmod(filename, 0o600)
+    return fdopen(private_fd, 'w')
+
+
+def save_key_cert(key: RSAPrivateKey, cert: x509.Certificate, filename: str, key_ext: str, cert_ext: str, pem_ext: str,
+                  issuer_cert=None, is_ca: bool = False, ca_suffix: str = '') -> None:
     key_str: str = key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.TraditionalOpenSSL,
@@ -110,13 +128,13 @@ def create_key_cert(subject: x509.Name, san_names: list[str], san_ips: list[str]
     ).decode()
     cert_str: str = cert.public_bytes(serialization.Encoding.PEM).decode()
 
-    with open(f'{filename}.{key_ext}', 'w') as key_file:
+    with open_private(f'{filename}.{key_ext}') as key_file:
         key_file.write(key_str)
 
     with open(f'{filename}.{cert_ext}', 'w') as cert_file:
         cert_file.write(cert_str)
 
-    with open(f'{filename}.{pem_ext}', 'w') as pem_file:
+    with open_private(f'{filename}.{pem_ext}') as pem_file:
         pem_file.write(f'{cert_str}\n{key_str}')
 
     if not is_ca:
@@ -124,8 +142,6 @@ def create_key_cert(subject: x509.Name, san_names: list[str], san_ips: list[str]
         with open(f'{filename}-{ca_suffix}.{cert_ext}', 'w') as cert_combo_file:
             cert_combo_file.write(f'{cert_str}\n{issuer_cert_str}')
 
-    return key, cert
-
 
 # Import server configurations
 with open(environ.get('SERVER_CONFIG_FILEPATH')) as config_file:
@@ -174,6 +190,33 @@ DATASTORE_LOGS_OPERATION_PATH: str = RUNTIME_CONFIG['datastore']['logs']['operat
 DATASTORE_LOGS_SERVER_PATH: str = RUNTIME_CONFIG['datastore']['logs']['serverPath']
 DATASTORE_TYPE: str = RUNTIME_CONFIG['datastore']['type']
 
+# Set the dedupe cache for repeated messages
+DEDUPE_MAX_ENTRIES: int = int(RUNTIME_CONFIG['dedupe']['maxEntries'])
+DEDUPE_SCOPE: str = RUNTIME_CONFIG['dedupe']['scope']
+DEDUPE_TTL_SECONDS: float = float(RUNTIME_CONFIG['dedupe']['ttlSecs'])
+
+# Set fibonacci engine limits
+FIB_CACHE_SIZE: int = int(RUNTIME_CONFIG['fib']['cacheSize'])
+FIB_LOG_MAX_DIGITS: int = int(RUNTIME_CONFIG['fib']['logMaxDigits'])
+FIB_MAX_INDEX: int = int(RUNTIME_CONFIG['fib']['maxIndex'])
+
+# Set the GraphQL batch and document cache limits
+GRAPHQL_BATCH_SIZE: int = int(RUNTIME_CONFIG['graphql']['batchSize'])
+GRAPHQL_DOCUMENT_CACHE_SIZE: int = int(RUNTIME_CONFIG['graphql']['documentCacheSize'])
+GRAPHQL_OUTBOX_SIZE: int = int(RUNTIME_CONFIG['graphql']['outboxSize'])
+
+# Set the MQTT delivery guarantees
+MQTT_MAX_INFLIGHT: int = int(RUNTIME_CONFIG['mqtt']['maxInflight'])
+MQTT_QOS: int = int(RUNTIME_CONFIG['mqtt']['qos'])
+
+# Set the outbound circuit breaker
+NETWORK_BREAKER_FAILURE_THRESHOLD: int = int(RUNTIME_CONFIG['network']['breaker']['failureThreshold'])
+NETWORK_BREAKER_RESET_SECONDS: float = float(RUNTIME_CONFIG['network']['breaker']['resetSecs'])
+
+# Set MQTT broker socket
+NETWORK_BROKER_ADDRESS: str = RUNTIME_CONFIG['network']['broker']['address']
+NETWORK_BROKER_PORT: int = int(RUNTIME_CONFIG['network']['broker']['port'])
+
 # Set datastore socket
 NETWORK_DATASTORE_ADDRESS: str = RUNTIME_CONFIG['network']['datastore']['address']
 NETWORK_DATASTORE_PORT: int = int(RUNTIME_CONFIG['network']['datastore']['port'])
@@ -181,25 +224,80 @@ NETWORK_DATASTORE_PORT: int = int(RUNTIME_CONFIG['network']['datastore']['port']
 # Set destination socket
 NETWORK_DEST_ADDRESS: str = RUNTIME_CONFIG['network']['dest']['address']
 NETWORK_DEST_PORT: int = int(RUNTIME_CONFIG['network']['dest']['port'])
+NETWORK_DEST_SOCKET_PATH: str = RUNTIME_CONFIG['network']['dest']['socketPath']
+NETWORK_DEST_STREAM_PORT: int = int(RUNTIME_CONFIG['network']['dest']['streamPort'])
+
+# Set outbound connection pool sizes
+NETWORK_POOL_CONNECTIONS: int = int(RUNTIME_CONFIG['network']['pool']['connections'])
+NETWORK_POOL_SIZE: int = int(RUNTIME_CONFIG['network']['pool']['size'])
+
+# Set outbound retries
+NETWORK_RETRY_ATTEMPTS: int = int(RUNTIME_CONFIG['network']['retry']['attempts'])
+NETWORK_RETRY_BACKOFF_MAX_SECONDS: float = float(RUNTIME_CONFIG['network']['retry']['backoffMaxSecs'])
+NETWORK_RETRY_BACKOFF_SECONDS: float = float(RUNTIME_CONFIG['network']['retry']['backoffSecs'])
 
 # Set self server sockets
 NETWORK_SELF_ADDRESS_HEALTHCHECK: str = RUNTIME_CONFIG['network']['self']['address']['healthcheck']
 NETWORK_SELF_ADDRESS_LISTENING: str = RUNTIME_CONFIG['network']['self']['address']['listening']
+NETWORK_SELF_KEEPALIVE: int = int(RUNTIME_CONFIG['network']['self']['keepAlive'])
 NETWORK_SELF_PORT: int = int(RUNTIME_CONFIG['network']['self']['port'])
+NETWORK_SELF_SOCKET_PATH: str = RUNTIME_CONFIG['network']['self']['socketPath']
+NETWORK_SELF_STREAM_PORT: int = int(RUNTIME_CONFIG['network']['self']['streamPort'])
+NETWORK_SELF_STREAM_WORKERS: int = int(RUNTIME_CONFIG['network']['self']['streamWorkers'])
+
+# Set whether stages keep TLS on Unix domain sockets; the setting may come from the environment as text
+NETWORK_SOCKET_TLS: bool = str(RUNTIME_CONFIG['network']['socketTls']).lower() == 'true'
+
+# Set outbound timeouts
+NETWORK_TIMEOUT_CONNECT_SECONDS: float = float(RUNTIME_CONFIG['network']['timeout']['connectSecs'])
+NETWORK_TIMEOUT_READ_SECONDS: float = float(RUNTIME_CONFIG['network']['timeout']['readSecs'])
+
+# Set outbound sender limits
+SENDER_QUEUE_DEPTH: int = int(RUNTIME_CONFIG['sender']['queueDepth'])
+SENDER_RETRY_AFTER_SECONDS: int = int(RUNTIME_CONFIG['sender']['retryAfterSecs'])
+SENDER_SCHEDULE_DEPTH: int = int(RUNTIME_CONFIG['sender']['scheduleDepth'])
+SENDER_WORKERS: int = int(RUNTIME_CONFIG['sender']['workers'])
+
+# Set sequence tracking limits
+SEQUENCES_IDLE_SECONDS: int = int(RUNTIME_CONFIG['sequences']['idleSecs'])
+SEQUENCES_MAX_START: int = int(RUNTIME_CONFIG['sequences']['maxStart'])
+SEQUENCES_MAX_TRACKED: int = int(RUNTIME_CONFIG['sequences']['maxTracked'])
 
 # Set server stage information
 STAGE_COUNT: int = int(RUNTIME_CONFIG['stage']['count'])
 STAGE_INDEX: int = int(RUNTIME_CONFIG['stage']['index'])
 
+# Set steps per message
+STEPS_DEFAULT: int = int(RUNTIME_CONFIG['steps']['default'])
+STEPS_MAX: int = int(RUNTIME_CONFIG['steps']['max'])
+
 # Set other server settings
-THROTTLE_SECONDS: int = int(RUNTIME_CONFIG['throttleSecs'])
+THROTTLE_SECONDS: float = float(RUNTIME_CONFIG['throttleSecs'])
 UPPER_BOUND: int = int(RUNTIME_CONFIG['upperBound'])
+WIRE_FORMAT: str = RUNTIME_CONFIG['wire']['format']
 WORKERS: int = int(RUNTIME_CONFIG['workers'])
 
+# Let every number the ring can reach go out as the decimal text JSON and GraphQL carry it as; no pair grows past the
+# one after the upper bound or the one after the largest index that /start and /fib accept
+NUMBER_MAX_BITS: int = max(UPPER_BOUND.bit_length() + 2, FIB_MAX_INDEX * 7 // 10 + 2)
+NUMBER_MAX_DIGITS: int = NUMBER_MAX_BITS * 31 // 100 + 1
+if 0 < get_int_max_str_digits() < NUMBER_MAX_DIGITS:
+    set_int_max_str_digits(NUMBER_MAX_DIGITS)
+
+# Set whether the app is imported once in the gunicorn master and shared with the forked workers
+PRELOAD: bool = str(RUNTIME_CONFIG['preload']).lower() == 'true'
+
+# Set where the healthcheck probe finds the server endpoint and TLS materials
+PROBE_PATH: str = RUNTIME_CONFIG['probe']['path']
+
 # Set CA locations
 TLS_CA_KEY_PATH: str = RUNTIME_CONFIG['tls']['ca']['keyPath']
 TLS_CA_CERT_PATH: str = RUNTIME_CONFIG['tls']['ca']['certPath']
 
+# Set where generated TLS materials are cached between restarts and how long before expiry they are renewed
+TLS_CACHE_PATH: str = RUNTIME_CONFIG['tls']['cache']['path']
+TLS_CACHE_RENEW_SECONDS: float = float(RUNTIME_CONFIG['tls']['cache']['renewSecs'])
+
 # Set TLS creation settings
 TLS_GEN_CA_SUFFIX: str = RUNTIME_CONFIG['tls']['gen']['caSuffix']
 TLS_GEN_CERT_DAYS: int = int(RUNTIME_CONFIG['tls']['gen']['certDays'])
@@ -210,6 +308,9 @@ TLS_GEN_KEY_LENGTH: int = int(RUNTIME_CONFIG['tls']['gen']['keyLength'])
 TLS_GEN_PUBLIC_EXPONENT: int = int(RUNTIME_CONFIG['tls']['gen']['pubExponent'])
 TLS_GEN_SECRET_TARGET: str = RUNTIME_CONFIG['tls']['gen']['secretTarget']
 
+# Set whether TLS sessions are resumed; the setting may come from the environment as text
+TLS_RESUMPTION: bool = str(RUNTIME_CONFIG['tls']['resumption']).lower() == 'true'
+
 # Set Subject Alternative Names
 TLS_SAN_IPS: str = RUNTIME_CONFIG['tls']['san']['ips']
 TLS_SAN_NAMES: str = RUNTIME_CONFIG['tls']['san']['names']
@@ -220,11 +321,78 @@ SECRET_CERT_TARGET: str = f'{TLS_GEN_SECRET_TARGET}.{TLS_GEN_EXT_CERT}'
 SECRET_PEM_TARGET: str = f'{TLS_GEN_SECRET_TARGET}.{TLS_GEN_EXT_PEM}'
 
 
-def create_tls_materials():
-    # Read in CA TLS materials
+# Keep the timer that renews the cached TLS materials ahead of expiry
+TLS_RENEWAL_TIMER: Union[Timer, None] = None
+
+
+def get_tls_cache_file(ca_cert: x509.Certificate, san_names: list[str], san_ips: list[str]) -> str:
+    # Address the cache entry by everything that goes into the materials so changed inputs never reuse stale ones
+    cache_inputs: dict = {
+        'caFingerprint': ca_cert.fingerprint(hashes.SHA256()).hex(),
+        'sanNames': san_names,
+        'sanIps': san_ips,
+        'certDays': TLS_GEN_CERT_DAYS,
+        'keyLength': TLS_GEN_KEY_LENGTH,
+        'pubExponent': TLS_GEN_PUBLIC_EXPONENT
+    }
+    return f'{TLS_CACHE_PATH}/{sha256(dumps(cache_inputs).encode()).hexdigest()}.{TLS_GEN_EXT_PEM}'
+
+
+def load_cached_key_cert(cache_file: str) -> Union[tuple[RSAPrivateKey, x509.Certificate], None]:
+    # Read the cached key and certificate; anything missing, unreadable or expired is treated as a miss
+    if not exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as pem_file:
+            pem_bytes: bytes = pem_file.read()
+        # The key was written by a server and is matched against its certificate, so skip the slow RSA checks
+        key: RSAPrivateKey = serialization.load_pem_private_key(pem_bytes, None, unsafe_skip_rsa_key_validation=True)
+        cert: x509.Certificate = x509.load_pem_x509_certificate(pem_bytes)
+    except (OSError, ValueError):
+        return None
+    if cert.not_valid_after_utc <= datetime.now(timezone.utc) or cert.public_key() != key.public_key():
+        return None
+    return key, cert
+
+
+def save_cached_key_cert(cache_file: str, key: RSAPrivateKey, cert: x509.Certificate) -> None:
+    # Write the entry under a temporary name first so stages sharing the cache never read half of one
+    key_str: str = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption()
+    ).decode()
+    cert_str: str = cert.public_bytes(serialization.Encoding.PEM).decode()
+
+    # The temporary name is unique across containers sharing the cache, and the file is only readable by its owner
+    makedirs(TLS_CACHE_PATH, exist_ok=True)
+    temp_fd, temp_file = mkstemp(dir=TLS_CACHE_PATH, suffix='.tmp')
+    try:
+        with fdopen(temp_fd, 'w') as pem_file:
+            pem_file.write(f'{cert_str}\n{key_str}')
+        replace(temp_file, cache_file)
+    except OSError:
+        remove(temp_file)
+        raise
+
+
+def load_ca_key() -> RSAPrivateKey:
+    # Read in the CA key used to sign the server certificate
     with open(TLS_CA_KEY_PATH, 'rb') as ca_key_file:
-        ca_key = serialization.load_pem_private_key(ca_key_file.read(), None)
+        return serialization.load_pem_private_key(ca_key_file.read(), None)
+
+
+def get_tls_renewal_delay(cert: x509.Certificate) -> float:
+    # Renew ahead of expiry, but never so early that a freshly generated certificate is already due
+    renew_seconds: float = min(TLS_CACHE_RENEW_SECONDS, TLS_GEN_CERT_DAYS * 86400 / 2)
+    renew_time: datetime = cert.not_valid_after_utc - timedelta(seconds=renew_seconds)
+    return max((renew_time - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
 
+def create_tls_materials(on_renewal: Union[Callable[[], None], None] = None):
+    global TLS_RENEWAL_TIMER
+
+    # Read in the CA certificate; the CA key is only read when something has to be signed
     with open(TLS_CA_CERT_PATH, 'rb') as ca_cert_file:
         ca_cert = x509.load_pem_x509_certificate(ca_cert_file.read())
 
@@ -235,9 +403,63 @@ def create_tls_materials():
         x509.NameAttribute(NameOID.COUNTRY_NAME, 'US'),
         x509.NameAttribute(NameOID.COMMON_NAME, external_alt_names[0]),
     ])
-    create_key_cert(
-        subject=external_subject, san_names=external_alt_names, san_ips=external_alt_ips, cert_days=TLS_GEN_CERT_DAYS,
+    if not TLS_CACHE_PATH:  # Without a cache every start generates its own materials
+        create_key_cert(
+            subject=external_subject, san_names=external_alt_names, san_ips=external_alt_ips,
+            cert_days=TLS_GEN_CERT_DAYS, public_exponent=TLS_GEN_PUBLIC_EXPONENT, key_length=TLS_GEN_KEY_LENGTH,
+            filename=TLS_GEN_SECRET_TARGET, key_ext=TLS_GEN_EXT_KEY, cert_ext=TLS_GEN_EXT_CERT,
+            pem_ext=TLS_GEN_EXT_PEM, issuer_key=load_ca_key(), issuer_cert=ca_cert, ca_suffix=TLS_GEN_CA_SUFFIX,
+            is_key_encrypter=True
+        )
+        return
+
+    # Reuse the cached materials while they are valid and only generate them on a miss
+    cache_file: str = get_tls_cache_file(ca_cert, external_alt_names, external_alt_ips)
+    cached: Union[tuple[RSAPrivateKey, x509.Certificate], None] = load_cached_key_cert(cache_file)
+    if cached is None:
+        cached = renew_tls_materials(cache_file, external_subject, external_alt_names, external_alt_ips, ca_cert)
+    else:
+        save_key_cert(cached[0], cached[1], TLS_GEN_SECRET_TARGET, TLS_GEN_EXT_KEY, TLS_GEN_EXT_CERT,
+                      TLS_GEN_EXT_PEM, ca_cert, ca_suffix=TLS_GEN_CA_SUFFIX)
+
+    # Renew the materials in the background before they expire, replacing any timer from an earlier call
+    if TLS_RENEWAL_TIMER is not None:
+        TLS_RENEWAL_TIMER.cancel()
+    TLS_RENEWAL_TIMER = Timer(
+        get_tls_renewal_delay(cached[1]), renew_tls_materials,
+        args=(cache_file, external_subject, external_alt_names, external_alt_ips, ca_cert, on_renewal)
+    )
+    TLS_RENEWAL_TIMER.daemon = True
+    TLS_RENEWAL_TIMER.start()
+
+
+def renew_tls_materials(cache_file: str, subject: x509.Name, san_names: list[str], san_ips: list[str],
+                        ca_cert: x509.Certificate, on_renewal: Union[Callable[[], None], None] = None
+                        ) -> tuple[RSAPrivateKey, x509.Certificate]:
+    # Generate new materials, store them in the cache and put them where the server reads them
+    key, cert = create_key_cert(
+        subject=subject, san_names=san_names, san_ips=san_ips, cert_days=TLS_GEN_CERT_DAYS,
         public_exponent=TLS_GEN_PUBLIC_EXPONENT, key_length=TLS_GEN_KEY_LENGTH, filename=TLS_GEN_SECRET_TARGET,
-        key_ext=TLS_GEN_EXT_KEY, cert_ext=TLS_GEN_EXT_CERT, pem_ext=TLS_GEN_EXT_PEM, issuer_key=ca_key,
+        key_ext=TLS_GEN_EXT_KEY, cert_ext=TLS_GEN_EXT_CERT, pem_ext=TLS_GEN_EXT_PEM, issuer_key=load_ca_key(),
         issuer_cert=ca_cert, ca_suffix=TLS_GEN_CA_SUFFIX, is_key_encrypter=True
     )
+    save_cached_key_cert(cache_file, key, cert)
+
+    # Let the caller pick up the new materials
+    if on_renewal is not None:
+        on_renewal()
+    return key, cert
+
+
+def create_probe_file() -> None:
+    # Write what the probe needs once so it can run on the standard library alone instead of loading this module
+    probe_settings: dict = {
+        'address': NETWORK_SELF_ADDRESS_HEALTHCHECK,
+        'port': NETWORK_SELF_PORT,
+        'caPath': abspath(TLS_CA_CERT_PATH),
+        'certPath': abspath(SECRET_CERT_TARGET),
+        'keyPath': abspath(SECRET_KEY_TARGET),
+        'timeoutSecs': NETWORK_TIMEOUT_READ_SECONDS
+    }
+    with open(PROBE_PATH, 'w') as probe_file:
+        dump(probe_settings, probe_file)
@@ -0,0 +1,139 @@
+from server_init import *
+from os import getpid, kill
+from mmap import mmap
+from multiprocessing import Lock
+from multiprocessing.synchronize import Lock as LockType
+from struct import Struct
+from time import time
+from typing import Union
+
+# Set the fixed layout of the shared segment: unsigned counters, a timestamp, then a length-prefixed log ID
+SHARED_COUNTERS: tuple[str, ...] = (
+    'steps', 'healthcheckSteps', 'sequencesStarted', 'sequencesCompleted', 'logCountServer', 'logCountDefault',
+    'logCountOperation', 'duplicatesDropped', 'subscriberPid', 'tlsClientHandshakes', 'tlsClientResumed',
+    'tlsServerHandshakes', 'tlsServerResumed'
+)
+SHARED_COUNTER_STRUCT: Struct = Struct('<Q')
+SHARED_TIME_STRUCT: Struct = Struct('<d')
+SHARED_LENGTH_STRUCT: Struct = Struct('<I')
+SHARED_TIME_OFFSET: int = SHARED_COUNTER_STRUCT.size * len(SHARED_COUNTERS)
+SHARED_LOG_ID_OFFSET: int = SHARED_TIME_OFFSET + SHARED_TIME_STRUCT.size
+SHARED_LOG_ID_SIZE: int = 512
+
+# Set the layout of each dedupe slot: key, expiry time, response code, then a length-prefixed log ID
+SHARED_DEDUPE_STRUCT: Struct = Struct('<QdHH')
+SHARED_DEDUPE_LOG_ID_SIZE: int = 256
+SHARED_DEDUPE_SLOT_SIZE: int = SHARED_DEDUPE_STRUCT.size + SHARED_DEDUPE_LOG_ID_SIZE
+
+
+# Wrap an anonymous shared mapping that forked workers inherit from the gunicorn master
+class SharedState:
+    def __init__(self) -> None:
+        self.buffer: mmap = mmap(-1, SHARED_LOG_ID_OFFSET + SHARED_LENGTH_STRUCT.size + SHARED_LOG_ID_SIZE)
+        self.lock: LockType = Lock()
+        self.set_log_id('N/A')
+
+        # Only reserve dedupe slots when workers share the cache
+        self.dedupe_buffer: Union[mmap, None] = None
+        if DEDUPE_SCOPE == 'container':
+            self.dedupe_buffer = mmap(-1, DEDUPE_MAX_ENTRIES * SHARED_DEDUPE_SLOT_SIZE)
+
+    def get_counter(self, name: str) -> int:
+        offset: int = SHARED_COUNTERS.index(name) * SHARED_COUNTER_STRUCT.size
+        return SHARED_COUNTER_STRUCT.unpack_from(self.buffer, offset)[0]
+
+    def set_counter(self, name: str, value: int) -> None:
+        offset: int = SHARED_COUNTERS.index(name) * SHARED_COUNTER_STRUCT.size
+        SHARED_COUNTER_STRUCT.pack_into(self.buffer, offset, value)
+
+    def get_log_id(self) -> str:
+        length: int = SHARED_LENGTH_STRUCT.unpack_from(self.buffer, SHARED_LOG_ID_OFFSET)[0]
+        start: int = SHARED_LOG_ID_OFFSET + SHARED_LENGTH_STRUCT.size
+        return self.buffer[start:start + length].decode()
+
+    def set_log_id(self, log_id: str) -> None:
+        # Keep the head of IDs that do not fit in the slot
+        log_id_bytes: bytes = log_id.encode()[:SHARED_LOG_ID_SIZE]
+        SHARED_LENGTH_STRUCT.pack_into(self.buffer, SHARED_LOG_ID_OFFSET, len(log_id_bytes))
+        start: int = SHARED_LOG_ID_OFFSET + SHARED_LENGTH_STRUCT.size
+        self.buffer[start:start + len(log_id_bytes)] = log_id_bytes
+
+    def increment(self, name: str, amount: int = 1) -> int:
+        with self.lock:
+            value: int = self.get_counter(name) + amount
+            self.set_counter(name, value)
+            return value
+
+    def record_step(self, log_id: str) -> int:
+        # Count the step and remember it as the latest one in the container
+        with self.lock:
+            steps: int = self.get_counter('steps') + 1
+            self.set_counter('steps', steps)
+            SHARED_TIME_STRUCT.pack_into(self.buffer, SHARED_TIME_OFFSET, time())
+            self.set_log_id(log_id)
+            return steps
+
+    def check_progress(self) -> tuple[bool, str]:
+        # Report whether any worker processed a step since the last healthcheck
+        with self.lock:
+            steps: int = self.get_counter('steps')
+            has_progressed: bool = steps != self.get_counter('healthcheckSteps')
+            self.set_counter('healthcheckSteps', steps)
+            return has_progressed, self.get_log_id()
+
+    def get_dedupe(self, key: int) -> Union[tuple[int, str], None]:
+        # Each key maps to one slot, so a colliding key simply replaces the older entry
+        offset: int = key % DEDUPE_MAX_ENTRIES * SHARED_DEDUPE_SLOT_SIZE
+        with self.lock:
+            slot_key, expires, return_code, length = SHARED_DEDUPE_STRUCT.unpack_from(self.dedupe_buffer, offset)
+            if slot_key != key or expires < time():
+                return None
+            start: int = offset + SHARED_DEDUPE_STRUCT.size
+            return return_code, self.dedupe_buffer[start:start + length].decode()
+
+    def set_dedupe(self, key: int, expires: float, return_code: int, log_id: str) -> None:
+        offset: int = key % DEDUPE_MAX_ENTRIES * SHARED_DEDUPE_SLOT_SIZE
+        log_id_bytes: bytes = log_id.encode()[:SHARED_DEDUPE_LOG_ID_SIZE]
+        with self.lock:
+            SHARED_DEDUPE_STRUCT.pack_into(self.dedupe_buffer, offset, key, expires, return_code, len(log_id_bytes))
+            start: int = offset + SHARED_DEDUPE_STRUCT.size
+            self.dedupe_buffer[start:start + len(log_id_bytes)] = log_id_bytes
+
+    def claim_subscriber(self) -> bool:
+        # Let one live worker own the container's subscription; a replacement worker takes over from a dead owner
+        with self.lock:
+            owner_pid: int = self.get_counter('subscriberPid')
+            if owner_pid not in [0, getpid()]:
+                try:
+                    kill(owner_pid, 0)
+                    return False
+                except ProcessLookupError:
+                    pass
+            self.set_counter('subscriberPid', getpid())
+            return True
+
+    def get_snapshot(self) -> dict:
+        with self.lock:
+            snapshot: dict = {name: self.get_counter(name) for name in SHARED_COUNTERS}
+            snapshot['lastStepTime'] = SHARED_TIME_STRUCT.unpack_from(self.buffer, SHARED_TIME_OFFSET)[0]
+            snapshot['lastLogId'] = self.get_log_id()
+            return snapshot
+
+
+# Set up the container-wide state
+SHARED_STATE: Union[SharedState, None] = None
+
+
+def create_shared_state() -> SharedState:
+    global SHARED_STATE
+
+    # Create the segment once; the gunicorn master calls this before forking workers
+    if SHARED_STATE is None:
+        SHARED_STATE = SharedState()
+
+    return SHARED_STATE
+
+
+def get_shared_state() -> SharedState:
+    # Processes started outside of gunicorn get a private segment
+    return create_shared_state()
@@ -0,0 +1,192 @@
+from server_init import *
+from flask import Flask, request as flask_request
+from requests import RequestException, Response
+from typing import Union
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import get_dest_url, send_request
+from send_utils import get_executor
+from soap_utils import (ADVANCE_ACTION, SOAP_CHUNK_SIZE, SOAP_CONTENT_TYPE, get_soap_actions, parse_advance,
+                        render_advance_request, render_advance_response, render_fault, render_wsdl)
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, create_server_identifier, start_worker,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         register_routes)
+
+# Create a server identifier
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings; a preloaded app is started by the post_fork hook in each worker
+if not PRELOAD:
+    start_worker(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
+SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
+
+# Read the accepted SOAP actions from the service description once per worker
+SOAP_ACTIONS: dict[str, str] = get_soap_actions()
+
+# Create app object
+app = Flask(__name__)
+
+
+# Define a sending thread
+def trigger_send(new_fib_one: int, new_fib_two: int, steps: int, sequence_id: str, snf_log_id: str) -> None:
+    global SERVER_IDENTIFIER
+
+    body: bytes = render_advance_request(
+        {'fib_one': new_fib_one, 'fib_two': new_fib_two, 'steps': steps, 'sequence': sequence_id}
+    )
+    try:
+        response: Response = send_request(
+            method='POST',
+            url=get_dest_url(),
+            data=body,
+            headers={'Content-Type': SOAP_CONTENT_TYPE, 'SOAPAction': f'"{ADVANCE_ACTION}"'}
+        )
+    except RequestException as e:
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Experienced Request Exception for message ID {snf_log_id}. Details: {e}')
+        return
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+               f'Return code for message ID {snf_log_id}: {response.status_code}')
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+               f'Return info for message ID {snf_log_id}: {response.text}')
+
+
+# Define a SOAP response; envelopes come from pre-rendered templates instead of being built element by element
+def create_soap_response(body: bytes, return_code: int, headers: Union[dict, None] = None) -> tuple[bytes, int, dict]:
+    return body, return_code, {'Content-Type': SOAP_CONTENT_TYPE, **(headers or {})}
+
+
+# Define a fault for when the send queue cannot take more work
+def reject_busy_fault() -> tuple[bytes, int, dict]:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    get_executor().record_rejection()
+    msg: str = 'POST request rejected. Send queue is full.'
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return create_soap_response(render_fault(False, msg, SNF_LOG_ID), 503,
+                                {'Retry-After': str(SENDER_RETRY_AFTER_SECONDS)})
+
+
+# Create service description logic
+@app.route('/', methods=['GET'])
+def get_wsdl() -> tuple[bytes, int, dict]:
+    # Serve the description rendered for the address it was asked for
+    return render_wsdl(flask_request.url_root), 200, {'Content-Type': SOAP_CONTENT_TYPE}
+
+
+# Create route processing logic
+@app.route('/', methods=['POST'])
+def process_fib_numbers() -> tuple[bytes, int, dict]:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Shed load before doing any work if sends are backed up
+    if get_executor().is_full():
+        return reject_busy_fault()
+
+    # Refuse actions the service description does not list; an empty action leaves it to the body
+    soap_action: str = flask_request.headers.get('SOAPAction', '').strip('"')
+    if soap_action and soap_action not in SOAP_ACTIONS:
+        msg: str = f'POST request failed. Unknown SOAP action {soap_action}.'
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+        return create_soap_response(render_fault(True, msg, SNF_LOG_ID), 500)
+
+    # Get and ingest numbers by parsing the envelope while it is still being read
+    try:
+        fib_numbers: Union[dict, None] = parse_advance(iter(lambda: flask_request.stream.read(SOAP_CHUNK_SIZE), b''))
+        fib_one: int = int(fib_numbers['fib_one'])
+        fib_two: int = int(fib_numbers['fib_two'])
+        steps: int = get_requested_steps(fib_numbers)
+        sequence_id: str = str(fib_numbers.get('sequence', DEFAULT_SEQUENCE_ID))
+    except (KeyError, ValueError, TypeError):
+        msg: str = f'POST request failed. Unable to retrieve numbers.'
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+        return create_soap_response(render_fault(True, msg, SNF_LOG_ID), 500)
+
+    # Answer a repeat of a recently handled message with the original response and do nothing else
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    original_response: Union[tuple[int, str], None] = get_original_response(dedupe_key)
+    if original_response is not None:
+        get_shared_state().increment('duplicatesDropped')
+        return_code, log_id = original_response
+        return create_soap_response(
+            render_advance_response(return_code, 'Success', POST_SUCCESS_MESSAGES[return_code], log_id, sequence_id),
+            return_code
+        )
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+               f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
+
+    # Decide on a response to send back
+    if new_fib_one < UPPER_BOUND:  # Forward to the next server in line once the throttle interval passes
+        if not get_executor().submit(trigger_send, new_fib_one, new_fib_two, steps, sequence_id, snf_log_id,
+                                     delay=THROTTLE_SECONDS):
+            return reject_busy_fault()
+        return_code: int = 202
+    else:  # Return that the upper bound has been reached
+        return_code: int = 200
+
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
+
+    # Remember the response in case the same message is sent again
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    msg: str = POST_SUCCESS_MESSAGES[return_code]
+
+    # Send the response back
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return create_soap_response(render_advance_response(return_code, 'Success', msg, SNF_LOG_ID, sequence_id),
+                                return_code)
+
+
+def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+    return get_executor().submit(trigger_send, fib_one, fib_two, STEPS_DEFAULT, sequence_id, start_log_id)
+
+
+def start_sequences(start_index: Union[int, None], count: int, method: str) -> tuple[int, str, str, list[str]]:
+    global SNF_LOG_ID
+
+    return_code, status, msg, sequence_ids, start_log_id = launch_sequences(
+        SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, method, submit_start
+    )
+
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    return return_code, status, msg, sequence_ids
+
+
+def get_log_id() -> str:
+    return SNF_LOG_ID
+
+
+# Add the control routes every stage shares
+register_routes(app, SERVER_IDENTIFIER, SEQUENCE_TABLE, get_log_id, start_sequences)
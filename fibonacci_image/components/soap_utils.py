@@ -0,0 +1,150 @@
+from collections.abc import Iterable
+from functools import lru_cache
+from xml.etree.ElementTree import Element, ParseError, XMLPullParser, fromstring
+from xml.sax.saxutils import escape
+from codec_utils import encode_number, decode_number
+
+# Set the content type, namespaces, and action of the stage service
+SOAP_CONTENT_TYPE: str = 'text/xml; charset=utf-8'
+SOAP_ENVELOPE_NS: str = 'http://schemas.xmlsoap.org/soap/envelope/'
+STAGE_NS: str = 'urn:fibonacci:stage'
+WSDL_NS: str = 'http://schemas.xmlsoap.org/wsdl/'
+WSDL_SOAP_NS: str = 'http://schemas.xmlsoap.org/wsdl/soap/'
+ADVANCE_ACTION: str = f'{STAGE_NS}#Advance'
+
+# Read incoming envelopes in pieces of this many bytes
+SOAP_CHUNK_SIZE: int = 16384
+
+# Map the elements of an Advance request to the dictionary shape the other wire formats produce
+ADVANCE_FIELDS: dict[str, str] = {'fibOne': 'fib_one', 'fibTwo': 'fib_two', 'steps': 'steps', 'sequence': 'sequence'}
+
+# Render the fixed parts of every envelope once; only the values are filled in per message
+ENVELOPE_OPEN: str = f'<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="{SOAP_ENVELOPE_NS}"><soap:Body>'
+ENVELOPE_CLOSE: str = '</soap:Body></soap:Envelope>'
+ADVANCE_REQUEST_TEMPLATE: str = (
+    ENVELOPE_OPEN + f'<Advance xmlns="{STAGE_NS}">'
+    + '<fibOne>{fib_one}</fibOne><fibTwo>{fib_two}</fibTwo><steps>{steps}</steps><sequence>{sequence}</sequence>'
+    + '</Advance>' + ENVELOPE_CLOSE
+)
+ADVANCE_RESPONSE_TEMPLATE: str = (
+    ENVELOPE_OPEN + f'<AdvanceResponse xmlns="{STAGE_NS}">'
+    + '<code>{code}</code><status>{status}</status><message>{message}</message><result>{result}</result>'
+    + '<sequence>{sequence}</sequence></AdvanceResponse>' + ENVELOPE_CLOSE
+)
+FAULT_TEMPLATE: str = (
+    ENVELOPE_OPEN + '<soap:Fault><faultcode>soap:{fault_code}</faultcode><faultstring>{message}</faultstring>'
+    + f'<detail><result xmlns="{STAGE_NS}">' + '{result}</result></detail></soap:Fault>' + ENVELOPE_CLOSE
+)
+
+# Describe the service; numbers travel as big-endian hexBinary so they need no decimal conversion
+WSDL_TEMPLATE: str = f'''<?xml version="1.0" encoding="utf-8"?>
+<definitions xmlns="{WSDL_NS}" xmlns:soap="{WSDL_SOAP_NS}" xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+             xmlns:tns="{STAGE_NS}" targetNamespace="{STAGE_NS}" name="FibonacciStage">
+  <types>
+    <xsd:schema targetNamespace="{STAGE_NS}" elementFormDefault="qualified">
+      <xsd:element name="Advance">
+        <xsd:complexType><xsd:sequence>
+          <xsd:element name="fibOne" type="xsd:hexBinary"/>
+          <xsd:element name="fibTwo" type="xsd:hexBinary"/>
+          <xsd:element name="steps" type="xsd:unsignedInt" minOccurs="0"/>
+          <xsd:element name="sequence" type="xsd:string" minOccurs="0"/>
+        </xsd:sequence></xsd:complexType>
+      </xsd:element>
+      <xsd:element name="AdvanceResponse">
+        <xsd:complexType><xsd:sequence>
+          <xsd:element name="code" type="xsd:unsignedShort"/>
+          <xsd:element name="status" type="xsd:string"/>
+          <xsd:element name="message" type="xsd:string"/>
+          <xsd:element name="result" type="xsd:string"/>
+          <xsd:element name="sequence" type="xsd:string"/>
+        </xsd:sequence></xsd:complexType>
+      </xsd:element>
+    </xsd:schema>
+  </types>
+  <message name="AdvanceInput"><part name="parameters" element="tns:Advance"/></message>
+  <message name="AdvanceOutput"><part name="parameters" element="tns:AdvanceResponse"/></message>
+  <portType name="StagePortType">
+    <operation name="Advance"><input message="tns:AdvanceInput"/><output message="tns:AdvanceOutput"/></operation>
+  </portType>
+  <binding name="StageBinding" type="tns:StagePortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="Advance">
+      <soap:operation soapAction="{ADVANCE_ACTION}"/>
+      <input><soap:body use="literal"/></input>
+      <output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="StageService">
+    <port name="StagePort" binding="tns:StageBinding"><soap:address location="{{address}}"/></port>
+  </service>
+</definitions>
+'''
+
+
+@lru_cache(maxsize=8)
+def render_wsdl(address: str) -> bytes:
+    # Render the service description once per address it is requested from
+    return WSDL_TEMPLATE.format(address=escape(address, {'"': '&quot;'})).encode()
+
+
+@lru_cache(maxsize=1)
+def get_soap_actions() -> dict[str, str]:
+    # Read the accepted actions out of the service description once instead of on every request
+    definitions: Element = fromstring(WSDL_TEMPLATE.format(address='').encode())
+    return {
+        operation.get('soapAction'): operation_parent.get('name')
+        for operation_parent in definitions.iterfind(f'{{{WSDL_NS}}}binding/{{{WSDL_NS}}}operation')
+        for operation in operation_parent.iterfind(f'{{{WSDL_SOAP_NS}}}operation')
+    }
+
+
+def render_advance_request(fib_numbers: dict) -> bytes:
+    return ADVANCE_REQUEST_TEMPLATE.format(
+        fib_one=encode_number(int(fib_numbers['fib_one'])).hex(),
+        fib_two=encode_number(int(fib_numbers['fib_two'])).hex(),
+        steps=int(fib_numbers['steps']),
+        sequence=escape(str(fib_numbers['sequence']))
+    ).encode()
+
+
+def render_advance_response(return_code: int, status: str, msg: str, log_id: str, sequence_id: str) -> bytes:
+    return ADVANCE_RESPONSE_TEMPLATE.format(
+        code=return_code, status=status, message=escape(msg), result=escape(log_id), sequence=escape(sequence_id)
+    ).encode()
+
+
+def render_fault(is_client_fault: bool, msg: str, log_id: str) -> bytes:
+    return FAULT_TEMPLATE.format(
+        fault_code='Client' if is_client_fault else 'Server', message=escape(msg), result=escape(log_id)
+    ).encode()
+
+
+def parse_advance(chunks: Iterable[bytes]) -> dict:
+    # Feed the envelope to the parser as it arrives and stop as soon as the Advance element closes
+    parser: XMLPullParser = XMLPullParser(events=('end',))
+    fields: dict[str, str] = {}
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                name: str = element.tag.rpartition('}')[2]
+                if name in ADVANCE_FIELDS:
+                    fields[ADVANCE_FIELDS[name]] = element.text or ''
+                elif name == 'Advance':
+                    return convert_advance(fields)
+    except ParseError as e:
+        raise ValueError(f'Envelope is not well-formed XML. Details: {e}')
+    raise ValueError('Envelope has no Advance element.')
+
+
+def convert_advance(fields: dict[str, str]) -> dict:
+    # Turn the element text into numbers, keeping only the optional fields that were sent
+    if 'fib_one' not in fields or 'fib_two' not in fields:
+        raise ValueError('Advance element must carry fibOne and fibTwo.')
+    fib_numbers: dict = {'fib_one': decode_number(bytes.fromhex(fields['fib_one'])),
+                         'fib_two': decode_number(bytes.fromhex(fields['fib_two']))}
+    if 'steps' in fields:
+        fib_numbers['steps'] = int(fields['steps'])
+    if 'sequence' in fields:
+        fib_numbers['sequence'] = fields['sequence']
+    return fib_numbers
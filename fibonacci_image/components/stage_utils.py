@@ -0,0 +1,364 @@
+from server_init import *
+from os import getpid, name
+from platform import win32_ver, freedesktop_os_release
+from sys import version
+from collections.abc import Callable, Mapping
+from typing import Union
+from flask import Flask, Response, request as flask_request, jsonify
+from datastore_utils import APIType, DatastoreType, LogType, LogKind, report_log, save_log
+from network_utils import get_breaker_stats, get_tls_stats
+from send_utils import AsyncBoundedExecutor, BoundedExecutor, get_executor
+from codec_utils import WireFormat
+from fib_utils import get_fib_pair, render_fib_number
+from sequence_utils import SequenceTable, create_sequence_id
+from shared_utils import get_shared_state
+from dedupe_utils import DedupeScope
+
+# Set the success responses of the default route by return code so repeated messages get the same answer
+POST_SUCCESS_MESSAGES: dict[int, str] = {
+    200: 'POST request succeeded. Reached upper bound.',
+    202: 'POST request succeeded. Sent off fibonacci numbers.'
+}
+
+
+def check_ready(is_sender_full: bool, checks: dict[str, bool] = None) -> tuple[dict, int]:
+    # Report ready while the sender takes new work and every API specific check passes; nothing touches the datastore
+    checks: dict[str, bool] = {'sender': not is_sender_full, **(checks or {})}
+    if all(checks.values()):
+        return {'status': 'Success', 'checks': checks}, 200
+    else:
+        return {'status': 'Fail', 'checks': checks}, 503
+
+
+def create_server_identifier() -> dict:
+    # Create a server identifier
+    if name == 'nt':
+        os_version: str = f'Windows {win32_ver()[0]}.{win32_ver()[1]}'
+    else:
+        os_version: str = f'{freedesktop_os_release()['PRETTY_NAME']}'
+
+    return {
+        'PYTHON_VERSION': version,
+        'OS_VERSION': os_version,
+        'WORKER_PID': getpid(),
+        'API': API,
+        'DATASTORE_TYPE': DATASTORE_TYPE,
+        'STAGE_INDEX': STAGE_INDEX
+    }
+
+
+def start_worker(server_id: dict) -> None:
+    # Stamp the identifier with this worker's PID, since a preloaded app was imported by the master
+    server_id['WORKER_PID'] = getpid()
+    report_startup(server_id)
+
+
+def report_startup(server_id: dict) -> None:
+    # Create log from the server identifier
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id, f'The server identifier is {server_id}')
+
+    # Create log from the datastore filepaths
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'The datastore default server log location is {DATASTORE_LOGS_DEFAULT_PATH}.')
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'The datastore operations log location is {DATASTORE_LOGS_OPERATION_PATH}.')
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'The datastore server log location is {DATASTORE_LOGS_SERVER_PATH}.')
+
+    # Create log from the server API
+    assert API in [member.value for member in APIType]
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id, f'The server API is {API}.')
+
+    # Get the server datastore
+    assert DATASTORE_TYPE in [member.value for member in DatastoreType]
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id, f'The server datastore is {DATASTORE_TYPE}.')
+
+    # Get the server count
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Total amount of servers in the network is {STAGE_COUNT}.')
+
+    # Get the server index
+    assert 0 < STAGE_INDEX <= STAGE_COUNT
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id, f'Server index validated. Index is {STAGE_INDEX}.')
+
+    # Get destination socket
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Destination socket created. Socket is {NETWORK_DEST_ADDRESS} at port {NETWORK_DEST_PORT}.')
+
+    # Get the Unix domain sockets shared with stages in the same pod
+    if NETWORK_SELF_SOCKET_PATH or NETWORK_DEST_SOCKET_PATH:
+        report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+                   f'Unix domain sockets in use. Listening on {NETWORK_SELF_SOCKET_PATH or "none"}, sending to '
+                   f'{NETWORK_DEST_SOCKET_PATH or "none"}, TLS is {"on" if NETWORK_SOCKET_TLS else "off"}.')
+
+    # Get outbound timeouts, retries, and the circuit breaker
+    assert NETWORK_RETRY_ATTEMPTS > 0 and NETWORK_BREAKER_FAILURE_THRESHOLD > 0
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Outbound requests time out after {NETWORK_TIMEOUT_CONNECT_SECONDS} second(s) to connect and '
+               f'{NETWORK_TIMEOUT_READ_SECONDS} second(s) to read, with up to {NETWORK_RETRY_ATTEMPTS} attempt(s).')
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Circuit breakers open after {NETWORK_BREAKER_FAILURE_THRESHOLD} failure(s) and retry after '
+               f'{NETWORK_BREAKER_RESET_SECONDS} second(s).')
+
+    # Get throttle time
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Throttle interval set to {THROTTLE_SECONDS} second(s).')
+
+    # Get the upper bound
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id, f'Upper bound of test set to {UPPER_BOUND}.')
+
+    # Get the steps per message
+    assert 0 < STEPS_DEFAULT <= STEPS_MAX
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Steps per message set to {STEPS_DEFAULT} with a maximum of {STEPS_MAX}.')
+
+    # Get the size above which logged numbers are summarized
+    assert FIB_LOG_MAX_DIGITS >= 10
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Numbers longer than {FIB_LOG_MAX_DIGITS} digits are summarized in logs.')
+
+    # Get the dedupe cache settings
+    assert DEDUPE_SCOPE in [member.value for member in DedupeScope]
+    assert DEDUPE_MAX_ENTRIES > 0 and DEDUPE_TTL_SECONDS > 0
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+               f'Repeated messages are deduplicated per {DEDUPE_SCOPE} for {DEDUPE_TTL_SECONDS} second(s) across '
+               f'{DEDUPE_MAX_ENTRIES} entries.')
+
+    # Get the wire format
+    assert WIRE_FORMAT in [member.value for member in WireFormat]
+    report_log(LogType.OPERATION, [LogKind.ONSTART], server_id, f'Messages between stages are sent as {WIRE_FORMAT}.')
+
+    # Get the GraphQL batching and caching settings
+    if API == APIType.GRAPHQL:
+        assert GRAPHQL_BATCH_SIZE > 0 and GRAPHQL_DOCUMENT_CACHE_SIZE > 0 and GRAPHQL_OUTBOX_SIZE >= GRAPHQL_BATCH_SIZE
+        report_log(LogType.OPERATION, [LogKind.ONSTART], server_id,
+                   f'GraphQL batches carry up to {GRAPHQL_BATCH_SIZE} pair(s) and {GRAPHQL_DOCUMENT_CACHE_SIZE} parsed '
+                   f'document(s) are kept. The outbox holds up to {GRAPHQL_OUTBOX_SIZE} pair(s).')
+
+
+def create_step_log_id(fib_one: int, fib_two: int) -> str:
+    # Name a step after its pair, summarizing numbers too large to log in full
+    return f'{STAGE_INDEX}-{render_fib_number(fib_one)}-{render_fib_number(fib_two)}'
+
+
+def get_next_fib_numbers(fib_one: int, fib_two: int) -> tuple[int, int]:
+    # Create new numbers
+    if fib_two > 0:  # The sequence already started
+        return fib_two, fib_one + fib_two
+    else:  # The sequence just started
+        return 0, 1
+
+
+def get_requested_steps(fib_numbers: dict) -> int:
+    # Use the stage default when the message does not ask for a step count and cap it to the stage maximum
+    try:
+        steps: int = int(fib_numbers.get('steps', STEPS_DEFAULT))
+    except (TypeError, ValueError):
+        raise ValueError('Steps must be an integer.') from None
+    return max(1, min(steps, STEPS_MAX))
+
+
+def get_next_fib_batch(fib_one: int, fib_two: int, steps: int) -> list[tuple[int, int]]:
+    # Advance the sequence several steps at once, stopping early at the upper bound
+    fib_pairs: list[tuple[int, int]] = []
+    for _ in range(steps):
+        fib_one, fib_two = get_next_fib_numbers(fib_one, fib_two)
+        fib_pairs.append((fib_one, fib_two))
+        if fib_one >= UPPER_BOUND:
+            break
+
+    return fib_pairs
+
+
+# Define a response for when the send queue cannot take more work
+def reject_busy(server_id: dict, log_id: str, log_kind: LogKind, method: str) -> tuple[Response, int, dict]:
+    get_executor().record_rejection()
+    msg: str = f'{method} request rejected. Send queue is full.'
+    report_log(LogType.SEND, [LogKind.ONCALL, log_kind], server_id, msg)
+    return (jsonify({'status': 'Fail', 'message': msg, 'result': log_id, 'sender': get_executor().get_stats()}),
+            503, {'Retry-After': str(SENDER_RETRY_AFTER_SECONDS)})
+
+
+def launch_sequences(server_id: dict, sequence_table: SequenceTable, start_index: Union[int, None], count: int,
+                     method: str, submit_start: Callable[[int, int, str, str], bool],
+                     executor: Union[BoundedExecutor, AsyncBoundedExecutor, None] = None
+                     ) -> tuple[int, str, str, list[str], str]:
+    # Check room against the executor the starts are submitted to; the Flask stages share the thread pool
+    if executor is None:
+        executor = get_executor()
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.START], server_id, f'{method} request received.')
+
+    # Check the starting index and the number of sequences
+    if start_index is not None and not 0 <= start_index <= FIB_MAX_INDEX:
+        msg: str = f'{method} request failed. Starting index must be an integer between 0 and {FIB_MAX_INDEX}.'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.START], server_id, msg)
+        return 422, 'Fail', msg, [], ''
+    if not 0 < count <= SEQUENCES_MAX_START:
+        msg: str = f'{method} request failed. Sequence count must be an integer between 1 and {SEQUENCES_MAX_START}.'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.START], server_id, msg)
+        return 422, 'Fail', msg, [], ''
+
+    # Refuse more sequences than the send queue can take right now instead of quietly starting fewer
+    free_slots: int = executor.get_free_slots()
+    if count > free_slots:
+        executor.record_rejection()
+        msg: str = f'{method} request rejected. Send queue only has room for {free_slots} more sequence(s).'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.START], server_id, msg)
+        return 503, 'Fail', msg, [], ''
+
+    # Start the sequence at 0 0 or inject the pair for a requested index
+    fib_one, fib_two = (0, 0) if start_index is None else get_fib_pair(start_index)
+
+    # Launch each sequence; a send queue filled by a concurrent request in the meantime still stops the loop
+    start_log_id: str = create_step_log_id(fib_one, fib_two)
+    sequence_ids: list[str] = []
+    for _ in range(count):
+        sequence_id: str = create_sequence_id()
+        if not submit_start(fib_one, fib_two, sequence_id, start_log_id):
+            break
+        sequence_table.update(sequence_id, start_log_id)
+        sequence_ids.append(sequence_id)
+
+    if not sequence_ids:
+        executor.record_rejection()
+        msg: str = f'{method} request rejected. Send queue is full.'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.START], server_id, msg)
+        return 503, 'Fail', msg, [], ''
+
+    get_shared_state().increment('sequencesStarted', len(sequence_ids))
+
+    msg: str = f'{method} request succeeded. Started {len(sequence_ids)} fibonacci sequence(s).'
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.START], server_id, msg)
+    return 202, 'Success', msg, sequence_ids, start_log_id
+
+
+def parse_start_args(args: Mapping[str, str]) -> tuple[Union[int, None], int]:
+    # Turn bad arguments into out of range values so the shared checks reject them
+    start_arg: Union[str, None] = args.get('from')
+    count_arg: str = args.get('count', '1')
+    start_index: Union[int, None] = None if start_arg is None else int(start_arg) if start_arg.isdigit() else -1
+    count: int = int(count_arg) if count_arg.isdigit() else 0
+    return start_index, count
+
+
+def create_start_response(return_code: int, status: str, msg: str, sequence_ids: list[str], log_id: str,
+                          sender_stats: dict) -> tuple[dict, int, dict]:
+    # Tell a rejected caller when to come back and show it the send queue that turned it away
+    if return_code == 503:
+        return ({'status': status, 'message': msg, 'result': log_id, 'sender': sender_stats},
+                503, {'Retry-After': str(SENDER_RETRY_AFTER_SECONDS)})
+    return {'status': status, 'message': msg, 'result': log_id, 'sequences': sequence_ids}, return_code, {}
+
+
+def create_health_response(server_id: dict, sequence_table: SequenceTable, sender_stats: dict,
+                           extras: dict = None) -> tuple[dict, int]:
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.HEALTHCHECK], server_id, 'GET healthcheck request received.')
+
+    # Check whether any worker in the container processed a step since the last healthcheck
+    has_progressed, last_log_id = get_shared_state().check_progress()
+    if has_progressed:
+        msg: str = 'GET healthcheck request succeeded. Server has processed a new step.'
+    else:
+        msg: str = 'GET healthcheck request succeeded. Server is waiting for some reason.'
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.HEALTHCHECK], server_id, msg)
+
+    # Send the response back along with the container progress, send queue, sequences, breakers, TLS, and extras
+    return {'status': 'Success', 'message': msg, 'result': last_log_id, 'progress': get_shared_state().get_snapshot(),
+            'sender': sender_stats, 'sequences': sequence_table.get_progress(), 'breakers': get_breaker_stats(),
+            'tls': get_tls_stats(), **(extras or {})}, 200
+
+
+def create_fib_response(server_id: dict, fib_index: int, log_id: str, is_hex: bool) -> tuple[dict, int]:
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.FIB], server_id,
+               f'GET fib request received for index {fib_index}.')
+
+    # Check the index against the engine limit
+    if fib_index > FIB_MAX_INDEX:
+        msg: str = f'GET fib request failed. Index must be between 0 and {FIB_MAX_INDEX}.'
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.FIB], server_id, msg)
+        return {'status': 'Fail', 'message': msg, 'result': log_id}, 422
+
+    # Jump straight to the pair for the index
+    fib_one, fib_two = get_fib_pair(fib_index)
+    if is_hex:  # Hex has no digit limit, so it works for any index the logs refer to
+        fib_one, fib_two = hex(fib_one), hex(fib_two)
+    msg: str = f'GET fib request succeeded. Computed fibonacci number at index {fib_index}.'
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.FIB], server_id, msg)
+
+    return {'status': 'Success', 'message': msg, 'result': log_id, 'index': fib_index, 'fib_one': fib_one,
+            'fib_two': fib_two}, 200
+
+
+def create_datastore_response(server_id: dict, cur_log: Union[dict, None], log_id: str) -> tuple[dict, int]:
+    # Get log
+    if cur_log is None:
+        msg: str = f'POST datastore request failed. Unable to retrieve log.'
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.DATASTORE], server_id, msg)
+        return {'status': 'Fail', 'message': msg, 'result': log_id}, 422
+
+    # Save log to file
+    success, op_success = save_log(DATASTORE_LOGS_SERVER_PATH, cur_log, server_id)
+    if success and op_success:
+        status: str = 'Success'
+        msg: str = f'POST datastore request succeeded. Saved log.'
+        return_code: int = 200
+    elif success and not op_success:
+        status: str = 'Success'
+        msg: str = f'POST datastore request succeeded. Saved log. Subsequent operation log saving failed.'
+        return_code: int = 200
+    else:
+        status: str = 'Fail'
+        msg: str = f'POST datastore request failed. Saving log to file failed.'
+        return_code: int = 500
+
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.DATASTORE], server_id, msg)
+    return {'status': status, 'message': msg, 'result': log_id}, return_code
+
+
+def register_routes(app: Flask, server_id: dict, sequence_table: SequenceTable, get_log_id: Callable[[], str],
+                    start_sequences: Callable[[Union[int, None], int, str], tuple[int, str, str, list[str]]],
+                    get_ready_checks: Callable[[], dict[str, bool]] = dict,
+                    get_health_extras: Callable[[], dict] = dict) -> None:
+    # Add the control routes every Flask stage serves; the API specific parts come in through the callables
+
+    # Create liveness and readiness logic; both answer from memory and skip logging so frequent probes stay cheap
+    def get_livez() -> tuple[Response, int]:
+        return jsonify({'status': 'Success'}), 200
+
+    def get_readyz() -> tuple[Response, int]:
+        ready_body, return_code = check_ready(get_executor().is_full(), get_ready_checks())
+        return jsonify(ready_body), return_code
+
+    # Create healthcheck logic
+    def get_healthcheck() -> tuple[Response, int]:
+        health_body, return_code = create_health_response(server_id, sequence_table, get_executor().get_stats(),
+                                                          get_health_extras())
+        return jsonify(health_body), return_code
+
+    # Create starting logic
+    def start_fib() -> tuple[Response, int, dict]:
+        start_index, count = parse_start_args(flask_request.args)
+        return_code, status, msg, sequence_ids = start_sequences(start_index, count, 'GET start')
+        start_body, return_code, headers = create_start_response(return_code, status, msg, sequence_ids,
+                                                                 get_log_id(), get_executor().get_stats())
+        return jsonify(start_body), return_code, headers
+
+    # Create direct lookup logic
+    def get_fib(fib_index: int) -> tuple[Response, int]:
+        fib_body, return_code = create_fib_response(server_id, fib_index, get_log_id(),
+                                                    flask_request.args.get('format') == 'hex')
+        return jsonify(fib_body), return_code
+
+    # Create datastore logic
+    def process_log() -> tuple[Response, int]:
+        log_body, return_code = create_datastore_response(server_id, flask_request.get_json(force=True, silent=True),
+                                                          get_log_id())
+        return jsonify(log_body), return_code
+
+    app.add_url_rule('/livez', view_func=get_livez, methods=['GET'])
+    app.add_url_rule('/readyz', view_func=get_readyz, methods=['GET'])
+    app.add_url_rule('/healthcheck', view_func=get_healthcheck, methods=['GET'])
+    app.add_url_rule('/start', view_func=start_fib, methods=['GET'])
+    app.add_url_rule('/fib/<int:fib_index>', view_func=get_fib, methods=['GET'])
+    app.add_url_rule('/datastore', view_func=process_log, methods=['POST'])
@@ -0,0 +1,324 @@
+from server_init import *
+from collections import deque
+from socket import IPPROTO_TCP, TCP_NODELAY, create_connection, create_server, socket
+from ssl import CERT_REQUIRED, PROTOCOL_TLS_SERVER, SSLContext, SSLSocket
+from threading import Lock, Thread
+from typing import BinaryIO, Union
+from flask import Flask
+from datastore_utils import LogType, LogKind, report_log
+from network_utils import (FAILURE_STATUS_CODES, RETRY_STATUS_CODES, CircuitBreaker, create_ssl_context,
+                           enable_session_resumption, get_backoff, get_breaker)
+from send_utils import get_executor
+from codec_utils import decode_ack, decode_binary, encode_ack, encode_binary, encode_frame, read_frame
+from fib_utils import render_fib_number
+from sequence_utils import DEFAULT_SEQUENCE_ID, SequenceTable
+from shared_utils import get_shared_state
+from dedupe_utils import create_dedupe_key, get_original_response, remember_response
+from stage_utils import (POST_SUCCESS_MESSAGES, create_server_identifier, report_startup,
+                         create_step_log_id, get_requested_steps, get_next_fib_batch, launch_sequences,
+                         register_routes)
+
+# Create a server identifier
+SERVER_IDENTIFIER: dict = create_server_identifier()
+
+# Create startup logs from the server settings
+report_startup(SERVER_IDENTIFIER)
+
+# Start the log ID rotation; the container-wide view lives in shared memory
+SNF_LOG_ID: str = 'N/A'
+
+# Track every sequence passing through this worker
+SEQUENCE_TABLE: SequenceTable = SequenceTable(SEQUENCES_MAX_TRACKED, SEQUENCES_IDLE_SECONDS)
+
+
+# Keep one persistent mutual TLS connection to the next stage and send frames on it without waiting for their acks
+class FrameLink:
+    def __init__(self, address: str, port: int) -> None:
+        self.address: str = address
+        self.port: int = port
+        self.destination: str = f'{address}:{port}'
+        self.ssl_context: SSLContext = create_ssl_context()
+        self.connection: Union[SSLSocket, None] = None
+        self.pending: deque[tuple[tuple[int, int, int, str], str, int]] = deque()
+        self.lock: Lock = Lock()
+
+    def connect(self) -> SSLSocket:
+        # Turn off Nagle so small frames leave right away, and bound both writes and the wait for acks
+        raw_connection: socket = create_connection((self.address, self.port), timeout=NETWORK_TIMEOUT_CONNECT_SECONDS)
+        raw_connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        connection: SSLSocket = self.ssl_context.wrap_socket(raw_connection, server_hostname=self.address)
+        connection.settimeout(NETWORK_TIMEOUT_READ_SECONDS)
+        return connection
+
+    def send(self, new_fib_one: int, new_fib_two: int, steps: int, sequence_id: str, snf_log_id: str,
+             attempt: int = 0) -> None:
+        global SERVER_IDENTIFIER
+
+        # Fail fast while the next stage is known to be down
+        if not get_breaker(self.destination).allow():
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Experienced Socket Exception for message ID {snf_log_id}. Details: Circuit to '
+                       f'{self.destination} is open.')
+            return
+
+        fields: tuple[int, int, int, str] = (new_fib_one, new_fib_two, steps, sequence_id)
+        frame: bytes = encode_frame(encode_binary(
+            {'fib_one': new_fib_one, 'fib_two': new_fib_two, 'steps': steps, 'sequence': sequence_id}
+        ))
+        is_tracked: bool = False
+        with self.lock:
+            try:
+                # Open the connection on first use or after it broke; its acks are read on their own thread
+                if self.connection is None:
+                    self.connection = self.connect()
+                    self.pending = deque()
+                    Thread(target=self.read_acks, args=(self.connection, self.pending), name='frame_acks',
+                           daemon=True).start()
+                self.pending.append((fields, snf_log_id, attempt))
+                is_tracked = True
+                self.connection.sendall(frame)
+            except OSError as e:
+                get_breaker(self.destination).record_failure()
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Experienced Socket Exception for message ID {snf_log_id}. Details: {e}')
+                self.close(self.connection)
+
+        # A frame that never reached a link is resent here; the ack reader resends the ones it was tracking
+        if not is_tracked:
+            self.resend(fields, snf_log_id, attempt, 'a connection error')
+
+    def resend(self, fields: tuple[int, int, int, str], snf_log_id: str, attempt: int, reason: str) -> None:
+        global SERVER_IDENTIFIER
+
+        # Try the frame again after a jittered backoff, giving it as many attempts as an HTTP request gets
+        if attempt + 1 < NETWORK_RETRY_ATTEMPTS and get_executor().submit(self.send, *fields, snf_log_id, attempt + 1,
+                                                                           delay=get_backoff(attempt)):
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Resending message ID {snf_log_id} to {self.destination} after {reason}.')
+            return
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                   f'Dropped message ID {snf_log_id} to {self.destination} after {reason} on attempt {attempt + 1}.')
+
+    def read_acks(self, connection: SSLSocket, pending: deque[tuple[tuple[int, int, int, str], str, int]]) -> None:
+        global SERVER_IDENTIFIER
+
+        # Match acks to frames by order; the next stage answers frames in the order they arrived
+        breaker: CircuitBreaker = get_breaker(self.destination)
+        reader: BinaryIO = connection.makefile('rb')
+        try:
+            while True:
+                try:
+                    payload: Union[bytes, None] = read_frame(reader)
+                except TimeoutError:
+                    # Quietly close a link that sat idle; one that kept frames waiting past the timeout has failed
+                    with self.lock:
+                        if not pending:
+                            self.close(connection)
+                            return
+                    raise
+
+                # The next stage hung up; that only counts as clean when every frame was acknowledged
+                if payload is None:
+                    if pending:
+                        breaker.record_failure()
+                    return
+
+                return_code, log_id = decode_ack(payload)
+                fields, snf_log_id, attempt = pending.popleft()
+                if 200 <= return_code < 300:
+                    breaker.record_success()
+                elif return_code in FAILURE_STATUS_CODES:
+                    breaker.record_failure()
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Return code for message ID {snf_log_id}: {return_code}')
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Return info for message ID {snf_log_id}: {log_id}')
+
+                # A busy next stage gets the frame again once it has had time to drain
+                if return_code in RETRY_STATUS_CODES:
+                    self.resend(fields, snf_log_id, attempt, f'return code {return_code}')
+        except (OSError, ValueError, IndexError) as e:
+            breaker.record_failure()
+            report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                       f'Experienced Socket Exception on the link to {self.destination}. Details: {e}')
+        finally:
+            # Let the next send reconnect; no send can add to this link's frames once it is closed
+            with self.lock:
+                self.close(connection)
+                unacknowledged: list[tuple[tuple[int, int, int, str], str, int]] = list(pending)
+                pending.clear()
+
+            # Resend the frames the link took down with it
+            if unacknowledged:
+                report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.TRIGGERSEND], SERVER_IDENTIFIER,
+                           f'Link to {self.destination} closed with {len(unacknowledged)} unacknowledged frame(s).')
+            for fields, snf_log_id, attempt in unacknowledged:
+                self.resend(fields, snf_log_id, attempt, 'the link closed')
+
+    def close(self, connection: Union[SSLSocket, None]) -> None:
+        # Only drop the current connection if it is the one that failed; the caller holds the lock
+        if connection is not None:
+            connection.close()
+        if self.connection is connection:
+            self.connection = None
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'destination': self.destination, 'connected': self.connection is not None,
+                    'unacknowledged': len(self.pending) if self.connection is not None else 0}
+
+
+# Create the outbound link; it connects lazily on the first send
+FRAME_LINK: FrameLink = FrameLink(NETWORK_DEST_ADDRESS, NETWORK_DEST_STREAM_PORT)
+
+
+def process_frame(payload: bytes) -> tuple[int, str]:
+    global SERVER_IDENTIFIER
+    global SNF_LOG_ID
+
+    # Shed load before doing any work if sends are backed up
+    if get_executor().is_full():
+        get_executor().record_rejection()
+        report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                   'Frame rejected. Send queue is full.')
+        return 503, SNF_LOG_ID
+
+    # Get and ingest numbers; a bad frame is answered on its own so the link keeps its place in the stream
+    try:
+        fib_numbers: dict = decode_binary(payload)
+        fib_one: int = int(fib_numbers['fib_one'])
+        fib_two: int = int(fib_numbers['fib_two'])
+        steps: int = get_requested_steps(fib_numbers)
+        sequence_id: str = str(fib_numbers.get('sequence', DEFAULT_SEQUENCE_ID))
+    except (KeyError, ValueError, TypeError):
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                   'Frame failed. Unable to retrieve numbers.')
+        return 422, SNF_LOG_ID
+
+    # Answer a repeat of a recently handled message with the original response and do nothing else
+    dedupe_key: int = create_dedupe_key(fib_one, fib_two, steps, sequence_id)
+    original_response: Union[tuple[int, str], None] = get_original_response(dedupe_key)
+    if original_response is not None:
+        get_shared_state().increment('duplicatesDropped')
+        return original_response
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Retrieved numbers {render_fib_number(fib_one)} and {render_fib_number(fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Create new numbers and only keep the last pair for forwarding
+    fib_pairs: list[tuple[int, int]] = get_next_fib_batch(fib_one, fib_two, steps)
+    new_fib_one, new_fib_two = fib_pairs[-1]
+
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Next {len(fib_pairs)} fibonacci number(s) determined to be '
+               f'{', '.join(render_fib_number(fib_pair[1]) for fib_pair in fib_pairs)}.')
+    report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+               f'Sending numbers {render_fib_number(new_fib_one)} and {render_fib_number(new_fib_two)} '
+               f'in fibonacci sequence {sequence_id}.')
+
+    # Name the step after its new pair; it only counts as progress once it is on its way
+    snf_log_id: str = create_step_log_id(new_fib_one, new_fib_two)
+
+    # Decide on an acknowledgement to send back
+    if new_fib_one < UPPER_BOUND:  # Forward on the link to the next server once the throttle interval passes
+        if not get_executor().submit(FRAME_LINK.send, new_fib_one, new_fib_two, steps, sequence_id, snf_log_id,
+                                     delay=THROTTLE_SECONDS):
+            get_executor().record_rejection()
+            report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                       'Frame rejected. Send queue is full.')
+            return 503, SNF_LOG_ID
+        return_code: int = 202
+    else:  # Return that the upper bound has been reached
+        return_code: int = 200
+
+    # Update the current log id and the sequence progress now that the step is forwarded or finished
+    SNF_LOG_ID = snf_log_id
+    SEQUENCE_TABLE.update(sequence_id, SNF_LOG_ID, is_done=new_fib_one >= UPPER_BOUND)
+    get_shared_state().record_step(SNF_LOG_ID)
+    if new_fib_one >= UPPER_BOUND:
+        get_shared_state().increment('sequencesCompleted')
+
+    # Remember the response in case the same message is sent again
+    remember_response(dedupe_key, return_code, SNF_LOG_ID)
+    msg: str = POST_SUCCESS_MESSAGES[return_code]
+
+    # Send the acknowledgement back
+    report_log(LogType.SEND, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER, msg)
+    return return_code, SNF_LOG_ID
+
+
+def submit_start(fib_one: int, fib_two: int, sequence_id: str, start_log_id: str) -> bool:
+    return get_executor().submit(FRAME_LINK.send, fib_one, fib_two, STEPS_DEFAULT, sequence_id, start_log_id)
+
+
+def start_sequences(start_index: Union[int, None], count: int, method: str) -> tuple[int, str, str, list[str]]:
+    global SNF_LOG_ID
+
+    return_code, status, msg, sequence_ids, start_log_id = launch_sequences(
+        SERVER_IDENTIFIER, SEQUENCE_TABLE, start_index, count, method, submit_start
+    )
+
+    # Set the log ID to the starting pair
+    if sequence_ids:
+        SNF_LOG_ID = start_log_id
+    return return_code, status, msg, sequence_ids
+
+
+def get_log_id() -> str:
+    return SNF_LOG_ID
+
+
+def serve_connection(connection: socket, server_context: SSLContext) -> None:
+    global SERVER_IDENTIFIER
+
+    # Finish the handshake off the accept loop, then answer each frame in order as it arrives
+    try:
+        connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        with server_context.wrap_socket(connection, server_side=True) as tls_connection:
+            reader: BinaryIO = tls_connection.makefile('rb')
+            while (payload := read_frame(reader)) is not None:
+                return_code, log_id = process_frame(payload)
+                tls_connection.sendall(encode_frame(encode_ack(return_code, log_id)))
+    except (OSError, ValueError) as e:
+        report_log(LogType.RECEIVE, [LogKind.ONCALL, LogKind.MAIN], SERVER_IDENTIFIER,
+                   f'Frame connection closed. Details: {e}')
+    finally:
+        connection.close()
+
+
+def serve_frames(listener: socket, server_context: SSLContext) -> None:
+    # Give every incoming link its own thread; there is one link per worker of the previous stage
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except OSError:
+            return
+        Thread(target=serve_connection, args=(connection, server_context), name='frame_link', daemon=True).start()
+
+
+def create_frame_server() -> socket:
+    # Every worker binds the same port with SO_REUSEPORT so the kernel spreads links across workers
+    listener: socket = create_server((NETWORK_SELF_ADDRESS_LISTENING, NETWORK_SELF_STREAM_PORT), reuse_port=True)
+
+    # Require a client certificate from the CA the stages share
+    server_context: SSLContext = SSLContext(PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile=SECRET_CERT_TARGET, keyfile=SECRET_KEY_TARGET)
+    server_context.load_verify_locations(cafile=TLS_CA_CERT_PATH)
+    server_context.verify_mode = CERT_REQUIRED
+    enable_session_resumption(server_context)
+
+    Thread(target=serve_frames, args=(listener, server_context), name='frame_server', daemon=True).start()
+    return listener
+
+
+# Start the frame server in this worker
+FRAME_SERVER: socket = create_frame_server()
+
+# Create app object for the HTTP control routes served by Gunicorn
+app = Flask(__name__)
+
+
+# Add the control routes every stage shares
+register_routes(app, SERVER_IDENTIFIER, SEQUENCE_TABLE, get_log_id, start_sequences,
+                get_health_extras=lambda: {'link': FRAME_LINK.get_stats()})
@@ -0,0 +1,33 @@
+from server_init import *
+from errno import EAGAIN, ECONNABORTED, EWOULDBLOCK
+from functools import partial
+from selectors import EVENT_READ
+from socket import AF_UNIX
+from gunicorn.http import RequestParser
+from gunicorn.workers.gthread import TConn, ThreadWorker
+
+
+# Create a connection that leaves Unix domain socket peers in plain text unless TLS is asked for on them
+class UnixSocketConn(TConn):
+    def init(self) -> None:
+        if self.parser is None and self.sock.family == AF_UNIX and not NETWORK_SOCKET_TLS:
+            self.initialized = True
+            self.sock.setblocking(True)
+            self.parser = RequestParser(self.cfg, self.sock, self.client)
+        else:
+            super().init()
+
+
+# Create a threaded worker that accepts on both the TCP and the Unix domain socket listeners
+class UnixSocketWorker(ThreadWorker):
+    def accept(self, server, listener) -> None:
+        try:
+            sock, client = listener.accept()
+            conn: UnixSocketConn = UnixSocketConn(self.cfg, sock, client, server)
+
+            self.nr_conns += 1
+            with self._lock:
+                self.poller.register(conn.sock, EVENT_READ, partial(self.on_client_socket_readable, conn))
+        except OSError as e:
+            if e.errno not in (EAGAIN, ECONNABORTED, EWOULDBLOCK):
+                raise
@@ -0,0 +1,42 @@
+from os import environ
+from pathlib import Path
+from subprocess import CompletedProcess, run
+from sys import executable
+
+# Point the server components at their default configuration
+BASE_FOLDER: Path = Path(__file__).resolve().parent
+COMPONENTS_FOLDER: Path = BASE_FOLDER.parent / 'components'
+CONFIG_PATH: str = str(COMPONENTS_FOLDER / 'server_config.json')
+
+# Import the datastore module in a fresh interpreter, load the chosen drivers, and report the cost of both
+MEASURE_CODE: str = '''
+from importlib import import_module
+from resource import RUSAGE_SELF, getrusage
+from sys import argv
+from time import perf_counter
+
+start: float = perf_counter()
+import datastore_utils
+drivers: tuple[str, ...] = datastore_utils.DATASTORE_BACKENDS[argv[1]].driver_modules
+if argv[2] == 'eager':
+    drivers = tuple(module for backend in datastore_utils.DATASTORE_BACKENDS.values()
+                    for module in backend.driver_modules)
+for module in drivers:
+    import_module(module)
+print(f'{perf_counter() - start:.3f} {getrusage(RUSAGE_SELF).ru_maxrss / 1024:.1f}')
+'''
+
+# Compare importing only the selected driver against importing every driver like the module used to
+datastore_types: list[str] = ['none', 'file', 'elasticstack', 'mongodb', 'postgresql']
+environment: dict = {**environ, 'SERVER_CONFIG_FILEPATH': CONFIG_PATH, 'DEFAULT_SERVER_CONFIG_FILEPATH': CONFIG_PATH}
+print(f'{'Datastore':>12} {'Loading':>8} {'Import s':>10} {'Peak RSS MB':>12}')
+for datastore_type in datastore_types:
+    for loading in ['lazy', 'eager']:
+        result: CompletedProcess = run([executable, '-c', MEASURE_CODE, datastore_type, loading],
+                                       cwd=COMPONENTS_FOLDER, env={**environment, 'DATASTORE_TYPE': datastore_type},
+                                       capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f'{datastore_type:>12} {loading:>8} failed: {result.stderr.strip().splitlines()[-1]}')
+            continue
+        import_seconds, peak_rss = result.stdout.split()[-2:]
+        print(f'{datastore_type:>12} {loading:>8} {import_seconds:>10} {peak_rss:>12}')
@@ -0,0 +1,33 @@
+from asyncio import Event, run
+from pathlib import Path
+from sys import argv
+from amqtt.broker import Broker
+
+# Get base folder
+BASE_FOLDER: Path = Path(__file__).resolve().parent
+
+# Listen with TLS on the given port using the test TLS materials unless others are given
+port: int = int(argv[1]) if len(argv) > 1 else 8883
+ca_file: str = argv[2] if len(argv) > 2 else f'{BASE_FOLDER}/test_ca.crt'
+cert_file: str = argv[3] if len(argv) > 3 else f'{BASE_FOLDER}/test_self.crt'
+key_file: str = argv[4] if len(argv) > 4 else f'{BASE_FOLDER}/test_self.key'
+broker_config: dict = {
+    'listeners': {
+        'default': {
+            'type': 'tcp', 'bind': f'127.0.0.1:{port}', 'ssl': True, 'cafile': ca_file, 'certfile': cert_file,
+            'keyfile': key_file
+        }
+    },
+    'plugins': {'amqtt.plugins.authentication.AnonymousAuthPlugin': {'allow_anonymous': True}}
+}
+
+
+async def serve() -> None:
+    # Stand in for the broker the stages share until stopped with Ctrl+C
+    broker: Broker = Broker(broker_config)
+    await broker.start()
+    print(f'Broker listening on 127.0.0.1:{port}...')
+    await Event().wait()
+
+
+run(serve())
@@ -0,0 +1,53 @@
+from json import dumps
+from pathlib import Path
+from sys import path
+from timeit import timeit
+
+# Make the server components importable
+BASE_FOLDER: Path = Path(__file__).resolve().parent
+path.insert(0, str(BASE_FOLDER.parent / 'components'))
+
+from codec_utils import JSON_CONTENT_TYPE, encode_message, decode_message
+from soap_utils import SOAP_CHUNK_SIZE, parse_advance, render_advance_request, render_advance_response
+
+
+def get_fib_pair(n: int) -> tuple[int, int]:
+    # Walk the sequence up to index n
+    fib_one: int = 1
+    fib_two: int = 0
+    for _ in range(n):
+        fib_one, fib_two = fib_two, fib_one + fib_two
+    return fib_one, fib_two
+
+
+def hop_rest(fib_numbers: dict) -> int:
+    # Encode the message, decode it on the next stage, and encode the response like rest.py does
+    body, content_type = encode_message(fib_numbers, 'json')
+    decode_message(body, content_type)
+    response: bytes = dumps({'status': 'Success', 'message': 'POST request succeeded. Sent off fibonacci numbers.',
+                             'result': '1-0-1', 'sequence': fib_numbers['sequence']}).encode()
+    return len(body) + len(response)
+
+
+def hop_soap(fib_numbers: dict) -> int:
+    # Render the envelope, parse it in chunks on the next stage, and render the response like soap.py does
+    body: bytes = render_advance_request(fib_numbers)
+    parse_advance(body[start:start + SOAP_CHUNK_SIZE] for start in range(0, len(body), SOAP_CHUNK_SIZE))
+    response: bytes = render_advance_response(202, 'Success', 'POST request succeeded. Sent off fibonacci numbers.',
+                                              '1-0-1', fib_numbers['sequence'])
+    return len(body) + len(response)
+
+
+# Compare the bytes on the wire and the codec time of one hop at increasing fibonacci indices
+indices: list[int] = [10, 100, 1000, 5000, 20000]
+loops: int = 2000
+print(f'{'Index':>8} {'API':>8} {'Bytes':>10} {'Hop us':>10}')
+for index in indices:
+    fib_one, fib_two = get_fib_pair(index)
+    fib_numbers: dict = {'fib_one': fib_one, 'fib_two': fib_two, 'steps': 1, 'sequence': '1-0123456789ab'}
+    assert parse_advance([render_advance_request(fib_numbers)]) == fib_numbers
+    assert decode_message(encode_message(fib_numbers, 'json')[0], JSON_CONTENT_TYPE) == fib_numbers
+
+    for api, hop in [('rest', hop_rest), ('soap', hop_soap)]:
+        hop_time: float = timeit(lambda: hop(fib_numbers), number=loops)
+        print(f'{index:>8} {api:>8} {hop(fib_numbers):>10} {hop_time / loops * 1e6:>10.2f}')
@@ -0,0 +1,35 @@
+from pathlib import Path
+from sys import path
+from timeit import timeit
+
+# Make the server components importable
+BASE_FOLDER: Path = Path(__file__).resolve().parent
+path.insert(0, str(BASE_FOLDER.parent / 'components'))
+
+from codec_utils import WireFormat, encode_message, decode_message
+
+
+def get_fib_pair(n: int) -> tuple[int, int]:
+    # Walk the sequence up to index n
+    fib_one: int = 1
+    fib_two: int = 0
+    for _ in range(n):
+        fib_one, fib_two = fib_two, fib_one + fib_two
+    return fib_one, fib_two
+
+
+# Compare payload size and codec speed at increasing Fibonacci indices
+indices: list[int] = [10, 100, 1000, 5000, 20000]
+loops: int = 2000
+print(f'{'Index':>8} {'Format':>8} {'Bytes':>10} {'Encode us':>10} {'Decode us':>10}')
+for index in indices:
+    fib_one, fib_two = get_fib_pair(index)
+    fib_numbers: dict = {'fib_one': fib_one, 'fib_two': fib_two, 'steps': 1, 'sequence': '1-0123456789ab'}
+    for wire_format in WireFormat:
+        body, content_type = encode_message(fib_numbers, wire_format.value)
+        assert decode_message(body, content_type) == fib_numbers
+
+        encode_time: float = timeit(lambda: encode_message(fib_numbers, wire_format.value), number=loops)
+        decode_time: float = timeit(lambda: decode_message(body, content_type), number=loops)
+        print(f'{index:>8} {wire_format.value:>8} {len(body):>10} {encode_time / loops * 1e6:>10.2f} '
+              f'{decode_time / loops * 1e6:>10.2f}')
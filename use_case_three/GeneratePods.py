@@ -86,6 +86,14 @@ def create_deployment_template(name: str, namespace_name: str, replica_count: in
         'failureThreshold': 3
     }
 
+    # Create the volume every stage shares its Unix domain socket through
+    socket_volume_name: str = f'{name}-socket-mount'
+    deployment['spec']['template']['spec']['volumes'].append(create_empty_dir_volume(socket_volume_name))
+
+    # Create the volume every stage caches its generated TLS materials in, so restarted containers reuse them
+    tls_cache_volume_name: str = f'{name}-tls-cache-mount'
+    deployment['spec']['template']['spec']['volumes'].append(create_empty_dir_volume(tls_cache_volume_name))
+
     # Create settings for each stage
     for i in range(stage['count']):
         server_stage_index: int = i + 1
@@ -97,11 +105,13 @@ def create_deployment_template(name: str, namespace_name: str, replica_count: in
             'protocol': 'TCP'
         }]
 
-        # Create the destination port
+        # Create the destination port and socket
         if server_stage_index < stage['count']:
             dest_port: int = engine['startPort'] + server_stage_index + 1
+            dest_socket_name: str = f'{stage['namePrefix']}-{server_stage_index + 1}'
         elif server_stage_index == stage['count']:
             dest_port: int = engine['startPort'] + 1
+            dest_socket_name: str = f'{stage['namePrefix']}-1'
         else:
             raise IndexError(f'{server_stage_index} is invalid.')
 
@@ -118,19 +128,29 @@ def create_deployment_template(name: str, namespace_name: str, replica_count: in
             {'name': 'DEST_ADDRESS', 'value': dns['default']},
             {'name': 'DEST_PORT', 'value': f'{dest_port}'},
             {'name': 'THROTTLE_INTERVAL', 'value': f'{envs['throttleInterval']}'},
-            {'name': 'UPPER_BOUND', 'value': f'{envs['upperBound']}'}
+            {'name': 'UPPER_BOUND', 'value': f'{envs['upperBound']}'},
+            {'name': 'NETWORK_SELF_SOCKETPATH', 'value': f'{envs['socketTarget']}/{server_stage_name}.sock'},
+            {'name': 'NETWORK_DEST_SOCKETPATH', 'value': f'{envs['socketTarget']}/{dest_socket_name}.sock'},
+            {'name': 'NETWORK_SOCKETTLS', 'value': f'{envs['socketTls']}'.lower()},
+            {'name': 'TLS_CACHE_PATH', 'value': envs['tlsCacheTarget']}
         ]
 
-        # Create volume mount
-        secret_mount: list[dict] = [{
+        # Create volume mounts
+        volume_mounts: list[dict] = [{
             'name': f'{server_stage_name}-secret-mount',
             'mountPath': envs['tlsTarget'],
             'readOnly': True
+        }, {
+            'name': socket_volume_name,
+            'mountPath': envs['socketTarget']
+        }, {
+            'name': tls_cache_volume_name,
+            'mountPath': envs['tlsCacheTarget']
         }]
 
         # Add containers and volumes
         deployment['spec']['template']['spec']['containers'].append(
-            create_container(server_stage_name, image_name, port_bindings, env_settings, secret_mount, probe_settings)
+            create_container(server_stage_name, image_name, port_bindings, env_settings, volume_mounts, probe_settings)
         )
         deployment['spec']['template']['spec']['volumes'].append(
             create_secret_volume(f'{server_stage_name}-secret-mount', f'{server_stage_name}-secret')